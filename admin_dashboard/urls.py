@@ -35,5 +35,8 @@ urlpatterns = [
     path('payments/esewa/', views.esewa_payments, name='esewa_payments'),
     path('payments/esewa/<int:pk>/process/', views.process_esewa_payment, name='process_esewa_payment'),
     
+    # Recommendation engine
+    path('metrics/recommendations/', views.recommendation_metrics, name='recommendation_metrics'),
+    
     
 ]  + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
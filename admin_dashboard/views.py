@@ -7,6 +7,8 @@ from shop.models import Product, Category, Order, OrderItem, EsewaPayment
 from accounts.models import UserProfile
 from .forms import ProductForm, CategoryForm
 from django.contrib.auth.models import User
+from django.http import JsonResponse
+from shop.instrumentation import metrics
 
 @login_required
 def dashboard(request):
@@ -308,3 +310,15 @@ def process_esewa_payment(request, pk):
     return render(request, 'admin_dashboard/process_payment.html', {
         'order': order
     })
+
+@login_required
+def recommendation_metrics(request):
+    # Check if user is admin
+    if not getattr(getattr(request.user, 'profile', None), 'is_admin', False):
+        return JsonResponse({'error': "You don't have permission to view recommendation metrics."}, status=403)
+    
+    if request.method == 'POST' and request.POST.get('action') == 'reset':
+        metrics.reset()
+    
+    # Add ?profiles=1 to include the sampled cProfile reports
+    return JsonResponse(metrics.as_dict(include_profiles=request.GET.get('profiles') == '1'))
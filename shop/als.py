@@ -0,0 +1,267 @@
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .artifacts import (
+    artifact_dir, artifact_version, artifact_versions, delete_array, load_array, load_artifact, save_array,
+    save_artifact,
+)
+from .ranking import top_k
+from .scoring import current_boost, scoring_signature
+from .snapshot import InteractionSnapshot
+
+
+
+ALS_MODEL_ARTIFACT = 'als_model'
+
+# Users scored per matrix product in recommend_many
+BLOCK_USERS = 2048
+
+
+
+
+class ALSModel:
+    """
+    Implicit-feedback matrix factorisation of the interaction matrix.
+
+    ``user_ids`` / ``product_ids`` label the rows of the float32
+    ``user_factors`` / ``item_factors`` arrays, which are stored as separate
+    ``.npy`` artefacts and memory-mapped on first use rather than pickled
+    with the model. ``seen_indptr`` / ``seen_indices`` hold each user's
+    interacted item rows (CSR layout) so they can be excluded without
+    reading the interaction table.
+    """
+
+    def __init__(self, user_ids, product_ids, seen_indptr, seen_indices, params):
+        self.version = f'{time.time_ns():x}'
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.seen_indptr = np.asarray(seen_indptr, dtype=np.int64)
+        self.seen_indices = np.asarray(seen_indices, dtype=np.int32)
+        self.params = params
+        self.scoring = scoring_signature()
+        self.trained_at = time.time()
+        self._init_lookups()
+
+
+
+    def _init_lookups(self):
+        self.user_index = {int(uid): row for row, uid in enumerate(self.user_ids)}
+        self._user_factors = None
+        self._item_factors = None
+
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('user_index', '_user_factors', '_item_factors'):
+            state.pop(name, None)
+        return state
+
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_lookups()
+
+
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return user_id in self.user_index
+
+
+
+    @property
+    def user_factors(self):
+        if self._user_factors is None:
+            self._user_factors = load_array(self._array_name('user_factors'))
+        return self._user_factors
+
+    @property
+    def item_factors(self):
+        if self._item_factors is None:
+            self._item_factors = load_array(self._array_name('item_factors'))
+        return self._item_factors
+
+
+
+    def save(self, user_factors, item_factors):
+        """Write the factor arrays, then the model that points at them, then drop arrays no kept model uses"""
+        previous = load_artifact(ALS_MODEL_ARTIFACT)
+        # The arrays share the model artefact's version; a later save drops
+        # them once publish_artifacts has pruned that version's model file
+        self.version = artifact_version()
+        save_array(self._array_name('user_factors'), user_factors.astype(np.float32))
+        save_array(self._array_name('item_factors'), item_factors.astype(np.float32))
+        save_artifact(ALS_MODEL_ARTIFACT, self, self.version)
+
+        kept = set(artifact_versions(ALS_MODEL_ARTIFACT))
+        if previous is not None:
+            kept.add(previous.version)
+        for path in artifact_dir().glob('als_*.npy'):
+            if path.stem.rsplit('.', 1)[-1] not in kept:
+                # Processes still holding the old mapping keep it until they reload
+                delete_array(path.stem)
+
+
+
+    def scores(self, user_id):
+        """Predicted preference of one user for every item row, or None for an unknown user"""
+        row = self.user_index.get(user_id)
+        if row is None:
+            return None
+        return self.item_factors @ self.user_factors[row]
+
+
+
+    def recommend(self, user_id, limit, allowed=None):
+        """
+        Top item rows for a user, excluding the items they interacted with.
+
+        Args:
+            user_id: Target user id
+            limit: Number of product ids to return
+            allowed: Optional boolean mask over item rows (e.g. availability)
+
+        Returns:
+            List of product ids, best first, or None for an unknown user
+        """
+        scores = self.scores(user_id)
+        if scores is None:
+            return None
+        row = self.user_index[user_id]
+        scores[self.seen_indices[self.seen_indptr[row]:self.seen_indptr[row + 1]]] = -np.inf
+        if allowed is not None:
+            scores[~allowed] = -np.inf
+        return self.product_ids[top_k(scores, limit)].tolist()
+
+
+
+    def recommend_many(self, user_ids, limit, allowed=None):
+        """
+        ``recommend`` for many users, scoring them in blocks of BLOCK_USERS.
+
+        Returns:
+            {user_id: list of product ids} for the users the model knows
+        """
+        known = [user_id for user_id in user_ids if user_id in self.user_index]
+        rows = np.array([self.user_index[user_id] for user_id in known], dtype=np.int64)
+        results = {}
+        for start in range(0, len(rows), BLOCK_USERS):
+            block = rows[start:start + BLOCK_USERS]
+            scores = self.user_factors[block] @ self.item_factors.T
+            for offset, row in enumerate(block.tolist()):
+                seen = self.seen_indices[self.seen_indptr[row]:self.seen_indptr[row + 1]]
+                scores[offset, seen] = -np.inf
+            if allowed is not None:
+                scores[:, ~allowed] = -np.inf
+            for offset, user_id in enumerate(known[start:start + BLOCK_USERS]):
+                results[user_id] = self.product_ids[top_k(scores[offset], limit)].tolist()
+        return results
+
+
+
+    def seen_product_ids(self, user_id):
+        """Products a user had interacted with when the model was trained"""
+        row = self.user_index.get(user_id)
+        if row is None:
+            return set()
+        return set(self.product_ids[self.seen_indices[self.seen_indptr[row]:self.seen_indptr[row + 1]]].tolist())
+
+
+
+    def allowed_mask(self, product_ids):
+        """Boolean mask over item rows for the given product ids"""
+        return np.isin(self.product_ids, np.fromiter(product_ids, dtype=np.int64))
+
+
+
+    def _array_name(self, name):
+        return f'als_{name}.{self.version}'
+
+
+
+
+def als_params():
+    """Training parameters from the RECOMMENDER_ALS_* settings"""
+    return {
+        'factors': getattr(settings, 'RECOMMENDER_ALS_FACTORS', 32),
+        'iterations': getattr(settings, 'RECOMMENDER_ALS_ITERATIONS', 10),
+        'regularization': getattr(settings, 'RECOMMENDER_ALS_REGULARIZATION', 1.0),
+        'alpha': getattr(settings, 'RECOMMENDER_ALS_ALPHA', 10.0),
+        'seed': 42,
+    }
+
+
+
+def train_als(snapshot=None, **overrides):
+    """
+    Fit and save an ALSModel on the current interaction scores.
+
+    Scores are decayed to the present and used as confidences
+    c = 1 + alpha * score on a binary preference matrix (Hu, Koren &
+    Volinsky, "Collaborative Filtering for Implicit Feedback Datasets").
+    User and item factors are solved for in turn, each in closed form.
+
+    Args:
+        snapshot: Optional InteractionSnapshot to train on
+        **overrides: Replace any of the als_params()
+
+    Returns:
+        The saved ALSModel
+    """
+    params = {**als_params(), **overrides}
+    matrix = (snapshot or InteractionSnapshot()).matrix
+    confidence = matrix.matrix.astype(np.float64) * (params['alpha'] / current_boost())
+    confidence.eliminate_zeros()
+
+    rng = np.random.default_rng(params['seed'])
+    n_users, n_items = confidence.shape
+    user_factors = rng.normal(scale=0.01, size=(n_users, params['factors']))
+    item_factors = rng.normal(scale=0.01, size=(n_items, params['factors']))
+    by_item = confidence.T.tocsr()
+    for _ in range(params['iterations']):
+        user_factors = _least_squares(confidence, item_factors, params['regularization'])
+        item_factors = _least_squares(by_item, user_factors, params['regularization'])
+
+    model = ALSModel(matrix.user_ids, matrix.product_ids, confidence.indptr, confidence.indices, params)
+    model.save(user_factors, item_factors)
+    return model
+
+
+
+def get_als_model():
+    """The trained ALSModel, or None if it hasn't been trained with the current scoring settings"""
+    model = load_artifact(ALS_MODEL_ARTIFACT)
+    if model is None or model.scoring != scoring_signature() or model.item_factors is None:
+        return None
+    return model
+
+
+
+def _least_squares(confidence, fixed, regularization):
+    """
+    Solve every row's factors against the ``fixed`` side.
+
+    For row u with confidence c_u - 1 stored in ``confidence``:
+    (YtY + Yt (C_u - I) Y + reg * I) x_u = Yt C_u p_u, where YtY is shared by
+    all rows so each solve only touches the row's own items.
+    """
+    n_factors = fixed.shape[1]
+    gram = fixed.T @ fixed + regularization * np.eye(n_factors)
+    solved = np.zeros((confidence.shape[0], n_factors))
+    indptr, indices, data = confidence.indptr, confidence.indices, confidence.data
+    for row in range(confidence.shape[0]):
+        start, end = indptr[row], indptr[row + 1]
+        if start == end:
+            continue
+        factors = fixed[indices[start:end]]
+        weights = data[start:end]
+        a = gram + (factors.T * weights) @ factors
+        b = factors.T @ (1 + weights)
+        solved[row] = np.linalg.solve(a, b)
+    return solved
@@ -0,0 +1,220 @@
+from abc import ABC, abstractmethod
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+
+
+# Defaults for the recall vs latency knobs, per metric
+DEFAULT_ANN_TABLES = {'cosine': 16, 'jaccard': 32}
+DEFAULT_ANN_BITS = {'cosine': 4, 'jaccard': 2}
+
+
+
+
+class _LSHIndex(ABC):
+    """
+    Shared bucket bookkeeping for the LSH indexes.
+
+    Each of ``n_tables`` hash tables buckets vectors by a code built from
+    ``n_bits`` hash values. A query returns the union of its buckets as
+    candidates, which the caller re-scores exactly.
+
+    Recall vs latency: more tables raise recall and cost; more bits make
+    buckets smaller, which is faster but lowers recall. Subclasses provide
+    the hash family.
+    """
+
+    def __init__(self, n_tables=8, n_bits=12, seed=42):
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.codes = None
+        self.tables = []
+
+
+
+    def fit(self, vectors):
+        """
+        Index the rows of ``vectors``.
+
+        Returns:
+            self
+        """
+        self._init_hashes(vectors.shape[1])
+        self.codes = self._hash(vectors)
+        self.tables = [defaultdict(list) for _ in range(self.n_tables)]
+        for row, row_codes in enumerate(self.codes.tolist()):
+            for table, code in zip(self.tables, row_codes):
+                table[code].append(row)
+        return self
+
+
+
+    def update(self, rows, vectors):
+        """
+        Re-hash existing rows and append new ones after their vectors changed.
+
+        Args:
+            rows: Row numbers, in the same order as ``vectors``
+            vectors: New vectors for those rows; rows past the end are added,
+                and new columns (e.g. new products) get fresh hash functions
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        self._grow_hashes(vectors.shape[1])
+
+        if len(rows) and rows.max() >= len(self.codes):
+            grow = rows.max() + 1 - len(self.codes)
+            self.codes = np.vstack([self.codes, np.full((grow, self.n_tables), -1, dtype=np.int64)])
+
+        new_codes = self._hash(vectors)
+        for row, row_codes in zip(rows.tolist(), new_codes.tolist()):
+            for t, (table, code) in enumerate(zip(self.tables, row_codes)):
+                old = self.codes[row, t]
+                if old == code:
+                    continue
+                if old >= 0:
+                    table[old].remove(row)
+                table[code].append(row)
+                self.codes[row, t] = code
+
+
+
+    def candidates(self, vector):
+        """Rows sharing at least one bucket with ``vector``"""
+        codes = self._hash(vector)[0]
+        buckets = [table.get(code, ()) for table, code in zip(self.tables, codes.tolist())]
+        if not any(buckets):
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate([np.asarray(bucket, dtype=np.int64) for bucket in buckets]))
+
+
+
+    @abstractmethod
+    def _init_hashes(self, n_columns):
+        """Draw the hash functions for vectors of ``n_columns``"""
+
+    @abstractmethod
+    def _grow_hashes(self, n_columns):
+        """Extend the hash functions to ``n_columns``, keeping existing codes valid"""
+
+    @abstractmethod
+    def _hash(self, vectors):
+        """Return an (n_rows, n_tables) array of non-negative bucket codes"""
+
+
+
+
+class RandomProjectionLSH(_LSHIndex):
+    """
+    LSH for cosine similarity using random projections (SimHash).
+
+    A table's code is the signs of ``n_bits`` random projections, so vectors
+    with a small angle between them tend to share a bucket.
+    """
+
+    def _init_hashes(self, n_columns):
+        rng = np.random.default_rng(self.seed)
+        self.planes = rng.standard_normal((n_columns, self.n_tables * self.n_bits))
+
+    def _grow_hashes(self, n_columns):
+        if n_columns > self.planes.shape[0]:
+            rng = np.random.default_rng(self.seed + self.planes.shape[0])
+            extra = rng.standard_normal((n_columns - self.planes.shape[0], self.planes.shape[1]))
+            self.planes = np.vstack([self.planes, extra])
+
+
+
+    def _hash(self, vectors):
+        projected = vectors @ self.planes
+        if sparse.issparse(projected):
+            projected = projected.toarray()
+        projected = np.atleast_2d(np.asarray(projected))
+
+        bits = (projected > 0).reshape(len(projected), self.n_tables, self.n_bits)
+        weights = 1 << np.arange(self.n_bits, dtype=np.int64)
+        return (bits * weights).sum(axis=2)
+
+
+
+
+class MinHashLSH(_LSHIndex):
+    """
+    LSH for Jaccard similarity of sets (the non-zero columns of each row).
+
+    Each table is a band of ``n_bits`` MinHash values; two sets with Jaccard
+    similarity J land in the same bucket of a table with probability J ** n_bits.
+    """
+
+    def _init_hashes(self, n_columns):
+        rng = np.random.default_rng(self.seed)
+        self.column_hashes = rng.integers(0, 2 ** 32, size=(self.n_tables * self.n_bits, n_columns), dtype=np.uint64)
+        self.band_weights = rng.integers(1, 2 ** 61, size=(self.n_bits, 1), dtype=np.uint64)
+
+    def _grow_hashes(self, n_columns):
+        if n_columns > self.column_hashes.shape[1]:
+            rng = np.random.default_rng(self.seed + self.column_hashes.shape[1])
+            extra = rng.integers(0, 2 ** 32, size=(self.column_hashes.shape[0], n_columns - self.column_hashes.shape[1]), dtype=np.uint64)
+            self.column_hashes = np.hstack([self.column_hashes, extra])
+
+
+
+    def _hash(self, vectors):
+        vectors = sparse.csr_matrix(vectors)
+        codes = np.zeros((vectors.shape[0], self.n_tables), dtype=np.int64)
+        nonempty = np.diff(vectors.indptr) > 0
+        if not nonempty.any():
+            return codes
+
+        starts = vectors.indptr[:-1][nonempty]
+        for t in range(self.n_tables):
+            band = self.column_hashes[t * self.n_bits:(t + 1) * self.n_bits][:, vectors.indices]
+            minima = np.minimum.reduceat(band, starts, axis=1)
+            # Fold the band's MinHash values into one code (uint64 arithmetic wraps)
+            combined = (minima * self.band_weights).sum(axis=0)
+            codes[nonempty, t] = (combined & np.uint64(0x7FFFFFFFFFFFFFFF)).astype(np.int64)
+        return codes
+
+
+
+
+def build_ann_index(vectors, metric='cosine'):
+    """
+    Fit an LSH index over ``vectors`` when there are enough rows for it to pay off.
+
+    Controlled by RECOMMENDER_ANN_MIN_ROWS (below it, exact search is used)
+    and the per-metric RECOMMENDER_ANN_TABLES / RECOMMENDER_ANN_BITS dicts.
+
+    Args:
+        vectors: Row vectors to index
+        metric: 'cosine' (random projections) or 'jaccard' (MinHash over non-zero columns)
+
+    Returns:
+        RandomProjectionLSH, MinHashLSH or None
+    """
+    if vectors.shape[0] < getattr(settings, 'RECOMMENDER_ANN_MIN_ROWS', 5000):
+        return None
+    tables = {**DEFAULT_ANN_TABLES, **getattr(settings, 'RECOMMENDER_ANN_TABLES', {})}
+    bits = {**DEFAULT_ANN_BITS, **getattr(settings, 'RECOMMENDER_ANN_BITS', {})}
+
+    index_class = MinHashLSH if metric == 'jaccard' else RandomProjectionLSH
+    return index_class(n_tables=tables[metric], n_bits=bits[metric]).fit(vectors)
+
+
+
+def cosine_to(vectors, vector):
+    """Cosine similarity of each row of ``vectors`` to a single row ``vector``"""
+    if sparse.issparse(vectors):
+        numerator = np.asarray((vectors @ vector.T).todense()).ravel()
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    else:
+        vector = vector.toarray() if sparse.issparse(vector) else vector
+        numerator = np.asarray(vectors @ np.ravel(vector)).ravel()
+        norms = np.linalg.norm(vectors, axis=1)
+
+    vector_norm = np.sqrt(vector.multiply(vector).sum()) if sparse.issparse(vector) else np.linalg.norm(vector)
+    denominator = norms * vector_norm
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator > 0, numerator / denominator, 0.0)
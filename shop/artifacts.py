@@ -0,0 +1,277 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from .instrumentation import record_cache
+
+
+
+# Artefact mapping each model name to the version load_artifact reads
+# (see publish_artifacts); train_recommenders also records its runs in it
+MANIFEST_ARTIFACT = 'training_manifest'
+
+# Loaded artefacts, keyed by name: (path, file signature, object)
+_loaded = {}
+_lock = threading.Lock()
+
+# Version being written by staged_artifacts in this thread
+_staging = threading.local()
+
+
+
+
+def artifact_dir():
+    """Directory recommendation models are written to"""
+    path = getattr(settings, 'RECOMMENDER_ARTIFACT_DIR', None)
+    path = Path(path) if path else Path(settings.BASE_DIR) / 'recommender_artifacts'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+
+def artifact_path(name, version=None):
+    return artifact_dir() / (f'{name}.{version}.pickle' if version else f'{name}.pickle')
+
+
+
+def artifact_version():
+    """The version the next save_artifact writes: the staged one, or a new one"""
+    version = getattr(_staging, 'version', None)
+    return version or f'{time.time_ns():x}'
+
+
+
+def artifact_versions(name):
+    """Versions of ``name`` on disk, published or not"""
+    prefix = f'{name}.'
+    return [path.name[len(prefix):-len('.pickle')] for path in artifact_dir().glob(f'{prefix}*.pickle')]
+
+
+
+@contextmanager
+def staged_artifacts(version):
+    """
+    Save artefacts under ``version`` without publishing them.
+
+    Inside the block save_artifact records each name it writes in the
+    yielded dict (name -> version) instead of updating the manifest, and
+    load_artifact reads those staged copies; serving processes keep the
+    published ones until publish_artifacts switches them over.
+    """
+    _staging.version = version
+    _staging.saved = {}
+    try:
+        yield _staging.saved
+    finally:
+        _staging.version = None
+        _staging.saved = None
+
+
+
+def save_artifact(name, obj, version=None):
+    """
+    Pickle ``obj`` to the artefact directory under a new version, and publish it.
+
+    The file is written to a temporary name and moved into place with
+    ``os.replace`` so readers in other processes never see a partial file,
+    and load_artifact only switches to it once the manifest points at it.
+
+    Returns:
+        The version written
+    """
+    version = version or artifact_version()
+    path = artifact_path(name, version)
+    _write(path, obj)
+
+    saved = getattr(_staging, 'saved', None)
+    if saved is not None:
+        # Not cached: this process may still be serving the published copy
+        saved[name] = version
+    else:
+        with _lock:
+            _loaded[name] = (path, _signature(path), obj)
+        publish_artifacts({name: version})
+    return version
+
+
+
+def load_artifact(name, default=None):
+    """
+    Load the published version of an artefact, reusing the in-process copy until it changes.
+
+    Artefacts saved before they were versioned are read from their
+    unversioned file until a version of them is published.
+
+    Returns:
+        The unpickled object, or ``default`` if it hasn't been built yet
+    """
+    saved = getattr(_staging, 'saved', None) or {}
+    version = saved.get(name) or _load(MANIFEST_ARTIFACT, artifact_path(MANIFEST_ARTIFACT), {}).get('artifacts', {}).get(name)
+    return _load(name, artifact_path(name, version), default)
+
+
+
+def publish_artifacts(versions, manifest=None):
+    """
+    Point load_artifact at new versions of artefacts with one manifest write.
+
+    The manifest is replaced atomically, so every name in ``versions``
+    switches at once. Each name keeps the version it replaced on disk (a
+    process may still be loading it, and a publisher in another process
+    that read the manifest first can point back at it); older ones are
+    deleted.
+
+    Args:
+        versions: Artefact name -> version to publish
+        manifest: Other entries to store in the manifest, e.g. a training run's details
+
+    Returns:
+        The new manifest
+    """
+    path = artifact_path(MANIFEST_ARTIFACT)
+    with _lock:
+        current = _read(path, {})
+        previous = current.get('artifacts', {})
+        published = {**current, **(manifest or {}), 'artifacts': {**previous, **versions}}
+        _write(path, published)
+        _loaded[MANIFEST_ARTIFACT] = (path, _signature(path), published)
+
+    for name, version in versions.items():
+        for old in artifact_versions(name):
+            if old not in (version, previous.get(name)):
+                delete_artifact(name, old)
+    return published
+
+
+
+def delete_artifact(name, version=None):
+    """Remove one version of an artefact (by default the unversioned file)"""
+    path = artifact_path(name, version)
+    with _lock:
+        if name in _loaded and _loaded[name][0] == path:
+            del _loaded[name]
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+
+def array_path(name):
+    return artifact_dir() / f'{name}.npy'
+
+
+
+def save_array(name, array):
+    """
+    Write a NumPy array artefact for ``load_array`` to memory-map.
+
+    Written and moved into place like ``save_artifact``. Processes that
+    already mapped the old file keep reading it until they reload.
+    """
+    path = array_path(name)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+
+def load_array(name):
+    """
+    Memory-map an array artefact read-only, reusing the mapping until the file changes.
+
+    Pages are shared between every process mapping the same file and only
+    read from disk when touched.
+
+    Returns:
+        numpy.memmap, or None if the file doesn't exist
+    """
+    path = array_path(name)
+    key = ('array', name)
+    try:
+        signature = _signature(path)
+    except FileNotFoundError:
+        return None
+
+    with _lock:
+        cached = _loaded.get(key)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+    array = np.load(path, mmap_mode='r')
+    with _lock:
+        _loaded[key] = (signature, array)
+    return array
+
+
+
+def delete_array(name):
+    with _lock:
+        _loaded.pop(('array', name), None)
+    try:
+        os.remove(array_path(name))
+    except FileNotFoundError:
+        pass
+
+
+
+def _load(name, path, default):
+    try:
+        signature = _signature(path)
+    except FileNotFoundError:
+        record_cache(f'artifact.{name}', hit=False)
+        return default
+
+    with _lock:
+        cached = _loaded.get(name)
+        if cached and cached[:2] == (path, signature):
+            record_cache(f'artifact.{name}', hit=True)
+            return cached[2]
+
+    record_cache(f'artifact.{name}', hit=False)
+
+    obj = _read(path, default)
+    with _lock:
+        _loaded[name] = (path, signature, obj)
+    return obj
+
+
+
+def _read(path, default):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return default
+
+
+
+def _write(path, obj):
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.stem}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
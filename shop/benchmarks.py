@@ -0,0 +1,465 @@
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.test import Client
+from django.urls import reverse
+
+from .instrumentation import counting_queries
+from .models import CartItem, Category, InteractionRollup, Product, ShoppingCart, UserProductInteraction
+from .ranking import in_order, top_items, top_k
+from .recommendation import BULK_METHODS, _clean_candidates, get_recommendations, get_recommendations_bulk
+from .snapshot import InteractionSnapshot
+
+
+
+# Benchmarks run by ``manage.py run_benchmarks``, in registration order
+BENCHMARKS = {}
+
+RECOMMENDATION_METHODS = ('collaborative', 'clean', 'clustering', 'als', 'content', 'hybrid')
+
+# Scored candidates ranked by the top_k benchmark, and the list sizes it
+# reorders (sorting by list.index is quadratic, so it only runs up to 10k)
+TOP_K_CANDIDATES = 100_000
+REORDER_SIZES = (1_000, 10_000, 100_000)
+INDEX_REORDER_MAX = 10_000
+
+# Query strings exercised by the shop_list benchmark
+SHOP_LIST_QUERIES = {
+    'default': {},
+    'category': {'category': None},  # Filled with a real category slug
+    'search': {'search': 'chocolate'},
+    'price': {'price': '1500'},
+    'sort_price_desc': {'sort': 'price-desc'},
+    'page_3': {'page': '3'},
+}
+
+# Cart lines checked out by the checkout benchmark
+CHECKOUT_CART_SIZES = (3, 50)
+
+
+
+
+def benchmark(name):
+    """Register a benchmark function taking a BenchmarkRun and returning a dict of results"""
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+
+
+class BenchmarkRun:
+    """
+    Options and the sampled users/products shared by every benchmark.
+
+    Users and products are sampled evenly by id, so the same data gives the
+    same sample on every run.
+    """
+
+    def __init__(self, users=50, products=50, repeat=3, limit=5):
+        self.repeat = repeat
+        self.limit = limit
+        self.users = _evenly_spaced(User.objects.filter(interaction_rollups__isnull=False).distinct().order_by('id'), users)
+        self.products = _evenly_spaced(Product.objects.filter(available=True).order_by('id'), products)
+
+
+
+    def measure(self, func, calls):
+        """
+        Time ``func(arg)`` for each argument in ``calls``, ``repeat`` times over.
+
+        Returns:
+            Dict of latency percentiles in ms and queries per call, or
+            {'error': ...} if a call raised
+        """
+        timings = []
+        queries = 0
+        for _ in range(self.repeat):
+            for arg in calls:
+                with counting_queries() as counted:
+                    started = time.perf_counter()
+                    try:
+                        func(arg)
+                    except Exception as e:
+                        # Report the failure and carry on with the other benchmarks
+                        return {'error': f'{type(e).__name__}: {e}'}
+                    timings.append((time.perf_counter() - started) * 1000)
+                queries += counted[0]
+        return summarise(timings, queries)
+
+
+
+
+def summarise(timings_ms, queries=0):
+    """Latency summary for a list of per-call timings"""
+    if not timings_ms:
+        return {'calls': 0}
+    timings = np.asarray(timings_ms)
+    return {
+        'calls': len(timings),
+        'mean_ms': round(float(timings.mean()), 3),
+        'p50_ms': round(float(np.percentile(timings, 50)), 3),
+        'p95_ms': round(float(np.percentile(timings, 95)), 3),
+        'max_ms': round(float(timings.max()), 3),
+        'queries_per_call': round(queries / len(timings), 2),
+    }
+
+
+
+def dataset_summary():
+    return {
+        'users': User.objects.count(),
+        'categories': Category.objects.count(),
+        'products': Product.objects.count(),
+        'interactions': UserProductInteraction.objects.count(),
+        'interaction_rollups': InteractionRollup.objects.count(),
+    }
+
+
+
+def run_benchmarks(run, names=None):
+    """
+    Run the registered benchmarks.
+
+    Returns:
+        {benchmark name: results}
+    """
+    return {
+        name: func(run)
+        for name, func in BENCHMARKS.items()
+        if names is None or name in names
+    }
+
+
+
+
+@benchmark('recommendations')
+def bench_recommendations(run):
+    """Live get_recommendations per method, plus precomputed reads where the table has rows"""
+    results = {}
+    for method in RECOMMENDATION_METHODS:
+        product_based = method == 'content'
+        calls = run.products if product_based else run.users
+
+        def live(arg, method=method, product_based=product_based):
+            if product_based:
+                return get_recommendations(None, method, product=arg, limit=run.limit, use_precomputed=False)
+            return get_recommendations(arg, method, limit=run.limit, use_precomputed=False)
+
+        def stored(arg, method=method, product_based=product_based):
+            if product_based:
+                return get_recommendations(None, method, product=arg, limit=run.limit)
+            return get_recommendations(arg, method, limit=run.limit)
+
+        results[f'{method}.live'] = run.measure(live, calls)
+        if method != 'hybrid':
+            results[f'{method}.precomputed'] = run.measure(stored, calls)
+    return results
+
+
+
+@benchmark('recommendations_bulk')
+def bench_recommendations_bulk(run):
+    """get_recommendations_bulk for the whole user sample, per method"""
+    user_ids = [user.id for user in run.users]
+    results = {}
+    for method in BULK_METHODS:
+        result = run.measure(lambda ids, method=method: get_recommendations_bulk(ids, method, run.limit), [user_ids])
+        result['users_per_call'] = len(user_ids)
+        results[method] = result
+    return results
+
+
+
+@benchmark('clean_pipeline')
+def bench_clean_pipeline(run):
+    """
+    Vectorised clean candidates against reference_clean_candidates.
+
+    ``cold`` reads a fresh snapshot per call, as a page render does; ``warm``
+    shares one loaded snapshot. ``mismatched_users`` counts sampled users
+    whose candidate ranking differs from the reference and should be 0.
+    """
+    snapshot = InteractionSnapshot()
+    len(snapshot)  # Load outside the timings
+
+    mismatched = 0
+    for user in run.users:
+        if _ranking(_clean_candidates(user, snapshot)) != _ranking(reference_clean_candidates(user, snapshot)):
+            mismatched += 1
+
+    results = {
+        'golden_users': len(run.users),
+        'mismatched_users': mismatched,
+    }
+    for name, new_snapshot in (('cold', InteractionSnapshot), ('warm', lambda: snapshot)):
+        reference = run.measure(lambda user: reference_clean_candidates(user, new_snapshot()), run.users)
+        vectorised = run.measure(lambda user: _clean_candidates(user, new_snapshot()), run.users)
+        results[f'{name}.reference'] = reference
+        results[f'{name}.vectorised'] = vectorised
+        if reference.get('mean_ms') and vectorised.get('mean_ms'):
+            results[f'{name}.speedup'] = round(reference['mean_ms'] / vectorised['mean_ms'], 1)
+    return results
+
+
+
+@benchmark('top_k')
+def bench_top_k(run):
+    """
+    Best ``run.limit * 2`` of TOP_K_CANDIDATES scores with a full sort against
+    shop.ranking, and putting fetched objects back in ranking order with
+    ``list.index`` against a position map. ``identical`` checks both give the
+    same answer.
+    """
+    rng = np.random.default_rng(0)
+    # Rounded scores so there are plenty of ties to keep in order
+    scores = np.round(rng.random(TOP_K_CANDIDATES), 3)
+    candidates = dict(zip(rng.permutation(TOP_K_CANDIDATES * 10)[:TOP_K_CANDIDATES].tolist(), scores.tolist()))
+    k = run.limit * 2
+
+    def sort_items(items):
+        return sorted(items.items(), key=lambda x: x[1], reverse=True)[:k]
+
+    results = {
+        'candidates': TOP_K_CANDIDATES,
+        'identical': (
+            top_items(candidates, k) == sort_items(candidates)
+            and np.array_equal(top_k(scores, k), np.argsort(-scores, kind='stable')[:k])
+        ),
+        'dict.sorted': run.measure(sort_items, [candidates]),
+        'dict.top_items': run.measure(lambda items: top_items(items, k), [candidates]),
+        'array.argsort': run.measure(lambda values: np.argsort(-values, kind='stable')[:k], [scores]),
+        'array.top_k': run.measure(lambda values: top_k(values, k), [scores]),
+    }
+
+    for size in REORDER_SIZES:
+        ids = list(candidates)[:size]
+        objects = [SimpleNamespace(id=object_id) for object_id in rng.permutation(ids).tolist()]
+        if size <= INDEX_REORDER_MAX:
+            results[f'reorder_{size}.index'] = run.measure(lambda objs: sorted(objs, key=lambda x: ids.index(x.id)), [objects])
+        results[f'reorder_{size}.position_map'] = run.measure(lambda objs: in_order(objs, ids), [objects])
+    return results
+
+
+
+@benchmark('shop_list')
+def bench_shop_list(run):
+    """The shop page with each filter, as HTML and as the AJAX JSON response"""
+    client = _client()
+    category = Category.objects.order_by('id').first()
+    url = reverse('shop:shop_list')
+
+    results = {}
+    for name, params in SHOP_LIST_QUERIES.items():
+        params = dict(params)
+        if 'category' in params:
+            if category is None:
+                continue
+            params['category'] = category.slug
+        results[f'{name}.html'] = run.measure(lambda query: client.get(url, query), [params])
+        results[f'{name}.ajax'] = run.measure(
+            lambda query: client.get(url, query, HTTP_X_REQUESTED_WITH='XMLHttpRequest'), [params]
+        )
+    return results
+
+
+
+@benchmark('checkout')
+def bench_checkout(run):
+    """Cash-on-delivery checkout of carts of CHECKOUT_CART_SIZES lines; every order is rolled back"""
+    if not run.users or not run.products:
+        return {}
+
+    client = _client()
+    client.force_login(run.users[0])
+    url = reverse('shop:checkout')
+    form = {
+        'first_name': 'Bench',
+        'last_name': 'Mark',
+        'email': 'bench@example.com',
+        'address': '1 Bench Street',
+        'postal_code': '44600',
+        'city': 'Kathmandu',
+        'payment_method': 'cod',
+    }
+
+    def checkout(products):
+        with transaction.atomic():
+            ShoppingCart.objects.filter(user=run.users[0]).delete()
+            cart = ShoppingCart.objects.create(user=run.users[0])
+            CartItem.objects.bulk_create(
+                CartItem(cart=cart, product=product, quantity=2, price=product.price) for product in products
+            )
+            cart.update_totals()
+            client.post(url, form)
+            transaction.set_rollback(True)
+
+    # Sizes beyond the sampled products (see --products) are skipped
+    return {
+        f'cod_{size}_items': run.measure(checkout, [run.products[:size]])
+        for size in CHECKOUT_CART_SIZES
+        if size <= len(run.products)
+    }
+
+
+
+
+def _client():
+    # Use a configured host so requests pass ALLOWED_HOSTS outside the test runner
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')]
+    return Client(HTTP_HOST=hosts[0] if hosts else 'localhost')
+
+
+
+def _ranking(candidates):
+    # Product ids best first, ties in insertion order as clean_recommendations sorts them
+    if candidates is None:
+        return None
+    return [product_id for product_id, _ in sorted(candidates.items(), key=lambda x: x[1], reverse=True)]
+
+
+
+def _evenly_spaced(queryset, count):
+    ids = list(queryset.values_list('id', flat=True))
+    if len(ids) > count:
+        ids = [ids[i] for i in np.linspace(0, len(ids) - 1, count).astype(int)]
+    objects = queryset.model.objects.in_bulk(ids)
+    return [objects[pk] for pk in ids]
+
+
+
+
+def reference_clean_candidates(user, snapshot):
+    """
+    The original pure-Python clean algorithm steps 1-5, kept as the golden
+    reference for recommendation._clean_candidates (see bench_clean_pipeline)
+    
+    Returns:
+        {product_id: score} for products the user hasn't interacted with,
+        or None when the user should get popular products instead
+    """
+    # Get all user interactions
+    interactions = list(snapshot.rows())
+    
+    if not interactions or not Product.objects.filter(available=True).exists():
+        return None
+    
+    
+    
+    
+    
+    
+    # Step 1: Calculate interaction statistics for outlier detection
+    product_interaction_counts = defaultdict(int)
+    user_interaction_counts = defaultdict(int)
+    
+    for interaction_user_id, product_id, _, count, _ in interactions:
+        product_interaction_counts[product_id] += count
+        user_interaction_counts[interaction_user_id] += count
+        
+        
+        
+        
+         
+    
+    # Calculate mean and standard deviation for product interactions
+    product_counts = list(product_interaction_counts.values())
+    product_mean = sum(product_counts) / len(product_counts) if product_counts else 0
+    product_std = (sum((x - product_mean) ** 2 for x in product_counts) / len(product_counts)) ** 0.5 if product_counts else 0
+    
+    
+    # Identify outlier products (products with abnormally high interaction counts)
+    outlier_threshold = product_mean + 2 * product_std
+    outlier_products = {pid for pid, count in product_interaction_counts.items() if count > outlier_threshold}
+    
+    
+    
+    # Step 2: Create normalized user-item interaction matrix
+    user_item_matrix = defaultdict(dict)
+    
+    # Fill the matrix with weighted, time-decayed interaction scores
+    for (interaction_user_id, product_id, _, _, _), score in zip(interactions, snapshot.scores().tolist()):
+        # Skip outlier products for cleaner recommendations
+        if product_id in outlier_products:
+            continue
+        
+        if interaction_user_id in user_item_matrix:
+            if product_id in user_item_matrix[interaction_user_id]:
+                user_item_matrix[interaction_user_id][product_id] += score
+            else:
+                user_item_matrix[interaction_user_id][product_id] = score
+        else:
+            user_item_matrix[interaction_user_id] = {product_id: score}
+            
+            
+            
+    
+    # Step 3: Normalize scores per user to address different user activity levels
+    for user_id in user_item_matrix:
+        user_scores = user_item_matrix[user_id]
+        max_score = max(user_scores.values()) if user_scores else 1
+        for product_id in user_scores:
+            user_item_matrix[user_id][product_id] /= max_score
+            
+            
+            
+    
+    # Step 4: Find similar users with normalized data
+    target_user_id = user.id
+    if target_user_id not in user_item_matrix:
+        # If user has no interactions, return popular products
+        return None
+    
+    user_similarities = {}
+    target_user_items = user_item_matrix[target_user_id]
+    
+    for other_user_id, other_user_items in user_item_matrix.items():
+        if other_user_id == target_user_id:
+            continue
+        
+        
+        
+        # Calculate cosine similarity
+        common_items = set(target_user_items.keys()) & set(other_user_items.keys())
+        if not common_items:
+            continue
+            
+        numerator = sum(target_user_items[item] * other_user_items[item] for item in common_items)
+        sum1 = sum(target_user_items[item] ** 2 for item in target_user_items)
+        sum2 = sum(other_user_items[item] ** 2 for item in other_user_items)
+        
+        denominator = (sum1 ** 0.5) * (sum2 ** 0.5)
+        
+        if denominator == 0:
+            continue
+            
+        similarity = numerator / denominator
+        user_similarities[other_user_id] = similarity
+        
+        
+        
+    
+    # Get top similar users
+    similar_users = sorted(user_similarities.items(), key=lambda x: x[1], reverse=True)[:10]
+    
+    
+    
+    # Step 5: Get items from similar users that target user hasn't interacted with
+    target_user_items_set = set(target_user_items.keys())
+    candidate_items = {}
+    
+    for similar_user_id, similarity in similar_users:
+        for item_id, score in user_item_matrix[similar_user_id].items():
+            if item_id not in target_user_items_set:
+                if item_id in candidate_items:
+                    candidate_items[item_id] += score * similarity
+                else:
+                    candidate_items[item_id] = score * similarity
+    
+    return candidate_items
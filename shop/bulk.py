@@ -0,0 +1,345 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from .diversity import category_round_robin
+from .ranking import top_k, top_k_rows
+
+# Vectorised kernels behind ``get_recommendations_bulk``. This module only
+# depends on numpy/scipy so worker processes can import it and unpickle a
+# BulkContext without configuring Django.
+
+
+
+# Neighbours used per user, as in the single-user recommenders
+N_NEIGHBOURS = 10
+
+# Upper bound on cells in one dense block of user x user similarities
+BLOCK_CELLS = 2 ** 22
+
+# Users per task handed to a worker process
+POOL_CHUNK_SIZE = 1000
+
+# Set by _init_worker inside worker processes
+_worker_context = None
+
+
+
+
+class BulkContext:
+    """
+    Data the bulk recommenders share, loaded once per call.
+
+    ``matrix`` is the user x product score matrix with ``user_ids`` /
+    ``product_ids`` labelling its rows and columns. ``popular_ids`` is the
+    popular-product fallback (any prefix of it is valid for a smaller limit),
+    ``available_ids`` the available products in catalogue (name) order and
+    ``category_of`` their categories.
+
+    For clustering, ``cluster_product_ids`` / ``clusters`` come from the
+    fitted ClusterModel (None when the catalogue is too small), and
+    ``cluster_weights`` / ``cluster_first_seen`` hold each user's summed
+    interaction weight per cluster and the position of their first
+    interaction in it.
+
+    Ties are broken as in the single-user recommenders: ``first_touched``
+    (InteractionSnapshot.first_touched) orders tied candidates by when the
+    neighbours, best first, touched them, and ``clean_first_seen`` orders
+    tied clean neighbours.
+    """
+
+    def __init__(self, user_ids, product_ids, matrix, popular_ids, available_ids, category_of,
+                 clean_matrix=None, cluster_product_ids=None, clusters=None,
+                 cluster_weights=None, cluster_first_seen=None, first_touched=None, clean_first_seen=None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.user_index = {int(uid): row for row, uid in enumerate(self.user_ids)}
+        self.matrix = matrix.tocsr()
+        self.binary = _pattern(self.matrix)
+        self.popular_ids = list(popular_ids)
+        self.available_ids = list(available_ids)
+        self.available_position = {pid: position for position, pid in enumerate(self.available_ids)}
+        self.category_of = category_of
+        self.clean_matrix = clean_matrix
+        self.cluster_product_ids = cluster_product_ids
+        self.clusters = clusters
+        self.cluster_weights = cluster_weights
+        self.cluster_first_seen = cluster_first_seen
+        self.first_touched = first_touched
+        self.clean_first_seen = clean_first_seen
+
+
+
+    def popular(self, limit, exclude=()):
+        """Popular product ids for a fallback of ``limit`` products, minus ``exclude``"""
+        return [pid for pid in self.popular_ids[:limit] if pid not in exclude]
+
+
+
+    def available(self, product_ids):
+        return [pid for pid in product_ids if pid in self.available_position]
+
+
+
+
+def recommend_users(context, method, user_ids, limit, workers=None):
+    """
+    Recommend for every user in ``user_ids``, optionally across a process pool.
+
+    Returns:
+        {user_id: [product_id, ...]}
+    """
+    user_ids = list(user_ids)
+    if not workers or workers < 2 or len(user_ids) <= POOL_CHUNK_SIZE:
+        return recommend_chunk(context, method, user_ids, limit)
+
+    chunks = [user_ids[start:start + POOL_CHUNK_SIZE] for start in range(0, len(user_ids), POOL_CHUNK_SIZE)]
+    results = {}
+    # The context is sent once per worker, not once per chunk
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(context,)) as pool:
+        for chunk_results in pool.map(_recommend_in_worker, [method] * len(chunks), chunks, [limit] * len(chunks)):
+            results.update(chunk_results)
+    return results
+
+
+
+def recommend_chunk(context, method, user_ids, limit):
+    """Recommend for ``user_ids`` in the current process"""
+    recommenders = {
+        'collaborative': _collaborative,
+        'clean': _clean,
+        'clustering': _clustering,
+    }
+    return recommenders[method](context, list(user_ids), limit)
+
+
+
+def _init_worker(context):
+    global _worker_context
+    _worker_context = context
+
+
+
+def _recommend_in_worker(method, user_ids, limit):
+    return recommend_chunk(_worker_context, method, user_ids, limit)
+
+
+
+def round_robin_by_category(items, category_of, limit):
+    """
+    Pick items round-robin across categories
+
+    Categories take turns in the order they first appear in ``items``, and
+    each category yields its items in their original order.
+    """
+    positions = category_round_robin([category_of(item) for item in items], limit)
+    return [items[position] for position in positions.tolist()]
+
+
+
+
+def _collaborative(context, user_ids, limit):
+    """Jaccard user neighbours on raw interactions, as collaborative_filtering"""
+    results = {}
+    binary = context.binary
+    row_sizes = np.diff(binary.indptr)
+    binary_t = binary.T.tocsc()
+
+    rows, missing = _known_rows(context, user_ids)
+    for user_id in missing:
+        results[user_id] = context.popular(limit)
+
+    for block_rows in _blocks(rows, binary.shape[0]):
+        intersection = (binary[block_rows] @ binary_t).toarray()
+        union = row_sizes[block_rows, None] + row_sizes[None, :] - intersection
+        similarities = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+        for row, ranked in _rank_blocks(context, block_rows, similarities, context.matrix, binary, include_zero=True, limit=limit):
+            seen = set(context.product_ids[binary.indices[binary.indptr[row]:binary.indptr[row + 1]]].tolist())
+            recommended = ranked
+
+            # If we don't have enough recommendations, add popular products
+            if len(recommended) < limit:
+                for product_id in context.popular(limit - len(recommended)):
+                    if product_id not in recommended and product_id not in seen:
+                        recommended.append(product_id)
+                        if len(recommended) >= limit:
+                            break
+
+            results[int(context.user_ids[row])] = context.available(recommended)
+    return results
+
+
+
+def _clean(context, user_ids, limit):
+    """Cosine user neighbours on outlier-free normalised scores, as clean_recommendations"""
+    results = {}
+    if context.clean_matrix is None or not context.available_ids:
+        return {user_id: context.popular(limit) for user_id in user_ids}
+
+    clean = context.clean_matrix
+    clean_t = clean.T.tocsc()
+    norms = np.sqrt(np.asarray(clean.multiply(clean).sum(axis=1)).ravel())
+
+    rows, missing = _known_rows(context, user_ids)
+    for user_id in missing:
+        results[user_id] = context.popular(limit)
+
+    # Users whose every product is an outlier have no clean vector
+    empty = norms[rows] == 0
+    for row in rows[empty]:
+        results[int(context.user_ids[row])] = context.popular(limit)
+    rows = rows[~empty]
+
+    for block_rows in _blocks(rows, clean.shape[0]):
+        numerator = (clean[block_rows] @ clean_t).toarray()
+        denominator = norms[block_rows, None] * norms[None, :]
+        similarities = np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+        ranked_blocks = _rank_blocks(
+            context, block_rows, similarities, clean, _pattern(clean),
+            include_zero=False, limit=limit * 2, neighbour_order=context.clean_first_seen,
+        )
+        for row, ranked in ranked_blocks:
+            # Get more than needed for diversity, then restore catalogue order
+            top = context.available(ranked)
+            top.sort(key=context.available_position.__getitem__)
+            results[int(context.user_ids[row])] = round_robin_by_category(top, context.category_of.__getitem__, limit)
+    return results
+
+
+
+def _clustering(context, user_ids, limit):
+    """Unseen products from each user's preferred KMeans cluster, as clustering_recommendations"""
+    if context.cluster_product_ids is None:
+        return {user_id: context.popular(limit) for user_id in user_ids}
+
+    results = {}
+    binary = context.binary
+    rows, missing = _known_rows(context, user_ids)
+    for user_id in missing:
+        results[user_id] = context.popular(limit)
+    if not len(rows):
+        return results
+
+    # Preferred cluster: highest weight, ties going to the cluster interacted with first
+    weights = context.cluster_weights[rows]
+    is_best = weights == weights.max(axis=1, keepdims=True)
+    preferred = np.where(is_best, context.cluster_first_seen[rows], np.iinfo(np.int64).max).argmin(axis=1)
+    # Default to the first cluster when none of the user's products are clustered
+    preferred[weights.max(axis=1) == 0] = 0
+
+    for row, cluster in zip(rows.tolist(), preferred.tolist()):
+        seen = context.product_ids[binary.indices[binary.indptr[row]:binary.indptr[row + 1]]]
+        unseen = ~np.isin(context.cluster_product_ids, seen)
+        in_cluster = context.clusters == cluster
+
+        recommended = context.cluster_product_ids[unseen & in_cluster][:limit].tolist()
+        if len(recommended) < limit:
+            recommended += context.cluster_product_ids[unseen & ~in_cluster][:limit - len(recommended)].tolist()
+        results[int(context.user_ids[row])] = context.available(recommended)
+    return results
+
+
+
+
+def _known_rows(context, user_ids):
+    """Split users into matrix rows and ids without any interactions"""
+    rows = [context.user_index[user_id] for user_id in user_ids if user_id in context.user_index]
+    missing = [user_id for user_id in user_ids if user_id not in context.user_index]
+    return np.asarray(rows, dtype=np.int64), missing
+
+
+
+def _blocks(rows, n_users):
+    """Split ``rows`` so each dense block of similarities stays under BLOCK_CELLS"""
+    size = max(1, BLOCK_CELLS // max(1, n_users))
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+
+def _rank_blocks(context, block_rows, similarities, scores_from, candidates_from, include_zero, limit, neighbour_order=None):
+    """
+    Score unseen products from each row's top neighbours and keep the best ``limit``.
+
+    Args:
+        block_rows: Matrix rows of the target users
+        similarities: Dense (len(block_rows), n_users) similarity block
+        scores_from: Matrix the neighbours' scores are read from
+        candidates_from: 0/1 matrix of the products each neighbour can contribute
+        include_zero: Whether users with zero similarity can fill the neighbour list
+        limit: Number of products to keep per row
+        neighbour_order: Optional per-user key breaking ties between
+            neighbours; by default ties keep matrix row order
+
+    Yields:
+        (row, [product_id, ...]) with the best score first
+    """
+    n_rows = len(block_rows)
+    similarities[np.arange(n_rows), block_rows] = -np.inf
+    if not include_zero:
+        similarities[similarities <= 0] = -np.inf
+
+    if neighbour_order is None:
+        # Ties keep matrix row order, like nearest_neighbours()
+        neighbour_rows = top_k_rows(similarities, N_NEIGHBOURS)
+    else:
+        by_order = np.argsort(neighbour_order, kind='stable')
+        neighbour_rows = by_order[top_k_rows(similarities[:, by_order], N_NEIGHBOURS)]
+    neighbour_similarities = np.take_along_axis(similarities, neighbour_rows, axis=1)
+    valid = np.isfinite(neighbour_similarities)
+
+    positions = np.repeat(np.arange(n_rows), neighbour_rows.shape[1])[valid.ravel()]
+    shape = (n_rows, similarities.shape[1])
+    weights = sparse.csr_matrix((neighbour_similarities[valid], (positions, neighbour_rows[valid])), shape=shape)
+    members = sparse.csr_matrix((np.ones(len(positions)), (positions, neighbour_rows[valid])), shape=shape)
+
+    scores = (weights @ scores_from).tocsr()
+    candidates = (members @ candidates_from).tocsr()
+    candidates.sort_indices()
+
+    binary = context.binary
+    row_scores = np.zeros(scores.shape[1])
+    first_keys = np.full(scores.shape[1], np.inf)
+    touched_stride = context.first_touched.data.max(initial=0) + 1 if context.first_touched is not None else None
+    for offset, row in enumerate(block_rows.tolist()):
+        cols = candidates.indices[candidates.indptr[offset]:candidates.indptr[offset + 1]]
+        cols = cols[~np.isin(cols, binary.indices[binary.indptr[row]:binary.indptr[row + 1]])]
+        if context.first_touched is not None:
+            cols = _first_touched(context.first_touched, neighbour_rows[offset][valid[offset]], cols, first_keys, touched_stride)
+
+        start, end = scores.indptr[offset], scores.indptr[offset + 1]
+        row_scores[scores.indices[start:end]] = scores.data[start:end]
+        ranked = cols[top_k(row_scores[cols], limit)]
+        row_scores[scores.indices[start:end]] = 0
+
+        yield row, context.product_ids[ranked].tolist()
+
+
+
+def _first_touched(first_touched, neighbour_rows, cols, keys, stride):
+    """
+    ``cols`` in the order the neighbours, best first, each first touched them.
+
+    ``keys`` is scratch space of one inf per column, left as it was found;
+    ``stride`` is above every position in ``first_touched``.
+    """
+    touched = []
+    for rank, row in enumerate(neighbour_rows.tolist()):
+        start, end = first_touched.indptr[row], first_touched.indptr[row + 1]
+        touched.append(first_touched.indices[start:end])
+        np.minimum.at(keys, touched[-1], rank * stride + first_touched.data[start:end])
+    ordered = cols[np.argsort(keys[cols], kind='stable')]
+    for row_cols in touched:
+        keys[row_cols] = np.inf
+    return ordered
+
+
+
+def _pattern(matrix):
+    """0/1 copy of a sparse matrix's non-zero pattern"""
+    pattern = matrix.copy()
+    pattern.data = np.ones_like(pattern.data)
+    return pattern
@@ -1,41 +1,166 @@
+import logging
+import random
 from decimal import Decimal
 from django.conf import settings
-from .models import Product
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .instrumentation import increment
+from .models import CartItem, Product, ShoppingCart
+
+
+logger = logging.getLogger(__name__)
 
 
 
 class Cart:
+    """
+    The visitor's cart, stored as a ShoppingCart row with CartItem lines.
+
+    Signed-in users have one cart each. Anonymous visitors get a cart whose
+    id is kept in the session under CART_SESSION_ID, merged into their own
+    cart when they sign in (see ``merge_session_cart``). The row is read on
+    first use and only created on the first write; its ``item_count`` and
+    ``total`` are updated with every write, so ``len(cart)`` and
+    ``get_total_price()`` never load the items or their products.
+
+    The item count is also copied into the session under
+    CART_COUNT_SESSION_ID whenever this session reads or changes the cart,
+    which is what ``cart_item_count`` serves the cart badge from.
+    """
+
     def __init__(self, request):
         """Initialize the cart."""
         self.session = request.session
-        cart = self.session.get(settings.CART_SESSION_ID)
-        if not cart:
-            # Save an empty cart in the session
-            cart = self.session[settings.CART_SESSION_ID] = {}
-        self.cart = cart
-        # Debug: Log cart contents on initialization
-        print(f"Cart contents: {self.cart}")
-        
-        
-
-    def add(self, product, quantity=1, override_quantity=False):
+        user = getattr(request, 'user', None)
+        self.user = user if user is not None and user.is_authenticated else None
+        self._record = None
+        self._loaded = False
+        self._items = None
+
+
+
+    @property
+    def record(self):
+        """The ShoppingCart row, or None while the cart has never been written"""
+        if not self._loaded:
+            self._record = self._find_record()
+            self._loaded = True
+            self._remember_count()
+        return self._record
+
+
+
+    def _remember_count(self):
+        count = self._record.item_count if self._record is not None else 0
+        if self.user is None and not count and _count_key() not in self.session:
+            # cart_item_count needs no count for anonymous visitors without a cart; don't start a session for one
+            return
+        if self.session.get(_count_key()) != count:
+            self.session[_count_key()] = count
+
+
+
+    def _find_record(self):
+        stored = self.session.get(settings.CART_SESSION_ID)
+        if isinstance(stored, dict):
+            # A cart from before carts were stored in the database
+            return self._import_session_cart(stored)
+
+        if self.user is not None:
+            return ShoppingCart.objects.filter(user=self.user).first()
+        if stored is None:
+            return None
+        return ShoppingCart.objects.filter(pk=stored, user__isnull=True).first()
+
+
+
+    def _import_session_cart(self, stored):
+        del self.session[settings.CART_SESSION_ID]
+        self.save()
+        self._loaded = True
+        self._record = self.user and ShoppingCart.objects.filter(user=self.user).first()
+
+        product_ids = [int(pid) for pid in stored if str(pid).isdigit()]
+        for product in Product.objects.filter(id__in=product_ids):
+            item = stored[str(product.id)]
+            self.add(product, quantity=int(item['quantity']), price=Decimal(item['price']))
+        return self._record
+
+
+
+    def lock(self):
+        """
+        Lock the cart row until the end of the transaction and re-read it.
+
+        Writes to a cart take this lock first, so they run one at a time and
+        the lines read after it stay as read until the transaction ends.
+        """
+        if self.record is None:
+            return
+        self._record = ShoppingCart.objects.select_for_update().filter(pk=self._record.pk).first()
+        self._items = None
+        self._remember_count()
+
+
+
+    def _record_for_write(self):
+        self.lock()
+        record = self._record
+        if record is None:
+            if self.user is not None:
+                record, _ = ShoppingCart.objects.get_or_create(user=self.user)
+            else:
+                record = ShoppingCart.objects.create()
+                self.session[settings.CART_SESSION_ID] = record.pk
+                self.save()
+            self._record = record
+        return record
+
+
+
+    def add(self, product, quantity=1, override_quantity=False, price=None):
         """Add a product to the cart or update its quantity."""
         # Validate that product has a valid integer ID
         try:
-            product_id = str(int(product.id))  # Ensure ID is numeric
-        except (ValueError, AttributeError):
-            print(f"Invalid product ID: {product.id if hasattr(product, 'id') else product}")
+            product_id = int(product.id)  # Ensure ID is numeric
+        except (ValueError, TypeError, AttributeError):
+            _trace('invalid_id', logging.WARNING, operation='add', product_id=getattr(product, 'id', product))
             return  # Skip adding invalid product
 
-        if product_id not in self.cart:
-            self.cart[product_id] = {'quantity': 0, 'price': str(product.price)}
+        with transaction.atomic():
+            record = self._record_for_write()
+            item, _ = CartItem.objects.select_for_update().get_or_create(
+                cart=record,
+                product_id=product_id,
+                defaults={'quantity': 0, 'price': product.price if price is None else price},
+            )
+            new_quantity = quantity if override_quantity else item.quantity + quantity
+            delta = max(new_quantity, 0) - item.quantity
+
+            if new_quantity > 0:
+                item.quantity = new_quantity
+                item.save(update_fields=['quantity'])
+            else:
+                item.delete()
+            self._adjust_totals(delta, delta * item.price)
+        _trace('add', cart_id=record.pk, product_id=product_id, quantity=new_quantity)
 
-        if override_quantity:
-            self.cart[product_id]['quantity'] = quantity
-        else:
-            self.cart[product_id]['quantity'] += quantity
 
-        self.save()
+
+    def _adjust_totals(self, quantity, amount):
+        """Apply a change to the stored item count and total, in the database and on the loaded row"""
+        self._items = None
+        if not quantity:
+            return
+        ShoppingCart.objects.filter(pk=self._record.pk).update(
+            item_count=F('item_count') + quantity,
+            total=F('total') + amount,
+            updated=timezone.now(),
+        )
+        self._record.item_count += quantity
+        self._record.total += amount
+        self._remember_count()
 
 
 
@@ -48,48 +173,198 @@ class Cart:
     def remove(self, product):
         """Remove a product from the cart."""
         try:
-            product_id = str(int(product.id))  # Validate ID
-            if product_id in self.cart:
-                del self.cart[product_id]
-                self.save()
-        except (ValueError, AttributeError):
-            print(f"Invalid product ID for removal: {product.id if hasattr(product, 'id') else product}")
+            product_id = int(product.id)  # Validate ID
+        except (ValueError, TypeError, AttributeError):
+            _trace('invalid_id', logging.WARNING, operation='remove', product_id=getattr(product, 'id', product))
+            return
+
+        with transaction.atomic():
+            self.lock()
+            if self._record is None:
+                return
+            item = CartItem.objects.select_for_update().filter(cart=self._record, product_id=product_id).first()
+            if item is not None:
+                item.delete()
+                self._adjust_totals(-item.quantity, -item.get_cost())
+        _trace('remove', cart_id=self._record.pk, product_id=product_id, removed=item is not None)
+
+
+
+    def update_prices(self, prices):
+        """
+        Reprice lines, e.g. to the catalogue price after it changed.
+
+        Args:
+            prices: {product_id: unit price} for the lines to change
+        """
+        if self.record is None or not prices:
+            return
+        with transaction.atomic():
+            self.lock()
+            items = list(self._record.items.filter(product_id__in=prices))
+            for item in items:
+                item.price = prices[item.product_id]
+            CartItem.objects.bulk_update(items, ['price'])
+            self._record.update_totals()
+        self._items = None
+
+
+
+    def product_ids(self):
+        """Ids of the products in the cart, without loading the products"""
+        if self.record is None:
+            return []
+        return list(self._record.items.values_list('product_id', flat=True))
 
 
 
     def __iter__(self):
-        """Iterate over the items in the cart and get the products from the database."""
-        product_ids = self.cart.keys()
-        # Filter out non-integer product IDs
-        valid_product_ids = []
-        for pid in product_ids:
-            try:
-                valid_product_ids.append(int(pid))
-            except ValueError:
-                print(f"Invalid product ID in cart: {pid}")  # Log invalid IDs
-                continue
-
-        # Get the product objects and add them to the cart
-        products = Product.objects.filter(id__in=valid_product_ids)
-
-        cart = self.cart.copy()
-        for product in products:
-            cart[str(product.id)]['product'] = product
-
-        for item in cart.values():
-            if 'product' in item:  # Only yield items with valid products
-                item['price'] = Decimal(item['price'])
-                item['total_price'] = item['price'] * item['quantity']
-                yield item
+        """Iterate over the items in the cart with their products, loaded in one query per request."""
+        if self._items is None:
+            self._items = []
+            if self.record is not None:
+                for item in self._record.items.select_related('product', 'product__category'):
+                    self._items.append({
+                        'product': item.product,
+                        'quantity': item.quantity,
+                        'price': item.price,
+                        'total_price': item.get_cost(),
+                    })
+        return iter(self._items)
 
     def __len__(self):
         """Count all items in the cart."""
-        return sum(item['quantity'] for item in self.cart.values())
+        return self.record.item_count if self.record is not None else 0
 
     def get_total_price(self):
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        return self.record.total if self.record is not None else Decimal('0')
 
     def clear(self):
-        # Remove cart from session
-        del self.session[settings.CART_SESSION_ID]
-        self.save()
\ No newline at end of file
+        # Remove the cart and its items
+        if self.record is not None:
+            _trace('clear', cart_id=self._record.pk, items=self._record.item_count)
+            self._record.delete()
+        self._record = None
+        self._items = None
+        for key in (settings.CART_SESSION_ID, _count_key()):
+            if key in self.session:
+                del self.session[key]
+        self.save()
+
+
+
+
+def checkout_problems(lines):
+    """
+    Check cart lines against the catalogue with one query.
+
+    The products are locked (SELECT ... FOR UPDATE), so inside the checkout
+    transaction their price and availability stay as checked until the
+    order is written.
+
+    Args:
+        lines: Items from iterating a Cart
+
+    Returns:
+        (names of products no longer available, {product_id: current price}
+        for the lines whose price changed)
+    """
+    current = {
+        product['id']: product
+        for product in Product.objects.select_for_update()
+        .filter(id__in=[line['product'].id for line in lines])
+        .values('id', 'price', 'available')
+    }
+    unavailable = []
+    prices = {}
+    for line in lines:
+        product = current.get(line['product'].id)
+        if product is None or not product['available']:
+            unavailable.append(line['product'].name)
+        elif product['price'] != line['price']:
+            prices[product['id']] = product['price']
+    return unavailable, prices
+
+
+
+def _trace(event, level=logging.DEBUG, **fields):
+    """
+    Count a cart event as ``cart.<event>`` on the metrics endpoint and log it.
+
+    Every event is counted. Events below WARNING are only logged when the
+    shop.cart logger is enabled for their level, and then only a
+    CART_LOG_SAMPLE_RATE fraction of them. The fields go in the message as
+    key=value pairs and on the record as ``cart_event``/``cart_fields``.
+    """
+    increment(f'cart.{event}')
+    if not logger.isEnabledFor(level):
+        return
+    if level < logging.WARNING and random.random() >= getattr(settings, 'CART_LOG_SAMPLE_RATE', 1):
+        return
+    logger.log(
+        level,
+        'cart.%s %s',
+        event,
+        ' '.join(f'{key}={value}' for key, value in fields.items()),
+        extra={'cart_event': event, 'cart_fields': fields},
+    )
+
+
+
+def _count_key():
+    return getattr(settings, 'CART_COUNT_SESSION_ID', 'cart_count')
+
+
+
+def cart_item_count(request):
+    """
+    Number of items in the visitor's cart, without a query in the common case.
+
+    Served from the count Cart keeps in the session; only a session that
+    has not read its cart yet (a new sign-in, or a cart stored before the
+    count was) loads the ShoppingCart row, which stores the count for next
+    time. A change made from another session shows once this one reads the
+    cart again, e.g. on the cart page.
+    """
+    count = request.session.get(_count_key())
+    if count is None:
+        user = getattr(request, 'user', None)
+        if request.session.get(settings.CART_SESSION_ID) is None and not (user is not None and user.is_authenticated):
+            # Anonymous and never added anything
+            return 0
+        count = len(Cart(request))
+    return count
+
+
+
+
+def merge_session_cart(request, user):
+    """
+    Move an anonymous session cart into ``user``'s cart on sign-in.
+
+    Quantities of products in both carts are added together.
+    """
+    # The anonymous count says nothing about the user's cart
+    request.session.pop(_count_key(), None)
+    cart_id = request.session.get(settings.CART_SESSION_ID)
+    if cart_id is None or isinstance(cart_id, dict):
+        # Nothing stored, or a pre-database cart that Cart imports on first use
+        return
+
+    anonymous = ShoppingCart.objects.filter(pk=cart_id, user__isnull=True).first()
+    del request.session[settings.CART_SESSION_ID]
+    if anonymous is None:
+        return
+
+    with transaction.atomic():
+        record, _ = ShoppingCart.objects.get_or_create(user=user)
+        existing = {item.product_id: item for item in record.items.select_for_update()}
+        for item in anonymous.items.all():
+            if item.product_id in existing:
+                CartItem.objects.filter(pk=existing[item.product_id].pk).update(quantity=F('quantity') + item.quantity)
+            else:
+                CartItem.objects.filter(pk=item.pk).update(cart=record)
+        anonymous.delete()
+        record.update_totals()
+    _trace('merge', cart_id=record.pk, merged_cart_id=cart_id, items=record.item_count)
+    request.session[_count_key()] = record.item_count
@@ -0,0 +1,104 @@
+import numpy as np
+from django.db.models import Count, Max
+from sklearn.cluster import KMeans
+
+from .artifacts import load_artifact, save_artifact
+from .models import Product
+
+
+
+CLUSTER_MODEL_ARTIFACT = 'cluster_model'
+
+# Products needed before clustering is meaningful
+MIN_PRODUCTS = 10
+
+
+
+
+class ClusterModel:
+    """
+    Fitted KMeans over available products.
+
+    ``product_ids`` is in catalogue (name) order with ``clusters`` aligned to
+    it, and ``product_clusters`` maps a product id to its cluster for O(1)
+    lookups. ``fingerprint`` identifies the catalogue state it was fitted on.
+    """
+
+    def __init__(self, fingerprint, kmeans, product_ids, clusters):
+        self.fingerprint = fingerprint
+        self.kmeans = kmeans
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.clusters = np.asarray(clusters)
+        self.product_clusters = dict(zip(self.product_ids.tolist(), self.clusters.tolist()))
+
+
+
+    @classmethod
+    def build(cls, fingerprint):
+        rows = list(
+            Product.objects.filter(available=True)
+            .order_by('name')
+            .values_list('id', 'price', 'category_id', 'flavor_profile', 'occasion')
+        )
+        if len(rows) < MIN_PRODUCTS:
+            return cls(fingerprint, None, [row[0] for row in rows], np.zeros(len(rows), dtype=np.int64))
+
+        features = product_features(rows)
+        n_clusters = min(5, len(rows) // 2)                    # Adjust number of clusters based on data size
+        kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+        clusters = kmeans.fit_predict(features)
+        return cls(fingerprint, kmeans, [row[0] for row in rows], clusters)
+
+
+
+    def __len__(self):
+        return len(self.product_ids)
+
+
+
+
+def product_features(rows):
+    """
+    Feature matrix for (id, price, category_id, flavor_profile, occasion) rows.
+
+    Price is log-scaled and standardised; category, flavor profile and
+    occasion are one-hot encoded.
+    """
+    prices = np.log1p(np.array([float(row[1]) for row in rows]))
+    price_std = prices.std()
+    columns = [((prices - prices.mean()) / price_std if price_std else np.zeros(len(rows)))[:, None]]
+
+    for position in (2, 3, 4):
+        values = [str(row[position]).strip().lower() for row in rows]
+        categories = sorted(set(values))
+        index = {value: i for i, value in enumerate(categories)}
+        one_hot = np.zeros((len(rows), len(categories)))
+        one_hot[np.arange(len(rows)), [index[value] for value in values]] = 1
+        columns.append(one_hot)
+
+    return np.hstack(columns)
+
+
+
+def catalogue_fingerprint():
+    """Changes whenever an available product is added, removed or edited (e.g. repriced)"""
+    stats = Product.objects.filter(available=True).aggregate(count=Count('id'), updated=Max('updated'))
+    return (stats['count'], stats['updated'])
+
+
+
+def get_cluster_model():
+    """Return the cached ClusterModel, refitting it if the catalogue changed"""
+    fingerprint = catalogue_fingerprint()
+    model = load_artifact(CLUSTER_MODEL_ARTIFACT)
+    if model is None or model.fingerprint != fingerprint:
+        model = rebuild_cluster_model(fingerprint)
+    return model
+
+
+
+def rebuild_cluster_model(fingerprint=None):
+    """Refit and save the ClusterModel"""
+    model = ClusterModel.build(fingerprint if fingerprint is not None else catalogue_fingerprint())
+    save_artifact(CLUSTER_MODEL_ARTIFACT, model)
+    return model
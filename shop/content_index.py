@@ -0,0 +1,214 @@
+import re
+
+import numpy as np
+from django.db import transaction
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from .ann import build_ann_index
+from .artifacts import artifact_dir, load_artifact, save_artifact
+from .models import Product, PrecomputedRecommendation
+from .ranking import top_k
+
+
+
+CONTENT_INDEX_ARTIFACT = 'content_index'
+
+# File in the artefact directory present while the catalogue has changed
+# since the index was built. A plain marker rather than an artefact, so a
+# product save doesn't publish a new manifest
+CONTENT_STALE_MARKER = 'content_index.stale'
+
+# Similar products kept per product
+TOP_K = 10
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+
+
+def product_tokens(ingredients, flavor_profile, occasion, category_name):
+    """Tokenise the text fields used for content similarity"""
+    text = f"{ingredients} {flavor_profile} {occasion} {category_name}".lower()
+    return TOKEN_RE.findall(text)
+
+
+
+def _pretokenised(tokens):
+    # Documents are already token lists; a named function keeps the vectorizer picklable
+    return tokens
+
+
+
+
+class ContentIndex:
+    """
+    TF-IDF index over available products.
+
+    ``matrix`` holds one L2-normalised TF-IDF row per product (so a dot product
+    is the cosine similarity) and ``neighbours`` maps each product id to its
+    TOP_K most similar product ids. Large catalogues rank against candidates
+    from an LSH index (``ann``) instead of every product.
+    """
+
+    def __init__(self, product_ids, category_ids, vectorizer, matrix, neighbours):
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.category_ids = np.asarray(category_ids, dtype=np.int64)
+        self.product_index = {int(pid): row for row, pid in enumerate(self.product_ids)}
+        self.vectorizer = vectorizer
+        self.matrix = matrix
+        self.neighbours = neighbours
+        self.ann = build_ann_index(matrix) if matrix is not None else None
+
+
+
+    @classmethod
+    def build(cls, top_k=TOP_K):
+        """Build the index from every available product in one query"""
+        rows = list(
+            Product.objects.filter(available=True)
+            .order_by('name')
+            .values_list('id', 'category_id', 'ingredients', 'flavor_profile', 'occasion', 'category__name')
+        )
+        product_ids = [row[0] for row in rows]
+        category_ids = [row[1] for row in rows]
+        documents = [product_tokens(*row[2:]) for row in rows]
+
+        vectorizer = TfidfVectorizer(analyzer=_pretokenised)
+        if any(documents):
+            matrix = vectorizer.fit_transform(documents).tocsr()
+        else:
+            vectorizer = None
+            matrix = None
+
+        index = cls(product_ids, category_ids, vectorizer, matrix, {})
+        index.neighbours = {pid: index._rank(row, top_k) for pid, row in index.product_index.items()}
+        return index
+
+
+
+    def similar(self, product, limit=TOP_K):
+        """
+        Ids of the products most similar to ``product``, best first.
+
+        Products outside the index (e.g. unavailable ones) are vectorised on the fly.
+        """
+        if product.id in self.neighbours and limit <= len(self.neighbours[product.id]):
+            return self.neighbours[product.id][:limit]
+
+        vector = None
+        if product.id not in self.product_index and self.vectorizer is not None:
+            vector = self.vectorizer.transform([
+                product_tokens(product.ingredients, product.flavor_profile, product.occasion, product.category.name)
+            ])
+        return self._rank(self.product_index.get(product.id), limit, vector=vector)
+
+
+
+    def vectors(self, product_ids):
+        """TF-IDF rows for the given products, with empty rows for products outside the index"""
+        rows = [self.product_index.get(product_id) for product_id in product_ids]
+        if self.matrix is None:
+            return sparse.csr_matrix((len(rows), 1))
+
+        known = [(position, row) for position, row in enumerate(rows) if row is not None]
+        selector = sparse.csr_matrix(
+            (np.ones(len(known)), ([position for position, _ in known], [row for _, row in known])),
+            shape=(len(rows), len(self.product_ids)),
+        )
+        return (selector @ self.matrix).tocsr()
+
+
+
+    def _rank(self, row, limit, vector=None):
+        if vector is None and self.matrix is not None and row is not None:
+            vector = self.matrix.getrow(row)
+
+        similarities = np.zeros(len(self.product_ids))
+        if vector is not None:
+            # Rows are L2-normalised, so a dot product is the cosine similarity
+            rows = self.ann.candidates(vector) if self.ann is not None else slice(None)
+            similarities[rows] = np.asarray((self.matrix[rows] @ vector.T).todense()).ravel()
+        if row is not None:
+            similarities[row] = -np.inf
+
+        # Ties keep catalogue (name) order between equally similar products
+        return self.product_ids[top_k(similarities, limit)].tolist()
+
+
+
+    def save(self):
+        save_artifact(CONTENT_INDEX_ARTIFACT, self)
+
+
+
+
+def get_content_index():
+    """
+    Load the content index, or None while it has never been built.
+
+    Never builds it: fitting TF-IDF and rewriting the stored top-K table is
+    left to ``manage.py rebuild_content_index`` (and build_recommendations
+    and train_recommenders), not to the request that finds it missing.
+    """
+    return load_artifact(CONTENT_INDEX_ARTIFACT)
+
+
+
+def rebuild_content_index():
+    """
+    Rebuild the index and refresh the stored top-K table.
+
+    Run by ``manage.py rebuild_content_index`` (e.g. from cron with
+    ``--if-stale``), ``build_recommendations`` and ``train_recommenders``.
+    """
+    # Cleared first, so a product saved during the build marks the new index stale again
+    (artifact_dir() / CONTENT_STALE_MARKER).unlink(missing_ok=True)
+    index = ContentIndex.build()
+    index.save()
+
+    rows = [
+        PrecomputedRecommendation(method='content', source_product_id=source_id, product_id=product_id, rank=rank)
+        for source_id, product_ids in index.neighbours.items()
+        for rank, product_id in enumerate(product_ids)
+    ]
+    with transaction.atomic():
+        PrecomputedRecommendation.objects.filter(method='content').delete()
+        PrecomputedRecommendation.objects.bulk_create(rows, batch_size=1000)
+
+    return index
+
+
+
+def mark_content_index_stale():
+    """Note that the catalogue changed; called by the product and category signals instead of rebuilding"""
+    (artifact_dir() / CONTENT_STALE_MARKER).touch()
+
+
+
+def content_index_stale():
+    """Whether the catalogue changed since the index was built, or it never was"""
+    return (artifact_dir() / CONTENT_STALE_MARKER).exists() or get_content_index() is None
+
+
+
+def similar_without_index(product, limit):
+    """
+    Ids of the products sharing the most tokens with ``product`` (Jaccard similarity), best first.
+
+    The original scan over every available product, in one query and
+    without writing anything, for while the index has not been built.
+    """
+    target = set(product_tokens(product.ingredients, product.flavor_profile, product.occasion, product.category.name))
+    rows = list(
+        Product.objects.filter(available=True)
+        .exclude(id=product.id)
+        .order_by('name')
+        .values_list('id', 'ingredients', 'flavor_profile', 'occasion', 'category__name')
+    )
+    similarities = np.zeros(len(rows))
+    for position, row in enumerate(rows):
+        tokens = set(product_tokens(*row[1:]))
+        if target and tokens:
+            similarities[position] = len(target & tokens) / len(target | tokens)
+    return [rows[position][0] for position in top_k(similarities, limit).tolist()]
@@ -1,6 +1,11 @@
-from .cart import Cart
+from django.utils.functional import SimpleLazyObject
+
+from .cart import Cart, cart_item_count
 
 def cart(request):
-    cart = Cart(request)
-    total_items = sum(item['quantity'] for item in cart)
-    return {'cart': cart, 'total_items': total_items}   
\ No newline at end of file
+    # Nothing is read until a template uses these, and then once per request;
+    # total_items comes from the count kept in the session (see cart_item_count)
+    return {
+        'cart': SimpleLazyObject(lambda: Cart(request)),
+        'total_items': SimpleLazyObject(lambda: cart_item_count(request)),
+    }
@@ -0,0 +1,170 @@
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from scipy import sparse
+
+from .instrumentation import timed
+from .models import OrderItem, PrecomputedRecommendation, Product, UserProductInteraction
+from .scoring import epoch_seconds
+
+
+
+TOGETHER_METHOD = 'together'
+
+
+
+
+def together_params():
+    """Settings for the co-occurrence model"""
+    return {
+        'top_k': getattr(settings, 'RECOMMENDER_TOGETHER_TOP_K', 10),
+        'session_gap_minutes': getattr(settings, 'RECOMMENDER_SESSION_GAP_MINUTES', 30),
+        'session_weight': getattr(settings, 'RECOMMENDER_SESSION_WEIGHT', 0.5),
+    }
+
+
+
+def basket_matrix(session_gap_minutes, session_weight):
+    """
+    Weighted baskets x products matrix of what appeared together.
+
+    Every non-cancelled order is a basket of weight 1. Each user's raw
+    interactions are split into sessions wherever consecutive events are
+    more than ``session_gap_minutes`` apart, and each session is a basket
+    of weight ``session_weight``. A product counts once per basket.
+
+    Sessions need event times, so they come from the raw
+    UserProductInteraction rows rather than the rollups; events removed by
+    ``compact_interactions --older-than`` (views by default) no longer
+    count towards them.
+
+    Returns:
+        (product_ids labelling the columns, CSR matrix)
+    """
+    orders = list(
+        OrderItem.objects.exclude(order__status='cancelled').order_by().values_list('order_id', 'product_id')
+    )
+    events = list(UserProductInteraction.objects.order_by('user_id', 'timestamp').values_list('user_id', 'product_id', 'timestamp'))
+
+    order_ids = np.fromiter((row[0] for row in orders), dtype=np.int64, count=len(orders))
+    _, order_baskets = np.unique(order_ids, return_inverse=True)
+    n_orders = int(order_baskets.max()) + 1 if len(orders) else 0
+
+    # A new session starts at each user's first event and after every long gap
+    users = np.fromiter((row[0] for row in events), dtype=np.int64, count=len(events))
+    seconds = epoch_seconds(row[2] for row in events)
+    starts = np.ones(len(events), dtype=bool)
+    starts[1:] = (users[1:] != users[:-1]) | (np.diff(seconds) > session_gap_minutes * 60)
+    session_baskets = np.cumsum(starts) - 1 + n_orders
+
+    product_ids, columns = np.unique(
+        np.concatenate([
+            np.fromiter((row[1] for row in orders), dtype=np.int64, count=len(orders)),
+            np.fromiter((row[1] for row in events), dtype=np.int64, count=len(events)),
+        ]),
+        return_inverse=True,
+    )
+    rows = np.concatenate([order_baskets.ravel(), session_baskets]).astype(np.int64)
+    n_baskets = int(rows.max()) + 1 if len(rows) else 0
+
+    baskets = sparse.coo_matrix(
+        (np.ones(len(rows)), (rows, columns.ravel())),
+        shape=(n_baskets, len(product_ids)),
+    ).tocsr()
+    baskets.sum_duplicates()
+    baskets.data[:] = 1  # Presence, not quantity
+
+    weights = np.full(n_baskets, session_weight)
+    weights[:n_orders] = 1
+    return product_ids, (sparse.diags(weights) @ baskets).tocsr()
+
+
+
+def rebuild_together(top_k=None, session_gap_minutes=None, session_weight=None):
+    """
+    Store each product's top co-occurring products as PrecomputedRecommendation rows.
+
+    Co-occurrence is the weighted number of baskets two products share;
+    only available products are recommended. Rows are swapped in one
+    transaction so readers never see a partial table.
+
+    The browsing sessions only cover raw interactions still in the table
+    (see ``basket_matrix``): after ``compact_interactions`` prunes old
+    views, a rebuild keeps their orders and later events but loses the
+    pruned browsing, so keep the prune cutoff at least as long as the
+    history the "browsed together" signal should reflect.
+
+    Returns:
+        Number of source products with rows
+    """
+    params = together_params()
+    top_k = top_k or params['top_k']
+    product_ids, baskets = basket_matrix(
+        session_gap_minutes if session_gap_minutes is not None else params['session_gap_minutes'],
+        session_weight if session_weight is not None else params['session_weight'],
+    )
+
+    cooccurrence = (baskets.T @ (baskets > 0).astype(np.float64)).tocsr()
+    cooccurrence.setdiag(0)
+    available = np.isin(product_ids, list(Product.objects.filter(available=True).values_list('id', flat=True)))
+    cooccurrence = (cooccurrence @ sparse.diags(available.astype(np.float64))).tocsr()
+    cooccurrence.eliminate_zeros()
+
+    rows = []
+    sources = 0
+    for row in range(cooccurrence.shape[0]):
+        start, end = cooccurrence.indptr[row], cooccurrence.indptr[row + 1]
+        if start == end:
+            continue
+        columns = cooccurrence.indices[start:end]
+        # Strongest first; ties in product id order so rebuilds are stable
+        order = np.lexsort((product_ids[columns], -cooccurrence.data[start:end]))[:top_k]
+        sources += 1
+        rows.extend(
+            PrecomputedRecommendation(
+                method=TOGETHER_METHOD,
+                source_product_id=int(product_ids[row]),
+                product_id=int(product_ids[columns[position]]),
+                rank=rank,
+            )
+            for rank, position in enumerate(order.tolist())
+        )
+
+    with transaction.atomic():
+        PrecomputedRecommendation.objects.filter(method=TOGETHER_METHOD).delete()
+        PrecomputedRecommendation.objects.bulk_create(rows, batch_size=1000)
+    return sources
+
+
+
+def frequently_bought_together(product_ids, limit=4):
+    """
+    Products most often bought or browsed together with the given ones.
+
+    One indexed query over the rows written by ``rebuild_together``. With
+    several source products (a cart), their lists are merged best rank first.
+
+    Args:
+        product_ids: Ids of the product(s) on the page
+        limit: Number of products to return
+
+    Returns:
+        List of available Product objects not among ``product_ids``
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return []
+
+    with timed(f'recommendations.{TOGETHER_METHOD}'):
+        rows = (
+            PrecomputedRecommendation.objects
+            .filter(method=TOGETHER_METHOD, source_product_id__in=product_ids, product__available=True)
+            .exclude(product_id__in=product_ids)
+            .select_related('product')
+            .order_by('rank', 'source_product_id')[:limit * len(product_ids)]
+        )
+        products = []
+        for row in rows:
+            if row.product not in products:
+                products.append(row.product)
+        return products[:limit]
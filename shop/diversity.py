@@ -0,0 +1,114 @@
+import math
+
+import numpy as np
+from scipy import sparse
+
+# Diversity re-rankers over ranked candidate lists. Each takes the
+# candidates' category ids or feature vectors, best candidate first, and
+# returns the positions to keep in their new order. Only depends on
+# numpy/scipy so bulk worker processes can import it without configuring Django.
+
+
+
+# Strategies accepted by get_recommendations(diversity=...)
+DIVERSITY_STRATEGIES = ('category', 'mmr')
+
+
+
+
+def category_codes(category_ids):
+    """Small integer code per candidate, numbering categories in order of first appearance"""
+    codes = {}
+    return np.fromiter((codes.setdefault(category_id, len(codes)) for category_id in category_ids), dtype=np.int64, count=len(category_ids))
+
+
+
+def category_occurrence(codes):
+    """How many earlier candidates share each candidate's category"""
+    codes = np.asarray(codes, dtype=np.int64)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, len(codes)]))
+
+    occurrence = np.empty(len(codes), dtype=np.int64)
+    occurrence[order] = np.arange(len(codes)) - group_start
+    return occurrence
+
+
+
+def category_round_robin(category_ids, limit):
+    """
+    Positions taking turns across categories.
+
+    Categories take turns in the order they first appear, and each yields
+    its candidates in their original order.
+    """
+    codes = category_codes(category_ids)
+    return np.lexsort((codes, category_occurrence(codes)))[:limit]
+
+
+
+def category_quota(category_ids, limit, max_per_category=None):
+    """
+    Positions in rank order, skipping candidates whose category is full.
+
+    Args:
+        category_ids: Category of each candidate, best candidate first
+        limit: Number of positions to return
+        max_per_category: Candidates allowed per category; defaults to an
+            even share of ``limit`` across the categories present
+
+    Returns:
+        Positions within quota in rank order, then the skipped ones in rank
+        order if there are too few
+    """
+    codes = category_codes(category_ids)
+    if not len(codes):
+        return np.empty(0, dtype=np.int64)
+    if max_per_category is None:
+        max_per_category = math.ceil(limit / (codes.max() + 1))
+
+    within = category_occurrence(codes) < max_per_category
+    return np.concatenate([np.flatnonzero(within), np.flatnonzero(~within)])[:limit]
+
+
+
+def mmr(relevance, features, limit, trade_off=0.7):
+    """
+    Maximal marginal relevance (Carbonell & Goldstein, 1998).
+
+    Greedily picks the candidate maximising
+    ``trade_off * relevance - (1 - trade_off) * max similarity to those picked``,
+    ties going to the better ranked candidate.
+
+    Args:
+        relevance: Relevance of each candidate
+        features: One L2-normalised row per candidate (dense or sparse), so
+            dot products are cosine similarities
+        limit: Number of positions to return
+        trade_off: 1 keeps the original ranking, 0 only rewards novelty
+
+    Returns:
+        Positions in pick order
+    """
+    relevance = np.asarray(relevance, dtype=np.float64)
+    limit = min(limit, len(relevance))
+    similarity = features @ features.T
+    similarity = similarity.toarray() if sparse.issparse(similarity) else np.asarray(similarity)
+
+    picked = np.empty(limit, dtype=np.int64)
+    max_similarity = np.zeros(len(relevance))
+    gain = trade_off * relevance
+    for i in range(limit):
+        best = int(np.argmax(gain - (1 - trade_off) * max_similarity))
+        picked[i] = best
+        gain[best] = -np.inf
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return picked
+
+
+
+def rank_relevance(count):
+    """Relevance for a ranked list without scores: 1 for the first candidate, falling linearly"""
+    return 1 - np.arange(count) / max(count, 1)
@@ -0,0 +1,225 @@
+import cProfile
+import functools
+import io
+import pstats
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Upper bounds of the size histogram buckets (query counts, candidate set sizes)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000)
+
+# Profiles kept for the metrics endpoint
+MAX_PROFILES = 20
+
+# Functions listed per profile
+PROFILE_TOP_FUNCTIONS = 25
+
+# Only one cProfile profiler can be active per thread
+_profiling = threading.local()
+
+
+
+
+class Histogram:
+    """Bucketed distribution with count, sum, min and max"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is the overflow bucket
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+
+
+    def as_dict(self):
+        labels = [f'le_{bound}' for bound in self.buckets] + ['inf']
+        return {
+            'count': self.count,
+            'sum': round(self.total, 3),
+            'mean': round(self.total / self.count, 3) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process metrics.
+
+    Each worker process keeps its own registry, so the endpoint reports the
+    process that served it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.timings = {}
+            self.sizes = {}
+            self.profiles = deque(maxlen=MAX_PROFILES)
+            self.started = time.time()
+
+
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+
+
+    def observe_ms(self, name, milliseconds):
+        with self._lock:
+            self.timings.setdefault(name, Histogram(LATENCY_BUCKETS_MS)).observe(milliseconds)
+
+
+
+    def observe_size(self, name, size):
+        with self._lock:
+            self.sizes.setdefault(name, Histogram(SIZE_BUCKETS)).observe(size)
+
+
+
+    def add_profile(self, name, report):
+        with self._lock:
+            self.profiles.append({'name': name, 'at': time.time(), 'report': report})
+
+
+
+    def as_dict(self, include_profiles=False):
+        with self._lock:
+            data = {
+                'since': self.started,
+                'counters': dict(self.counters),
+                'timings_ms': {name: histogram.as_dict() for name, histogram in self.timings.items()},
+                'sizes': {name: histogram.as_dict() for name, histogram in self.sizes.items()},
+            }
+            if include_profiles:
+                data['profiles'] = list(self.profiles)
+            return data
+
+
+
+
+metrics = MetricsRegistry()
+
+
+
+
+def increment(name, value=1):
+    """Add to a counter, e.g. ``increment('precomputed.hit')``"""
+    metrics.increment(name, value)
+
+
+
+def observe_size(name, size):
+    """Record a size such as the number of candidate products"""
+    metrics.observe_size(name, size)
+
+
+
+def record_cache(name, hit):
+    """Count a hit or miss for the cache called ``name``"""
+    metrics.increment(f'{name}.{"hit" if hit else "miss"}')
+
+
+
+@contextmanager
+def counting_queries():
+    """
+    Count the database queries run inside the block.
+
+    Uses a connection execute wrapper, so it works without DEBUG. Yields a
+    one-item list holding the running count.
+    """
+    queries = [0]
+
+    def count_query(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_query):
+        yield queries
+
+
+
+@contextmanager
+def timed(name):
+    """
+    Record the wall time and number of database queries of a block.
+
+    Adds to the ``name`` latency histogram and the ``name.queries`` size
+    histogram.
+    """
+    started = time.perf_counter()
+    with counting_queries() as queries:
+        try:
+            yield
+        finally:
+            metrics.observe_ms(name, (time.perf_counter() - started) * 1000)
+            metrics.observe_size(f'{name}.queries', queries[0])
+
+
+
+def instrumented(name):
+    """
+    Decorator recording a function's latency and query count under ``name``.
+
+    A RECOMMENDER_PROFILE_SAMPLE_RATE fraction of calls (default 0) also run
+    under cProfile; the top functions by cumulative time are kept for the
+    metrics endpoint. Calls nested in a profiled call are not sampled again.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            sample_rate = getattr(settings, 'RECOMMENDER_PROFILE_SAMPLE_RATE', 0)
+            with timed(name):
+                if not sample_rate or getattr(_profiling, 'active', False) or random.random() >= sample_rate:
+                    return func(*args, **kwargs)
+                return _profiled(name, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+
+def _profiled(name, func, args, kwargs):
+    profiler = cProfile.Profile()
+    _profiling.active = True
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        _profiling.active = False
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        metrics.add_profile(name, report.getvalue())
+        metrics.increment(f'{name}.profiled')
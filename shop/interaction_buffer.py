@@ -0,0 +1,201 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+
+from .instrumentation import increment
+from .models import UserProductInteraction
+from .popularity import record_interactions
+from .rollup import record_rollups
+
+
+
+logger = logging.getLogger(__name__)
+
+_queue = None
+_worker = None
+_worker_pid = None
+_start_lock = threading.Lock()
+_batch_ready = threading.Event()
+_flush_lock = threading.Lock()
+
+
+
+
+def log_interaction(user, product, interaction_type, rating=None):
+    """
+    Record a user/product interaction without writing it in the request.
+
+    Events are queued in memory and inserted in batches by a background thread
+    (see RECOMMENDER_INTERACTION_* settings). Set
+    RECOMMENDER_ASYNC_INTERACTIONS = False to write each one immediately.
+    The event time is taken now, not when the row is flushed.
+    """
+    interaction = UserProductInteraction(
+        user_id=user.id,
+        product_id=product.id,
+        interaction_type=interaction_type,
+        rating=rating,
+        timestamp=timezone.now(),
+    )
+
+    if not getattr(settings, 'RECOMMENDER_ASYNC_INTERACTIONS', True):
+        _save(interaction)
+        return
+
+    try:
+        events = _ensure_worker()
+        events.put_nowait(interaction)
+        increment('interactions.queued')
+        if events.qsize() >= getattr(settings, 'RECOMMENDER_INTERACTION_BATCH_SIZE', 500):
+            _batch_ready.set()
+    except queue.Full:
+        # Back-pressure: write this one inline rather than drop it
+        increment('interactions.queue_full')
+        _save(interaction)
+
+
+
+def log_interactions(user, products, interaction_type):
+    """
+    ``log_interaction`` for several products at once, e.g. every line of an order.
+
+    With RECOMMENDER_ASYNC_INTERACTIONS off, or whatever doesn't fit in the
+    queue, the rows are written with one bulk insert instead of one each.
+    """
+    now = timezone.now()
+    interactions = [
+        UserProductInteraction(user_id=user.id, product_id=product.id, interaction_type=interaction_type, timestamp=now)
+        for product in products
+    ]
+    if not interactions:
+        return
+
+    if not getattr(settings, 'RECOMMENDER_ASYNC_INTERACTIONS', True):
+        _insert(interactions)
+        return
+
+    events = _ensure_worker()
+    for queued, interaction in enumerate(interactions):
+        try:
+            events.put_nowait(interaction)
+        except queue.Full:
+            increment('interactions.queue_full', len(interactions) - queued)
+            _insert(interactions[queued:])
+            break
+        increment('interactions.queued')
+    if events.qsize() >= getattr(settings, 'RECOMMENDER_INTERACTION_BATCH_SIZE', 500):
+        _batch_ready.set()
+
+
+
+def flush_interactions():
+    """
+    Insert every queued interaction now.
+
+    Called by the background thread, at interpreter exit, and by anything
+    that needs the table to be up to date (e.g. before a rebuild).
+
+    Returns:
+        Number of rows written
+    """
+    if _queue is None:
+        return 0
+
+    batch_size = getattr(settings, 'RECOMMENDER_INTERACTION_BATCH_SIZE', 500)
+    written = 0
+    with _flush_lock:
+        while True:
+            batch = []
+            while len(batch) < batch_size:
+                try:
+                    batch.append(_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return written
+            written += _write(batch)
+
+
+
+
+def _write(batch):
+    close_old_connections()
+    try:
+        created = _insert(batch)
+    except DatabaseError:
+        # A bad row (e.g. a product deleted meanwhile) shouldn't lose the rest
+        logger.exception('Bulk insert of %d interactions failed, retrying one by one', len(batch))
+        saved = 0
+        for interaction in batch:
+            interaction.pk = None  # Set if the insert succeeded before the rollback
+            try:
+                _save(interaction)
+                saved += 1
+            except DatabaseError:
+                logger.exception('Dropping interaction %s/%s', interaction.user_id, interaction.product_id)
+                increment('interactions.dropped')
+        increment('interactions.flushed', saved)
+        return saved
+
+    increment('interactions.flushed', len(created))
+    return len(created)
+
+
+
+def _insert(interactions):
+    # bulk_create sends no post_save signals, so update the derived tables
+    # here, in the same transaction so a failure leaves none of them changed
+    with transaction.atomic():
+        created = UserProductInteraction.objects.bulk_create(interactions)
+        record_interactions(created)
+        record_rollups(created)
+    return created
+
+
+
+def _save(interaction):
+    # post_save updates popularity and the rollups; in the same transaction, so
+    # no reader sees the raw row without them (see similarity.consistent_snapshot)
+    with transaction.atomic():
+        interaction.save()
+
+
+
+def _ensure_worker():
+    """Start the flush thread on first use in each process (it doesn't survive a fork)"""
+    global _queue, _worker, _worker_pid
+    if _worker_pid == os.getpid() and _worker is not None and _worker.is_alive():
+        return _queue
+
+    with _start_lock:
+        if _worker_pid != os.getpid() or _worker is None or not _worker.is_alive():
+            if _worker_pid != os.getpid():
+                _queue = queue.Queue(maxsize=getattr(settings, 'RECOMMENDER_INTERACTION_QUEUE_SIZE', 10000))
+            _worker = threading.Thread(target=_run_worker, name='interaction-buffer', daemon=True)
+            _worker_pid = os.getpid()
+            _worker.start()
+    return _queue
+
+
+
+def _run_worker():
+    interval = getattr(settings, 'RECOMMENDER_INTERACTION_FLUSH_SECONDS', 2)
+    while True:
+        try:
+            # Flush every interval, or as soon as a full batch is waiting
+            _batch_ready.wait(interval)
+            _batch_ready.clear()
+            flush_interactions()
+        except Exception:
+            logger.exception('Interaction buffer flush failed')
+
+
+
+# Daemon threads are killed at exit, so drain the queue from the main thread
+atexit.register(flush_interactions)
@@ -0,0 +1,308 @@
+import numpy as np
+from scipy import sparse
+
+from .ann import cosine_to
+from .models import UserProductInteraction
+from .ranking import top_k
+from .scoring import TYPE_CODES, epoch_seconds, score_arrays
+
+
+
+
+class InteractionMatrix:
+    """
+    Sparse user x product matrix of weighted interaction scores.
+
+    Rows are users and columns are products, both kept in the order they were
+    first seen in the interaction data. ``user_index`` / ``product_index`` map
+    database ids to row / column positions and ``user_ids`` / ``product_ids``
+    map them back.
+    """
+
+    def __init__(self, user_ids, product_ids, matrix, product_counts=None):
+        self.user_ids = np.asarray(user_ids, dtype=np.int64)
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.matrix = matrix.tocsr()
+        # Raw number of interaction rows per product column
+        if product_counts is None:
+            product_counts = np.zeros(len(self.product_ids), dtype=np.int64)
+        self.product_counts = np.asarray(product_counts, dtype=np.int64)
+        self.user_index = {int(uid): row for row, uid in enumerate(self.user_ids)}
+        self.product_index = {int(pid): col for col, pid in enumerate(self.product_ids)}
+        self._binary = None
+
+
+
+    @classmethod
+    def build(cls, interactions=None, exclude_product_ids=None):
+        """
+        Build the matrix from UserProductInteraction rows.
+
+        Args:
+            interactions: Optional UserProductInteraction queryset (defaults to all rows)
+            exclude_product_ids: Product ids to leave out of the matrix
+
+        Returns:
+            InteractionMatrix
+        """
+        if interactions is None:
+            interactions = UserProductInteraction.objects.all()
+
+        rows = list(interactions.values_list('user_id', 'product_id', 'interaction_type', 'rating', 'timestamp'))
+
+        if exclude_product_ids:
+            rows = [row for row in rows if row[1] not in exclude_product_ids]
+
+        user_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        product_ids = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+        scores = score_arrays(
+            np.fromiter((TYPE_CODES[row[2]] for row in rows), dtype=np.int8, count=len(rows)),
+            np.fromiter(((row[3] or 1) if row[2] == 'rating' else 1 for row in rows), dtype=np.float64, count=len(rows)),
+            epoch_seconds(row[4] for row in rows),
+        )
+        return cls.from_arrays(user_ids, product_ids, scores)
+
+
+
+    @classmethod
+    def from_arrays(cls, user_ids, product_ids, scores, counts=None):
+        """
+        Build the matrix from parallel arrays of user ids, product ids and scores.
+
+        ``counts`` gives the number of interaction rows each entry stands for
+        (e.g. InteractionRollup rows); by default every entry is one row.
+        """
+        unique_users, user_first, user_rows = np.unique(user_ids, return_index=True, return_inverse=True)
+        unique_products, product_first, product_cols = np.unique(product_ids, return_index=True, return_inverse=True)
+
+        # Re-number rows and columns by first appearance so ties rank like the
+        # original dict-based implementation did
+        user_order = np.argsort(user_first, kind='stable')
+        product_order = np.argsort(product_first, kind='stable')
+        user_rank = np.empty_like(user_order)
+        user_rank[user_order] = np.arange(len(user_order))
+        product_rank = np.empty_like(product_order)
+        product_rank[product_order] = np.arange(len(product_order))
+
+        cols = product_rank[product_cols]
+        matrix = sparse.coo_matrix(
+            (scores, (user_rank[user_rows], cols)),
+            shape=(len(unique_users), len(unique_products)),
+        ).tocsr()
+        matrix.sum_duplicates()
+        product_counts = np.bincount(cols, weights=counts, minlength=len(unique_products)).astype(np.int64)
+        return cls(unique_users[user_order], unique_products[product_order], matrix, product_counts)
+
+
+
+    def add(self, user_ids, product_ids, scores):
+        """
+        Add interaction scores in place, growing the matrix for unseen users and products.
+
+        Returns:
+            Set of user ids whose rows changed
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+
+        new_users = [uid for uid in dict.fromkeys(user_ids.tolist()) if uid not in self.user_index]
+        new_products = [pid for pid in dict.fromkeys(product_ids.tolist()) if pid not in self.product_index]
+        for uid in new_users:
+            self.user_index[uid] = len(self.user_index)
+        for pid in new_products:
+            self.product_index[pid] = len(self.product_index)
+        if new_users:
+            self.user_ids = np.concatenate([self.user_ids, np.array(new_users, dtype=np.int64)])
+        if new_products:
+            self.product_ids = np.concatenate([self.product_ids, np.array(new_products, dtype=np.int64)])
+            self.product_counts = np.concatenate([self.product_counts, np.zeros(len(new_products), dtype=np.int64)])
+
+        shape = (len(self.user_ids), len(self.product_ids))
+        rows = np.fromiter((self.user_index[uid] for uid in user_ids.tolist()), dtype=np.int64, count=len(user_ids))
+        cols = np.fromiter((self.product_index[pid] for pid in product_ids.tolist()), dtype=np.int64, count=len(product_ids))
+
+        self.matrix.resize(shape)
+        delta = sparse.coo_matrix((np.asarray(scores, dtype=np.float64), (rows, cols)), shape=shape).tocsr()
+        self.matrix = (self.matrix + delta).tocsr()
+        self.product_counts += np.bincount(cols, minlength=shape[1])
+        self._binary = None
+
+        return set(user_ids.tolist())
+
+
+
+    def __contains__(self, user_id):
+        return user_id in self.user_index
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def binary(self):
+        """Matrix of 0/1 flags marking which products each user interacted with"""
+        if self._binary is None:
+            binary = self.matrix.copy()
+            binary.data = np.ones_like(binary.data)
+            self._binary = binary
+        return self._binary
+
+
+
+    def user_items(self, user_id):
+        """Return {product_id: score} for a single user"""
+        row = self.matrix.getrow(self.user_index[user_id])
+        return dict(zip(self.product_ids[row.indices].tolist(), row.data.tolist()))
+
+
+
+    def jaccard_similarities(self, user_id, rows=None):
+        """
+        Jaccard similarity between ``user_id`` and every user in the matrix.
+
+        Computed as one sparse matrix-vector product over the binary matrix:
+        |A & B| = B . a and |A | B| = |A| + |B| - |A & B|.
+
+        Args:
+            user_id: Target user id
+            rows: Optional candidate rows (e.g. from an ANN index); other rows get 0
+
+        Returns:
+            numpy array indexed by matrix row
+        """
+        binary = self.binary
+        target_row = self.user_index[user_id]
+        target = binary.getrow(target_row)
+        row_sizes = np.diff(binary.indptr)
+        if rows is None:
+            rows = slice(None)
+
+        intersection = np.asarray((binary[rows] @ target.T).todense()).ravel()
+        union = row_sizes[rows] + row_sizes[target_row] - intersection
+
+        similarities = np.zeros(binary.shape[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarities[rows] = np.where(union > 0, intersection / union, 0.0)
+        return similarities
+
+
+
+    def cosine_similarities(self, user_id, matrix=None, rows=None):
+        """
+        Cosine similarity between ``user_id`` and every user.
+
+        Args:
+            user_id: Target user id
+            matrix: Optional matrix with the same layout to use instead of the raw scores
+                (e.g. a normalised copy)
+            rows: Optional candidate rows (e.g. from an ANN index); other rows get 0
+
+        Returns:
+            numpy array indexed by matrix row
+        """
+        if matrix is None:
+            matrix = self.matrix
+        if rows is None:
+            rows = slice(None)
+
+        similarities = np.zeros(matrix.shape[0])
+        similarities[rows] = cosine_to(matrix[rows], matrix.getrow(self.user_index[user_id]))
+        return similarities
+
+
+
+    def nearest_neighbours(self, user_id, similarities, n_neighbours=10, include_zero=True):
+        """
+        Pick the most similar users to ``user_id``.
+
+        Ties keep matrix row order, i.e. the order users were first seen.
+
+        Args:
+            user_id: Target user id
+            similarities: Array of similarities indexed by matrix row
+            n_neighbours: Number of users to return
+            include_zero: Whether users with zero similarity can fill the list
+
+        Returns:
+            (rows, similarities) numpy arrays
+        """
+        target_row = self.user_index[user_id]
+
+        similarities = np.array(similarities, dtype=np.float64)
+        similarities[target_row] = -np.inf
+        if not include_zero:
+            similarities[similarities <= 0] = -np.inf
+
+        order = top_k(similarities, n_neighbours)
+        return order, similarities[order]
+
+
+
+    def candidate_scores(self, user_id, neighbour_rows, neighbour_similarities, matrix=None):
+        """
+        Score the products a user hasn't interacted with from their neighbours.
+
+        Args:
+            user_id: Target user id
+            neighbour_rows: Matrix rows of the neighbouring users
+            neighbour_similarities: Similarity of each neighbour to the target user
+            matrix: Optional matrix to read neighbour scores from (defaults to raw scores)
+
+        Returns:
+            (candidate columns in column order, their scores) numpy arrays
+        """
+        if matrix is None:
+            matrix = self.matrix
+        if not len(neighbour_rows):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        neighbours = matrix[neighbour_rows]
+        scores = np.asarray(neighbours.T @ np.asarray(neighbour_similarities, dtype=np.float64)).ravel()
+
+        # Candidates are every product a neighbour touched, minus the user's own
+        candidate_cols = np.unique(neighbours.indices)
+        seen_cols = self.matrix.getrow(self.user_index[user_id]).indices
+        candidate_cols = candidate_cols[~np.isin(candidate_cols, seen_cols)]
+        return candidate_cols, scores[candidate_cols]
+
+
+
+    def score_candidates(self, user_id, neighbour_rows, neighbour_similarities, matrix=None, limit=None):
+        """
+        ``candidate_scores`` ranked best first.
+
+        Returns:
+            List of (product_id, score) sorted by score descending, ties in
+            column order; only the best ``limit`` when given
+        """
+        candidate_cols, scores = self.candidate_scores(user_id, neighbour_rows, neighbour_similarities, matrix=matrix)
+        ranked = top_k(scores, len(scores) if limit is None else limit)
+        return list(zip(self.product_ids[candidate_cols[ranked]].tolist(), scores[ranked].tolist()))
+
+
+
+    def outlier_product_ids(self):
+        """Products with abnormally high interaction counts (more than mean + 2 std)"""
+        counts = self.product_counts[self.product_counts > 0]
+        if not len(counts):
+            return set()
+        threshold = counts.mean() + 2 * counts.std()
+        return set(self.product_ids[self.product_counts > threshold].tolist())
+
+
+
+    def normalised(self, exclude_product_ids=()):
+        """
+        Copy of the score matrix with the given products dropped and each
+        user's scores divided by their maximum score.
+        """
+        matrix = self.matrix.copy()
+        if exclude_product_ids:
+            keep = ~np.isin(self.product_ids, np.fromiter(exclude_product_ids, dtype=np.int64))
+            matrix = (matrix @ sparse.diags(keep.astype(np.float64))).tocsr()
+            matrix.eliminate_zeros()
+
+        row_max = np.asarray(matrix.max(axis=1).todense()).ravel()
+        row_max[row_max == 0] = 1
+        # Divide rather than multiply by the reciprocal so scores match a plain x / max exactly
+        matrix.data /= np.repeat(row_max, np.diff(matrix.indptr))
+        return matrix
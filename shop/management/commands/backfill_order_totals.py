@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+
+from shop.models import Order, OrderItem
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the stored subtotal, tax and total of existing orders from their items, '
+        'in batches of one aggregate query and one bulk update. New orders get them at '
+        'checkout; orders from before the columns are filled by migrate, which runs this '
+        'with --missing. Run it without to apply a changed ORDER_TAX_RATE. Safe to re-run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Orders read and updated per batch')
+        parser.add_argument(
+            '--missing',
+            action='store_true',
+            help='Only orders that have items but no stored subtotal, i.e. placed before the columns existed',
+        )
+
+
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        orders = Order.objects.all()
+        if options['missing']:
+            # Empty orders legitimately cost 0, so they aren't picked up on every run
+            orders = orders.filter(subtotal=0).filter(models.Exists(OrderItem.objects.filter(order=models.OuterRef('pk'))))
+
+        updated = 0
+        last_id = 0
+        while True:
+            # Keyset pagination, so each batch is an index range scan however far in we are
+            batch = list(
+                orders.filter(id__gt=last_id).order_by('id').with_item_totals()
+                .only('id', 'subtotal', 'tax', 'total')[:batch_size]
+            )
+            if not batch:
+                break
+
+            for order in batch:
+                order.set_totals(order.items_subtotal)
+            with transaction.atomic():
+                Order.objects.bulk_update(batch, ['subtotal', 'tax', 'total'])
+
+            updated += len(batch)
+            last_id = batch[-1].id
+            if options['verbosity']:
+                self.stdout.write(f'{updated} orders')
+
+        if options['verbosity']:
+            self.stdout.write(self.style.SUCCESS(f'Backfilled the totals of {updated} orders'))
@@ -0,0 +1,136 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from shop.ann import MinHashLSH, RandomProjectionLSH
+from shop.interaction_matrix import InteractionMatrix
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare LSH nearest-neighbour search against exact user similarity on a '
+        'synthetic user x product matrix: recall@k and latency per query.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20000)
+        parser.add_argument('--products', type=int, default=2000)
+        parser.add_argument('--interactions-per-user', type=int, default=20)
+        parser.add_argument('--groups', type=int, default=50, help='Number of taste groups users are drawn from')
+        parser.add_argument('--group-affinity', type=float, default=0.7, help='Share of interactions inside the user\'s group')
+        parser.add_argument('--queries', type=int, default=100)
+        parser.add_argument('--k', type=int, default=10)
+        parser.add_argument('--tables', type=int, nargs='+', default=[8, 16, 32], help='LSH table counts to try')
+        parser.add_argument('--bits', type=int, nargs='+', default=[2, 4, 8], help='LSH bits per table to try')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        matrix = self._synthetic_matrix(rng, options)
+        binary = matrix.binary
+        k = options['k']
+        query_ids = rng.choice(matrix.user_ids, size=min(options['queries'], len(matrix)), replace=False).tolist()
+
+        results = []
+
+        # Baseline: the per-user set loop collaborative_filtering used to run
+        user_sets = {
+            int(uid): set(binary.indices[binary.indptr[row]:binary.indptr[row + 1]].tolist())
+            for row, uid in enumerate(matrix.user_ids)
+        }
+        loop_ids = query_ids[:max(1, len(query_ids) // 10)]
+        started = time.perf_counter()
+        for user_id in loop_ids:
+            target = user_sets[user_id]
+            for other_id, other in user_sets.items():
+                if other_id != user_id:
+                    len(target & other) / len(target | other)
+        results.append(self._result('python_loop', started, len(loop_ids), recall=1.0))
+
+        # Exact sparse similarity, also the ground truth for recall
+        exact = {}
+        started = time.perf_counter()
+        for user_id in query_ids:
+            rows, _ = matrix.nearest_neighbours(user_id, matrix.jaccard_similarities(user_id), k, include_zero=False)
+            exact[user_id] = set(rows.tolist())
+        results.append(self._result('sparse_exact', started, len(query_ids), recall=1.0))
+
+        for index_name, index_class in (('minhash', MinHashLSH), ('simhash', RandomProjectionLSH)):
+            for n_tables in options['tables']:
+                for n_bits in options['bits']:
+                    results.append(self._benchmark_index(matrix, index_class(n_tables=n_tables, n_bits=n_bits, seed=options['seed']), query_ids, exact, k, f'{index_name}_t{n_tables}_b{n_bits}'))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for result in results:
+            extra = ''
+            if 'mean_candidates' in result:
+                extra = f"  candidates={result['mean_candidates']}  build={result['build_seconds']}s"
+            self.stdout.write(f"{result['name']:<20} {result['ms_per_query']:>9.3f} ms/query  recall@{k}={result['recall']:.3f}{extra}")
+
+
+
+    def _benchmark_index(self, matrix, index, query_ids, exact, k, name):
+        binary = matrix.binary
+        build_started = time.perf_counter()
+        index.fit(binary)
+        build_seconds = time.perf_counter() - build_started
+
+        hits = total = candidates = 0
+        started = time.perf_counter()
+        for user_id in query_ids:
+            rows = index.candidates(binary.getrow(matrix.user_index[user_id]))
+            candidates += len(rows)
+            similarities = matrix.jaccard_similarities(user_id, rows=rows)
+            found, _ = matrix.nearest_neighbours(user_id, similarities, k, include_zero=False)
+            hits += len(exact[user_id] & set(found.tolist()))
+            total += len(exact[user_id])
+
+        result = self._result(name, started, len(query_ids), recall=hits / total if total else 1.0)
+        result['build_seconds'] = round(build_seconds, 3)
+        result['mean_candidates'] = round(candidates / len(query_ids), 1)
+        return result
+
+
+
+    def _synthetic_matrix(self, rng, options):
+        """
+        Users with a fixed number of interactions. Each user belongs to a taste
+        group and draws most interactions from that group's products, the rest
+        from power-law popular products across the catalogue.
+        """
+        n_users = options['users']
+        n_products = options['products']
+        per_user = options['interactions_per_user']
+        popularity = 1.0 / np.arange(1, n_products + 1)
+        popularity /= popularity.sum()
+
+        groups = rng.integers(0, options['groups'], size=n_users)
+        group_size = max(1, n_products // options['groups'])
+
+        user_ids = np.repeat(np.arange(1, n_users + 1), per_user)
+        in_group = rng.random(len(user_ids)) < options['group_affinity']
+        group_products = np.repeat(groups, per_user) * group_size + rng.integers(0, group_size, size=len(user_ids))
+        popular_products = rng.choice(n_products, size=len(user_ids), p=popularity)
+        product_ids = np.where(in_group, group_products % n_products, popular_products) + 1
+
+        scores = np.ones(len(user_ids))
+        return InteractionMatrix.from_arrays(user_ids, product_ids, scores)
+
+
+
+    def _result(self, name, started, queries, recall):
+        elapsed = time.perf_counter() - started
+        return {
+            'name': name,
+            'ms_per_query': round(elapsed * 1000 / queries, 3),
+            'recall': round(recall, 4),
+        }
@@ -0,0 +1,78 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from shop.als import train_als
+from shop.content_index import rebuild_content_index
+from shop.cooccurrence import rebuild_together
+from shop.models import PrecomputedRecommendation
+from shop.recommendation import BULK_METHODS, get_recommendations_bulk
+
+
+
+# Per-user methods are computed for every user at once
+USER_METHODS = BULK_METHODS
+
+# Models trained before their method's rows are computed
+TRAINED_METHODS = {
+    'als': train_als,
+}
+
+# Per-product methods rebuild their own index and top-K rows, returning the
+# number of products covered
+PRODUCT_METHODS = {
+    'content': lambda: len(rebuild_content_index().product_ids),
+    'together': rebuild_together,
+}
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Materialise top-N recommendations per user (collaborative, clean, clustering, als) '
+        'and per product (content, together) into the PrecomputedRecommendation table. '
+        'Intended to run nightly from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10, help='Number of recommendations to store per user')
+        parser.add_argument(
+            '--method',
+            action='append',
+            choices=sorted(USER_METHODS) + sorted(PRODUCT_METHODS),
+            help='Only rebuild the given method (can be repeated). Defaults to all methods.',
+        )
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes for the per-user methods')
+
+
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+        methods = options['method'] or list(USER_METHODS) + list(PRODUCT_METHODS)
+
+        user_ids = list(User.objects.filter(interaction_rollups__isnull=False).distinct().values_list('id', flat=True))
+
+        for method in methods:
+            if method in PRODUCT_METHODS:
+                count = PRODUCT_METHODS[method]()
+                self.stdout.write(self.style.SUCCESS(f'{method}: indexed {count} products'))
+                continue
+
+            if method in TRAINED_METHODS:
+                model = TRAINED_METHODS[method]()
+                self.stdout.write(f'{method}: trained on {len(model)} users')
+
+            recommendations = get_recommendations_bulk(user_ids, method, limit, workers=options['workers'])
+            rows = [
+                PrecomputedRecommendation(method=method, user_id=user_id, product_id=product_id, rank=rank)
+                for user_id, product_ids in recommendations.items()
+                for rank, product_id in enumerate(product_ids)
+            ]
+
+            # Swap the whole method's rows in one transaction so readers never see a partial table
+            with transaction.atomic():
+                PrecomputedRecommendation.objects.filter(method=method).delete()
+                PrecomputedRecommendation.objects.bulk_create(rows, batch_size=1000)
+
+            self.stdout.write(self.style.SUCCESS(f'{method}: stored {len(rows)} recommendations'))
@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop.models import UserProductInteraction
+from shop.popularity import rebuild_popularity
+from shop.rollup import DEFAULT_PRUNE_TYPES, prune_interactions, rebuild_rollups, rollup_totals
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Fold raw UserProductInteraction rows into the InteractionRollup table and delete '
+        'old raw rows. New interactions are rolled up as they are written, so --rebuild is '
+        'only needed once, before the first prune, and after changing a score half-life (the '
+        'rollups store decayed sums); after a prune it would lose the pruned events. '
+        'Pruned events also stop counting towards the browsing sessions of the "frequently '
+        'bought together" model from its next rebuild.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recompute every rollup from the raw rows first')
+        parser.add_argument('--older-than', type=int, metavar='DAYS', help='Delete raw rows older than this many days')
+        parser.add_argument(
+            '--type',
+            action='append',
+            dest='types',
+            choices=[interaction_type for interaction_type, _ in UserProductInteraction.INTERACTION_TYPES],
+            help=f"Interaction type to prune (can be repeated; default: {', '.join(DEFAULT_PRUNE_TYPES)})",
+        )
+        parser.add_argument('--all-types', action='store_true', help='Prune raw rows of every type')
+
+
+
+    def handle(self, *args, **options):
+        if options['older_than'] is not None and options['older_than'] < 1:
+            raise CommandError('--older-than must be at least 1 day')
+
+        if options['rebuild']:
+            count = rebuild_rollups()
+            rebuild_popularity()
+            self.stdout.write(f'Rebuilt {count} rollups')
+
+        if options['older_than'] is not None:
+            types = None if options['all_types'] else options['types'] or DEFAULT_PRUNE_TYPES
+            before = timezone.now() - timedelta(days=options['older_than'])
+            deleted = prune_interactions(before, types)
+            self.stdout.write(f'Deleted {deleted} raw interactions older than {before:%Y-%m-%d %H:%M}')
+
+        totals = rollup_totals()
+        self.stdout.write(self.style.SUCCESS(
+            f"{totals['interactions']} raw interactions, {totals['rollups']} rollups"
+        ))
@@ -0,0 +1,152 @@
+from datetime import timedelta
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from shop.content_index import rebuild_content_index
+from shop.models import Category, Product, UserProductInteraction
+from shop.popularity import rebuild_popularity
+from shop.rollup import rebuild_rollups
+
+
+
+# Synthetic rows are recognisable by these prefixes, so --clear only removes them
+USER_PREFIX = 'bench-user-'
+CATEGORY_PREFIX = 'bench-category-'
+
+INGREDIENTS = [
+    'chocolate', 'vanilla', 'strawberry', 'cream', 'butter', 'almond', 'hazelnut', 'lemon',
+    'orange', 'caramel', 'coffee', 'coconut', 'raspberry', 'blueberry', 'mango', 'pistachio',
+    'cheese', 'honey', 'cinnamon', 'walnut', 'banana', 'red velvet', 'fondant', 'ganache',
+]
+FLAVOR_PROFILES = ['sweet', 'rich', 'fruity', 'nutty', 'tangy', 'light', 'creamy', 'spiced']
+OCCASIONS = ['birthday', 'wedding', 'anniversary', 'party', 'everyday', 'festival', 'graduation']
+
+# Share of each interaction type
+INTERACTION_MIX = {'view': 0.70, 'cart': 0.15, 'purchase': 0.10, 'rating': 0.05}
+
+BATCH_SIZE = 5000
+
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Fill the database with deterministic synthetic users, categories, products and '
+        'power-law distributed UserProductInteraction rows for benchmarking.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--products', type=int, default=500)
+        parser.add_argument('--categories', type=int, default=12)
+        parser.add_argument('--interactions', type=int, default=100000)
+        parser.add_argument('--alpha', type=float, default=1.1, help='Zipf exponent of product popularity')
+        parser.add_argument('--user-alpha', type=float, default=1.5, help='Pareto shape of user activity')
+        parser.add_argument('--days', type=int, default=90, help='Spread interaction timestamps over this many past days')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--clear', action='store_true', help='Delete previously generated data first')
+
+
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+
+        if options['clear']:
+            User.objects.filter(username__startswith=USER_PREFIX).delete()
+            Category.objects.filter(slug__startswith=CATEGORY_PREFIX).delete()
+
+        with transaction.atomic():
+            categories = self._categories(options['categories'])
+            products = self._products(rng, categories, options['products'])
+            users = self._users(options['users'])
+            count = self._interactions(rng, users, products, options)
+
+        # bulk_create sends no signals, so refresh the derived tables directly
+        rebuild_rollups()
+        rebuild_popularity()
+        rebuild_content_index()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated {len(users)} users, {len(categories)} categories, '
+            f'{len(products)} products and {count} interactions'
+        ))
+
+
+
+    def _categories(self, count):
+        Category.objects.bulk_create([
+            Category(name=f'Bench Category {i}', slug=f'{CATEGORY_PREFIX}{i}')
+            for i in range(count)
+        ], ignore_conflicts=True)
+        return list(Category.objects.filter(slug__startswith=CATEGORY_PREFIX).order_by('id'))
+
+
+
+    def _products(self, rng, categories, count):
+        prices = np.round(np.exp(rng.normal(7.0, 0.6, size=count)), -1)  # Log-normal, centred near Rs 1100
+        rows = []
+        for i in range(count):
+            ingredients = rng.choice(INGREDIENTS, size=rng.integers(2, 6), replace=False)
+            rows.append(Product(
+                category=categories[rng.integers(len(categories))],
+                name=f'Bench Cake {i:06d}',
+                slug=f'bench-cake-{i:06d}',
+                price=max(prices[i], 100),
+                description=f'Synthetic benchmark cake {i}',
+                ingredients=', '.join(ingredients),
+                flavor_profile=rng.choice(FLAVOR_PROFILES),
+                occasion=rng.choice(OCCASIONS),
+            ))
+        Product.objects.bulk_create(rows, batch_size=BATCH_SIZE, ignore_conflicts=True)
+        return list(Product.objects.filter(category__in=categories).order_by('id'))
+
+
+
+    def _users(self, count):
+        password = make_password(None)  # Unusable password
+        User.objects.bulk_create([
+            User(username=f'{USER_PREFIX}{i:06d}', password=password)
+            for i in range(count)
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+        return list(User.objects.filter(username__startswith=USER_PREFIX).order_by('id'))
+
+
+
+    def _interactions(self, rng, users, products, options):
+        """Zipf-distributed product popularity and Pareto-distributed user activity"""
+        total = options['interactions']
+        if not total or not users or not products:
+            return 0
+
+        product_weights = 1.0 / np.arange(1, len(products) + 1) ** options['alpha']
+        product_weights = product_weights[rng.permutation(len(products))]  # Popular items aren't the first ids
+        product_weights /= product_weights.sum()
+
+        user_weights = rng.pareto(options['user_alpha'], size=len(users)) + 1
+        user_weights /= user_weights.sum()
+
+        user_rows = rng.choice(len(users), size=total, p=user_weights)
+        product_rows = rng.choice(len(products), size=total, p=product_weights)
+        types = rng.choice(list(INTERACTION_MIX), size=total, p=list(INTERACTION_MIX.values()))
+        ratings = rng.integers(1, 6, size=total)
+        now = timezone.now()
+        ages = np.sort(rng.uniform(0, options['days'] * 24 * 60 * 60, size=total))[::-1]  # Oldest first, like real inserts
+
+        for start in range(0, total, BATCH_SIZE):
+            end = min(start + BATCH_SIZE, total)
+            UserProductInteraction.objects.bulk_create([
+                UserProductInteraction(
+                    user_id=users[user_rows[i]].id,
+                    product_id=products[product_rows[i]].id,
+                    interaction_type=str(types[i]),
+                    rating=int(ratings[i]) if types[i] == 'rating' else None,
+                    timestamp=now - timedelta(seconds=float(ages[i])),
+                )
+                for i in range(start, end)
+            ])
+        return total
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from shop.content_index import content_index_stale, rebuild_content_index
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the TF-IDF content index and the stored "similar products" rows. Product and '
+        'category changes only mark the index stale, so run this every few minutes from cron '
+        'with --if-stale.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--if-stale', action='store_true', help='Only rebuild if the catalogue changed since the last build')
+
+
+
+    def handle(self, *args, **options):
+        if options['if_stale'] and not content_index_stale():
+            self.stdout.write('Content index is up to date')
+            return
+        index = rebuild_content_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {len(index.product_ids)} products'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from shop.popularity import rebuild_popularity
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the ProductPopularity totals from the InteractionRollup table. '
+        'Run once after deploying the table, and after rebuilding the rollups.'
+    )
+
+    def handle(self, *args, **options):
+        count = rebuild_popularity()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt popularity for {count} products'))
@@ -0,0 +1,64 @@
+import json
+import platform
+import sys
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from shop.benchmarks import BENCHMARKS, BenchmarkRun, dataset_summary, run_benchmarks
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Time every get_recommendations method, the bulk API, shop_list filtering and '
+        'checkout against the current database and write a JSON report. Fill the '
+        'database with manage.py generate_benchmark_data first.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Users sampled for the per-user benchmarks')
+        parser.add_argument('--products', type=int, default=50, help='Products sampled for the per-product benchmarks')
+        parser.add_argument('--repeat', type=int, default=3, help='Times each call is repeated')
+        parser.add_argument('--limit', type=int, default=5, help='Recommendations requested per call')
+        parser.add_argument(
+            '--only',
+            action='append',
+            choices=list(BENCHMARKS),
+            help='Only run the given benchmark (can be repeated)',
+        )
+        parser.add_argument('--output', help='Write the report to this file instead of stdout')
+
+
+
+    def handle(self, *args, **options):
+        run = BenchmarkRun(
+            users=options['users'],
+            products=options['products'],
+            repeat=options['repeat'],
+            limit=options['limit'],
+        )
+
+        report = {
+            'generated_at': timezone.now().isoformat(),
+            'environment': {
+                'python': sys.version.split()[0],
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'platform': platform.platform(),
+            },
+            'dataset': dataset_summary(),
+            'options': {key: options[key] for key in ('users', 'products', 'repeat', 'limit')},
+            'results': run_benchmarks(run, names=options['only']),
+        }
+
+        # Sorted keys keep reports from different releases diffable
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        else:
+            self.stdout.write(output)
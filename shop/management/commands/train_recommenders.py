@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from shop.training import TRAINERS, train_recommenders
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the recommendation models (similarities, ALS, clustering, content index, '
+        'frequently bought together) in parallel worker processes sharing one memory-mapped '
+        'interaction snapshot. Running servers switch to the new models together, without a restart, '
+        'once every build has succeeded.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--model',
+            action='append',
+            choices=list(TRAINERS),
+            help='Only build the given model (can be repeated). Defaults to all models.',
+        )
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes (1 builds everything in this process)')
+
+
+
+    def handle(self, *args, **options):
+        manifest = train_recommenders(options['model'], workers=options['workers'])
+
+        for name, result in manifest['models'].items():
+            if 'error' in result:
+                self.stderr.write(self.style.ERROR(f"{name}: failed: {result['error']}"))
+            else:
+                self.stdout.write(f"{name}: {result['count']} in {result['seconds']}s")
+
+        if not manifest['published']:
+            self.stderr.write(self.style.ERROR(f"Version {manifest['version']} not published: the previous models stay in use"))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Trained and published version {manifest['version']} on {manifest['interactions']} interaction rollups "
+            f"in {manifest['seconds']}s with {manifest['workers']} workers"
+        ))
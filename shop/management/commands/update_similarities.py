@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from shop.similarity import update_similarity_state
+
+
+
+class Command(BaseCommand):
+    help = (
+        'Apply UserProductInteraction rows created since the last run to the stored '
+        'user similarity state. Run every minute or so from cron: serving processes only read the '
+        'saved state and pick up each new one on their next request. Use --full for a periodic rebuild.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild the similarity state from the interaction rollups')
+
+
+
+    def handle(self, *args, **options):
+        state, changed = update_similarity_state(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated {changed} users ({len(state.matrix)} users, watermark {state.watermark})'
+        ))
@@ -1,4 +1,7 @@
+from decimal import Decimal
+from django.conf import settings
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
@@ -53,6 +56,20 @@ class Product(models.Model):
     
 
 
+class OrderQuerySet(models.QuerySet):
+    def with_item_totals(self):
+        """Annotate ``item_count`` and ``items_subtotal`` computed from the order lines in the same query"""
+        return self.annotate(
+            item_count=Coalesce(models.Sum('items__quantity'), 0),
+            items_subtotal=Coalesce(
+                models.Sum(models.F('items__price') * models.F('items__quantity')),
+                Decimal('0'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+        )
+
+
+
 class Order(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -96,6 +113,15 @@ class Order(models.Model):
     # Unique order reference for eSewa
     order_ref = models.CharField(max_length=50, unique=True, default='')
     
+    # Denormalised from the items at checkout and whenever an item changes
+    # (see set_totals). Orders placed before the columns existed are filled
+    # by ``migrate`` (see signals.backfill_missing_order_totals)
+    subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    tax = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    
+    objects = OrderQuerySet.as_manager()
+    
     class Meta:
         ordering = ('-created',)
     
@@ -103,7 +129,20 @@ class Order(models.Model):
         return f'Order {self.id}'
     
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.items.all())
+        # Cost of the items before tax, as stored
+        return self.subtotal
+    
+    def set_totals(self, subtotal):
+        """Set subtotal, tax (ORDER_TAX_RATE, rounded to the paisa) and total; doesn't save"""
+        self.subtotal = Decimal(subtotal)
+        self.tax = (self.subtotal * Decimal(str(getattr(settings, 'ORDER_TAX_RATE', '0.13')))).quantize(Decimal('0.01'))
+        self.total = self.subtotal + self.tax
+    
+    def update_totals(self):
+        """Recompute the stored totals from the items"""
+        subtotal = self.items.aggregate(subtotal=models.Sum(models.F('price') * models.F('quantity')))['subtotal']
+        self.set_totals(subtotal or 0)
+        Order.objects.filter(pk=self.pk).update(subtotal=self.subtotal, tax=self.tax, total=self.total)
     
     def save(self, *args, **kwargs):
         if not self.order_ref:
@@ -128,6 +167,57 @@ class OrderItem(models.Model):
     
     
 
+class ShoppingCart(models.Model):
+    # A signed-in user's cart, or an anonymous one whose id is kept in the session (see shop.cart.Cart)
+    user = models.OneToOneField(User, related_name='shopping_cart', on_delete=models.CASCADE, null=True, blank=True)
+    # Denormalised from the items on every write, so the cart badge never reads them
+    item_count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+    
+    def __str__(self):
+        return f'Cart {self.id}'
+    
+    def update_totals(self):
+        """Recompute item_count and total from the items in one UPDATE"""
+        items = CartItem.objects.filter(cart=models.OuterRef('pk')).order_by().values('cart')
+        ShoppingCart.objects.filter(pk=self.pk).update(
+            item_count=Coalesce(models.Subquery(items.annotate(n=models.Sum('quantity')).values('n')), 0),
+            total=Coalesce(
+                models.Subquery(items.annotate(t=models.Sum(models.F('price') * models.F('quantity'))).values('t')),
+                Decimal('0'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+            updated=timezone.now(),
+        )
+        self.refresh_from_db(fields=['item_count', 'total', 'updated'])
+
+
+
+class CartItem(models.Model):
+    cart = models.ForeignKey(ShoppingCart, related_name='items', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='cart_items', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=1)
+    # Unit price when the product was first added
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    
+    class Meta:
+        ordering = ('id',)
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+    
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id}'
+    
+    def get_cost(self):
+        return self.price * self.quantity
+    
+    
+    
+    
+
 class UserProductInteraction(models.Model):
     INTERACTION_TYPES = (
         ('view', 'View'),
@@ -140,10 +230,103 @@ class UserProductInteraction(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     interaction_type = models.CharField(max_length=10, choices=INTERACTION_TYPES)
     rating = models.IntegerField(null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the event happens; buffered rows are inserted later (see shop.interaction_buffer)
+    timestamp = models.DateTimeField(default=timezone.now, db_index=True)
     
     class Meta:
         ordering = ['-timestamp']
+
+
+
+
+
+class InteractionRollup(models.Model):
+    # One row per (user, product, type), maintained by shop.rollup.record_rollups
+    user = models.ForeignKey(User, related_name='interaction_rollups', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='interaction_rollups', on_delete=models.CASCADE)
+    interaction_type = models.CharField(max_length=10, choices=UserProductInteraction.INTERACTION_TYPES)
+    count = models.PositiveIntegerField(default=0)
+    # Sum and number of the events that carried a rating
+    rating_sum = models.IntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now, db_index=True)
+    # Sum of each event's units * e^(decay * seconds since scoring.SCORE_EPOCH), so
+    # every event decays from its own time: at RECOMMENDER_SCORE_HALF_LIFE_DAYS
+    # for the recommenders and RECOMMENDER_POPULARITY_HALF_LIFE_DAYS for
+    # popularity. Changing a half-life needs ``compact_interactions --rebuild``
+    decayed_units = models.FloatField(default=0)
+    popularity_units = models.FloatField(default=0)
+
+    class Meta:
+        ordering = ['-last_seen']
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product', 'interaction_type'], name='unique_interaction_rollup'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id}/{self.product_id} {self.interaction_type} x{self.count}'
+
+    @property
+    def units(self):
+        """Event count, with each rating event counted as its rating (1 if missing)"""
+        if self.interaction_type == 'rating':
+            return self.rating_sum + self.count - self.rating_count
+        return self.count
+
+
+
+
+
+class ProductPopularity(models.Model):
+    # Running totals maintained by shop.popularity.record_interactions
+    product = models.OneToOneField(Product, related_name='popularity', on_delete=models.CASCADE, primary_key=True)
+    score = models.FloatField(default=0)
+    # Sum of weight * e^(decay * seconds since scoring.SCORE_EPOCH); orders like the time-decayed score
+    decayed_score = models.FloatField(default=0)
+    interactions = models.PositiveIntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['-score']),
+            models.Index(fields=['-decayed_score']),
+        ]
+    
+    def __str__(self):
+        return f'{self.product_id}: {self.score}'
+        
+      
+      
+        
+
+class PrecomputedRecommendation(models.Model):
+    METHOD_CHOICES = (
+        ('collaborative', 'Collaborative'),
+        ('clean', 'Clean'),
+        ('clustering', 'Clustering'),
+        ('content', 'Content'),
+        ('als', 'Matrix factorisation'),
+        ('together', 'Frequently bought together'),
+    )
+    
+    method = models.CharField(max_length=20, choices=METHOD_CHOICES)
+    # User-based methods are keyed by user, content-based by source product
+    user = models.ForeignKey(User, related_name='precomputed_recommendations', on_delete=models.CASCADE, null=True, blank=True)
+    source_product = models.ForeignKey(Product, related_name='precomputed_similar', on_delete=models.CASCADE, null=True, blank=True)
+    product = models.ForeignKey(Product, related_name='precomputed_recommendations', on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ('rank',)
+        indexes = [
+            models.Index(fields=['method', 'user', 'rank']),
+            models.Index(fields=['method', 'source_product', 'rank']),
+        ]
+    
+    def __str__(self):
+        return f'{self.method} #{self.rank}: {self.product_id}'
         
       
       
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .instrumentation import record_cache
+from .models import InteractionRollup, Product, ProductPopularity
+from .scoring import TYPE_CODES, decay_boost, interaction_score, rating_units, score_arrays
+
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+
+
+def popularity_half_life():
+    """
+    RECOMMENDER_POPULARITY_HALF_LIFE_DAYS, used for ``decayed_score``.
+
+    Decayed scores are stored relative to scoring.SCORE_EPOCH. With a 7 day
+    half-life the stored values stay within float range for ~19 years; move
+    the epoch forward and run ``manage.py rebuild_popularity`` well before then.
+    """
+    return getattr(settings, 'RECOMMENDER_POPULARITY_HALF_LIFE_DAYS', 7)
+
+
+
+def popularity_boost(timestamp):
+    """Multiplier for an interaction at ``timestamp`` in ``decayed_score`` (see scoring.decay_boost)"""
+    return decay_boost(timestamp, popularity_half_life())
+
+
+
+def decayed_value(decayed_score, now=None):
+    """Convert a stored ``decayed_score`` into the time-decayed score at ``now``"""
+    now = now or timezone.now()
+    return decayed_score / popularity_boost(now)
+
+
+
+def record_interactions(interactions):
+    """
+    Add interactions to the ProductPopularity totals.
+
+    Called for each saved UserProductInteraction by the post_save signal; code
+    that inserts with ``bulk_create`` (which sends no signals) must call it
+    with the created rows.
+
+    Args:
+        interactions: Iterable of UserProductInteraction objects
+    """
+    totals = defaultdict(lambda: [0.0, 0.0, 0])
+    for interaction in interactions:
+        weight = interaction_score(interaction.interaction_type, interaction.rating)
+        total = totals[interaction.product_id]
+        total[0] += weight
+        total[1] += weight * popularity_boost(interaction.timestamp or timezone.now())
+        total[2] += 1
+
+    if not totals:
+        return
+
+    with transaction.atomic():
+        ProductPopularity.objects.bulk_create(
+            [ProductPopularity(product_id=product_id) for product_id in totals],
+            ignore_conflicts=True,
+        )
+        # F() expressions keep concurrent writers from losing each other's increments
+        for product_id, (score, decayed_score, count) in totals.items():
+            ProductPopularity.objects.filter(product_id=product_id).update(
+                score=F('score') + score,
+                decayed_score=F('decayed_score') + decayed_score,
+                interactions=F('interactions') + count,
+            )
+
+
+
+def rebuild_popularity():
+    """
+    Recompute every product's totals from the interaction rollups.
+
+    The decayed score comes from each rollup's ``popularity_units``, in which
+    every event is decayed from its own time, so it matches what
+    ``record_interactions`` added up for the same events.
+
+    Returns:
+        Number of products with a popularity row
+    """
+    rows = list(InteractionRollup.objects.values_list(
+        'product_id', 'interaction_type', 'count', 'rating_sum', 'rating_count', 'popularity_units',
+    ))
+    product_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    types = np.fromiter((TYPE_CODES[row[1]] for row in rows), dtype=np.int8, count=len(rows))
+    counts = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+    units = rating_units(
+        types,
+        counts,
+        np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows)),
+        np.fromiter((row[4] for row in rows), dtype=np.int64, count=len(rows)),
+    )
+    weights = score_arrays(types, units)
+    decayed = score_arrays(types, np.fromiter((row[5] for row in rows), dtype=np.float64, count=len(rows)))
+
+    products, positions = np.unique(product_ids, return_inverse=True)
+    totals = zip(
+        products.tolist(),
+        np.bincount(positions, weights=weights, minlength=len(products)).tolist(),
+        np.bincount(positions, weights=decayed, minlength=len(products)).tolist(),
+        np.bincount(positions, weights=counts, minlength=len(products)).astype(np.int64).tolist(),
+    )
+
+    with transaction.atomic():
+        ProductPopularity.objects.all().delete()
+        ProductPopularity.objects.bulk_create(
+            [
+                ProductPopularity(product_id=product_id, score=score, decayed_score=decayed_score, interactions=count)
+                for product_id, score, decayed_score, count in totals
+            ],
+            batch_size=1000,
+        )
+
+    clear_popularity_cache()
+    return len(products)
+
+
+
+def popular_products(limit=5, category=None, decayed=False):
+    """
+    Most popular available products, topped up with the newest ones.
+
+    Results are cached in-process for RECOMMENDER_POPULARITY_CACHE_SECONDS.
+
+    Args:
+        limit: Number of products to return
+        category: Optional Category (or id) to restrict to
+        decayed: Rank by the time-decayed score instead of the all-time score
+
+    Returns:
+        List of Product objects
+    """
+    category_id = getattr(category, 'id', category)
+    key = (limit, category_id, decayed)
+    ttl = getattr(settings, 'RECOMMENDER_POPULARITY_CACHE_SECONDS', 30)
+
+    cached = _cache.get(key)
+    hit = cached is not None and time.monotonic() - cached[0] < ttl
+    record_cache('popular_products', hit)
+    if hit:
+        return list(cached[1])
+
+    products = Product.objects.filter(available=True)
+    if category_id is not None:
+        products = products.filter(category_id=category_id)
+
+    order = '-popularity__decayed_score' if decayed else '-popularity__score'
+    popular = list(products.filter(popularity__score__gt=0).order_by(order, 'name')[:limit])
+
+    # If we don't have enough popular products, add some recent ones
+    if len(popular) < limit:
+        recent = products.exclude(id__in=[product.id for product in popular]).order_by('-created')
+        popular += list(recent[:limit - len(popular)])
+
+    with _cache_lock:
+        _cache[key] = (time.monotonic(), popular)
+    return list(popular)
+
+
+
+def clear_popularity_cache():
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,86 @@
+import numpy as np
+
+# Top-k selection shared by the recommenders. Every helper returns exactly
+# what a stable full sort would (ties keep their input order) without sorting
+# more than the k items kept. Only depends on numpy so bulk worker processes
+# can import it without configuring Django.
+
+
+
+
+def top_k(scores, k):
+    """
+    Positions of the ``k`` highest finite scores, best first.
+
+    Same result as ``np.argsort(-scores, kind='stable')[:k]`` with non-finite
+    scores dropped, in O(n + k log k).
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    if k < len(scores):
+        # Everything above the k-th best score, then the earliest of those tied with it
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > threshold)
+        tied = np.flatnonzero(scores == threshold)[:k - len(above)]
+        top = np.concatenate([above, tied])
+    else:
+        top = np.arange(len(scores))
+
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top[np.isfinite(scores[top])]
+
+
+
+def top_k_rows(scores, k):
+    """
+    ``top_k`` for every row of a dense 2-D array.
+
+    Returns:
+        (n_rows, k) array of column positions, best first; unlike ``top_k``
+        non-finite scores are kept, so check them with np.isfinite
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    n_rows, n_cols = scores.shape
+    k = min(k, n_cols)
+    if k <= 0:
+        return np.empty((n_rows, 0), dtype=np.int64)
+    if k == n_cols:
+        return np.argsort(-scores, axis=1, kind='stable')
+
+    threshold = -np.partition(-scores, k - 1, axis=1)[:, k - 1:k]
+    above = scores > threshold
+    tied = scores == threshold
+    # Keep as many of the tied columns, leftmost first, as there are places left
+    keep = above | (tied & (np.cumsum(tied, axis=1) <= k - above.sum(axis=1, keepdims=True)))
+    top = np.nonzero(keep)[1].reshape(n_rows, k)
+
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+
+def top_items(scores, k):
+    """
+    The ``k`` best (key, score) pairs of a {key: score} dict.
+
+    Same result as ``sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]``
+    for finite scores, without sorting the whole dict.
+    """
+    keys = list(scores)
+    values = np.fromiter(scores.values(), dtype=np.float64, count=len(keys))
+    return [(keys[position], scores[keys[position]]) for position in top_k(values, k).tolist()]
+
+
+
+def in_order(objects, ids, key=lambda obj: obj.id):
+    """
+    ``objects`` sorted to follow ``ids``.
+
+    Uses a position map, so reordering n objects is O(n log n) rather than
+    the O(n^2) of sorting by ``ids.index``. Every object's key must be in ``ids``.
+    """
+    position = {object_id: i for i, object_id in enumerate(ids)}
+    return sorted(objects, key=lambda obj: position[key(obj)])
@@ -1,147 +1,343 @@
 import numpy as np
-from sklearn.cluster import KMeans
 from sklearn.metrics.pairwise import cosine_similarity
 from collections import defaultdict
-from .models import Product, UserProductInteraction 
+from django.conf import settings
+from .models import Product, PrecomputedRecommendation
+from .similarity import get_similarity_state
+from .content_index import get_content_index, similar_without_index
+from .clustering import MIN_PRODUCTS, get_cluster_model
+from .diversity import DIVERSITY_STRATEGIES, category_quota, category_round_robin, mmr, rank_relevance
+from .instrumentation import instrumented, observe_size, record_cache, timed
+from .popularity import popular_products
+from .ranking import in_order, top_items, top_k
+from .snapshot import get_interaction_snapshot
+from .bulk import BulkContext, recommend_users, round_robin_by_category
+from .als import get_als_model
 
 
 
-def get_recommendations(user, method='hybrid', product=None, limit=5):
+# Methods get_recommendations_bulk can compute
+BULK_METHODS = ('collaborative', 'clean', 'clustering', 'als')
+
+
+
+def get_recommendations(user, method='hybrid', product=None, limit=5, use_precomputed=True, snapshot=None, diversity=None):
     
     """
     Get product recommendations based on specified method
     
     Args:
         user: User object
-        method: 'collaborative', 'content', 'hybrid', 'clustering', or 'clean'
+        method: 'collaborative', 'content', 'hybrid', 'clustering', 'clean' or 'als'
         product: Product object (for content-based recommendations)
         limit: Number of recommendations to return
+        use_precomputed: Serve from the PrecomputedRecommendation table when it
+            has enough rows, falling back to live computation on a miss
+        snapshot: InteractionSnapshot to share between several calls (e.g. for
+            one page render); a fresh one is used when omitted
+        diversity: Re-rank a larger candidate list with 'category' (per-category
+            quota) or 'mmr' (maximal marginal relevance); see shop.diversity
         
     Returns:
         List of recommended Product objects
     """
+    if diversity is not None:
+        return _diversified(user, method, product, limit, use_precomputed, snapshot, diversity)
+    
     
     
     if method == 'collaborative':
-        return collaborative_filtering(user, limit)
+        return _precomputed_or_live(method, limit, use_precomputed, lambda: collaborative_filtering(user, limit, snapshot=snapshot), user=user)
     elif method == 'content':
-        return content_based_filtering(product, limit)
+        return _precomputed_or_live(method, limit, use_precomputed, lambda: content_based_filtering(product, limit), product=product)
     elif method == 'clustering':
-        return clustering_recommendations(user, limit)
+        return _precomputed_or_live(method, limit, use_precomputed, lambda: clustering_recommendations(user, limit, snapshot=snapshot), user=user)
     elif method == 'clean':
-        return clean_recommendations(user, limit)
+        return _precomputed_or_live(method, limit, use_precomputed, lambda: clean_recommendations(user, limit, snapshot=snapshot), user=user)
+    elif method == 'als':
+        return _precomputed_or_live(method, limit, use_precomputed, lambda: als_recommendations(user, limit), user=user)
     else:  # hybrid (default)
-        collab_recs = collaborative_filtering(user, limit)
-        
-        # If we have a specific product, get content-based recommendations too
+        with timed('recommendations.hybrid'):
+            return _hybrid(user, product, limit, use_precomputed, snapshot)
+    
+    
+    
+    
+    
+
+def _hybrid(user, product, limit, use_precomputed, snapshot):
+    """Collaborative recommendations, topped up with content-based ones for ``product``"""
+    collab_recs = get_recommendations(user, 'collaborative', limit=limit, use_precomputed=use_precomputed, snapshot=snapshot)
+    
+    # If we have a specific product, get content-based recommendations too
+    
+    if product:
+        content_recs = get_recommendations(user, 'content', product=product, limit=limit, use_precomputed=use_precomputed)
         
-        if product:
-            content_recs = content_based_filtering(product, limit)
-            
-            # Combine and deduplicate recommendations
-            
-            hybrid_recs = list(collab_recs)
-            for rec in content_recs:
-                if rec not in hybrid_recs:
-                    hybrid_recs.append(rec)
-            return hybrid_recs[:limit]
+        # Combine and deduplicate recommendations
         
-        return collab_recs
+        hybrid_recs = list(collab_recs)
+        for rec in content_recs:
+            if rec not in hybrid_recs:
+                hybrid_recs.append(rec)
+        return hybrid_recs[:limit]
+    
+    return collab_recs
     
     
     
     
     
 
-def collaborative_filtering(user, limit=5):
-    """User-based collaborative filtering"""
-    # Get all user interactions
-    interactions = UserProductInteraction.objects.all()
+def _diversified(user, method, product, limit, use_precomputed, snapshot, strategy):
+    """Recommendations from ``method``, over-fetched and re-ranked with ``diversify``"""
+    if strategy not in DIVERSITY_STRATEGIES:
+        raise ValueError(f"Diversity must be one of {', '.join(DIVERSITY_STRATEGIES)}, not {strategy!r}")
+    
+    pool = limit * getattr(settings, 'RECOMMENDER_DIVERSITY_POOL', 3)
+    candidates = None
+    if use_precomputed and (method in BULK_METHODS or method == 'content'):
+        # Stored lists are only as long as the nightly build made them; any that cover the limit will do
+        keyed_by = {'product': product} if method == 'content' else {'user': user}
+        candidates = get_precomputed_recommendations(method, limit=pool, min_count=limit, **keyed_by)
+        record_cache(f'precomputed.{method}', candidates is not None)
+    if candidates is None:
+        candidates = get_recommendations(
+            user, method, product=product, limit=pool,
+            use_precomputed=use_precomputed and method == 'hybrid', snapshot=snapshot,
+        )
+    
+    with timed(f'diversity.{strategy}'):
+        return diversify(candidates, limit, strategy)
+
+
+
+def diversify(products, limit, strategy):
+    """
+    Re-rank recommended products (best first) for variety.
+    
+    'category' keeps the ranking but caps how many products each category
+    gets; 'mmr' trades rank against TF-IDF similarity to the products already
+    picked, using the content index's vectors, and takes turns across
+    categories instead while no index has been built. Categories come from
+    the products themselves, so no queries are made.
+    
+    Args:
+        products: Product objects, best first
+        limit: Number of products to return
+        strategy: One of DIVERSITY_STRATEGIES
+        
+    Returns:
+        List of at most ``limit`` Product objects
+    """
+    products = list(products)
+    category_ids = [product.category_id for product in products]
+    index = get_content_index() if strategy == 'mmr' else None
+    if strategy == 'category':
+        positions = category_quota(category_ids, limit)
+    elif index is None:
+        # Never build the index from here; take turns across categories until it exists
+        positions = category_round_robin(category_ids, limit)
+    else:
+        features = index.vectors([product.id for product in products])
+        trade_off = getattr(settings, 'RECOMMENDER_MMR_TRADE_OFF', 0.7)
+        positions = mmr(rank_relevance(len(products)), features, limit, trade_off)
+    return [products[position] for position in positions.tolist()]
+
+
+
+def get_precomputed_recommendations(method, user=None, product=None, limit=5, min_count=None):
+    """
+    Read stored recommendations written by ``manage.py build_recommendations``
+    
+    Returns:
+        List of up to ``limit`` Product objects, or None when the table has
+        fewer than ``min_count`` (default: ``limit``)
+    """
+    if product is not None:
+        rows = PrecomputedRecommendation.objects.filter(method=method, source_product_id=product.id)
+    elif user is not None and user.is_authenticated:
+        rows = PrecomputedRecommendation.objects.filter(method=method, user_id=user.id)
+    else:
+        return None
+    
+    # One indexed query, joined to the recommended products
+    rows = rows.filter(product__available=True).select_related('product').order_by('rank')[:limit]
+    products = [row.product for row in rows]
+    
+    if len(products) < (limit if min_count is None else min_count):
+        return None
+    return products
+
+
+
+@instrumented('get_recommendations_bulk')
+def get_recommendations_bulk(user_ids, method='collaborative', limit=5, workers=None, snapshot=None):
+    """
+    Get recommendations for many users at once
+    
+    Loads the interactions once and scores users in blocks with sparse matrix
+    products, instead of repeating the per-user queries for every user.
+    
+    Args:
+        user_ids: Iterable of user ids
+        method: 'collaborative', 'clean', 'clustering' or 'als'
+        limit: Number of recommendations per user
+        workers: Split the users across this many worker processes
+        snapshot: Optional InteractionSnapshot to read the interactions from
+        
+    Returns:
+        Dict mapping each user id to a list of recommended product ids, best first
+    """
+    if method not in BULK_METHODS:
+        raise ValueError(f"Bulk recommendations support {', '.join(BULK_METHODS)}, not {method!r}")
     
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
     
-    # Create user-item matrix
-    user_item_matrix = defaultdict(dict)
+    if method == 'als':
+        return _als_bulk(user_ids, limit)
     
+    snapshot = snapshot or get_interaction_snapshot()
+    return recommend_users(_bulk_context(method, limit, snapshot), method, user_ids, limit, workers=workers)
+
+
+
+def _als_bulk(user_ids, limit):
+    """Score every user against the item factors in blocks; unknown users get popular products"""
+    model = get_als_model()
+    available_ids = list(Product.objects.filter(available=True).values_list('id', flat=True))
+    results = {}
+    if model is not None:
+        results = model.recommend_many(user_ids, limit, allowed=model.allowed_mask(available_ids))
+    
+    popular_ids = [product.id for product in get_popular_products(limit)]
+    for user_id in user_ids:
+        recommended = results.get(user_id, [])
+        if len(recommended) < limit:
+            seen = model.seen_product_ids(user_id) if model is not None else set()
+            for product_id in popular_ids:
+                if len(recommended) >= limit:
+                    break
+                if product_id not in recommended and product_id not in seen:
+                    recommended.append(product_id)
+        results[user_id] = recommended
+    return results
+
+
+
+def _bulk_context(method, limit, snapshot):
+    """Load everything ``method`` needs for a bulk run in a handful of queries"""
+    matrix = snapshot.matrix
     
-    # Weight different interaction types
-    weights = {
-        'view': 1,
-        'cart': 3,
-        'purchase': 5,
-        'rating': 2  # Base weight, will be multiplied by rating value
-    }
+    products = list(Product.objects.filter(available=True).values_list('id', 'category_id'))
+    context = BulkContext(
+        matrix.user_ids,
+        matrix.product_ids,
+        matrix.matrix,
+        popular_ids=[product.id for product in get_popular_products(limit)],
+        available_ids=[product_id for product_id, _ in products],
+        category_of=dict(products),
+    )
     
+    if method in ('collaborative', 'clean') and len(snapshot):
+        # Tied candidates and neighbours rank as in the single-user recommenders
+        context.first_touched = snapshot.first_touched
+    if method == 'clean' and len(snapshot):
+        context.clean_matrix = snapshot.clean_matrix
+        context.clean_first_seen = snapshot.clean_first_seen
     
+    if method == 'clustering':
+        model = get_cluster_model()
+        if len(model) >= MIN_PRODUCTS:
+            _add_cluster_weights(context, model, snapshot)
     
+    return context
+
+
+
+def _add_cluster_weights(context, model, snapshot):
+    """Per-user interaction score and first interaction position for each cluster"""
+    n_clusters = int(model.clusters.max()) + 1
+    weights = np.zeros((len(context.user_ids), n_clusters))
+    first_seen = np.full((len(context.user_ids), n_clusters), np.iinfo(np.int64).max, dtype=np.int64)
     
+    clusters = np.fromiter(
+        (model.product_clusters.get(product_id, -1) for product_id in snapshot.product_ids.tolist()),
+        dtype=np.int64,
+        count=len(snapshot),
+    )
+    known = np.flatnonzero(clusters >= 0)
+    rows = np.fromiter((context.user_index[user_id] for user_id in snapshot.user_ids[known].tolist()), dtype=np.int64, count=len(known))
     
+    # Unbuffered adds accumulate in snapshot order, like the per-user loop
+    np.add.at(weights, (rows, clusters[known]), snapshot.scores()[known])
+    np.minimum.at(first_seen, (rows, clusters[known]), known)
     
-    # Fill the matrix with weighted interaction scores
-    for interaction in interactions:
-        score = weights[interaction.interaction_type]
-        if interaction.interaction_type == 'rating' and interaction.rating:
-            score *= interaction.rating
+    context.cluster_product_ids = model.product_ids
+    context.clusters = model.clusters
+    context.cluster_weights = weights
+    context.cluster_first_seen = first_seen
+
+
+
+def _precomputed_or_live(method, limit, use_precomputed, compute, user=None, product=None):
+    """Serve from the precomputed table, calling ``compute()`` only on a miss"""
+    with timed(f'recommendations.{method}'):
+        if use_precomputed:
+            products = get_precomputed_recommendations(method, user=user, product=product, limit=limit)
+            record_cache(f'precomputed.{method}', products is not None)
+            if products is not None:
+                return products
         
-        if interaction.user.id in user_item_matrix:
-            if interaction.product.id in user_item_matrix[interaction.user.id]:
-                user_item_matrix[interaction.user.id][interaction.product.id] += score
-            else:
-                user_item_matrix[interaction.user.id][interaction.product.id] = score
-        else:
-            user_item_matrix[interaction.user.id] = {interaction.product.id: score}
+        return compute()
+    
     
     
     
     
+
+@instrumented('collaborative_filtering')
+def collaborative_filtering(user, limit=5, snapshot=None):
+    """User-based collaborative filtering"""
+    # Use the incrementally maintained similarity state when it has been built,
+    # otherwise the sparse user-item matrix of weighted interaction scores
+    state = get_similarity_state()
+    if state is None:
+        snapshot = snapshot or get_interaction_snapshot()
+    matrix = state.matrix if state is not None else snapshot.matrix
+    
+    
     
     # Find similar users
     target_user_id = user.id
-    if target_user_id not in user_item_matrix:
+    if target_user_id not in matrix:
         # If user has no interactions, return popular products
         return get_popular_products(limit)
     
-    user_similarities = {}
-    target_user_items = user_item_matrix[target_user_id]
-    
-    for other_user_id, other_user_items in user_item_matrix.items():
-        if other_user_id == target_user_id:
-            continue
-        
-        # Calculate Jaccard similarity
-        common_items = set(target_user_items.keys()) & set(other_user_items.keys())
-        all_items = set(target_user_items.keys()) | set(other_user_items.keys())
-        
-        if not all_items:
-            continue
-            
-        similarity = len(common_items) / len(all_items)
-        user_similarities[other_user_id] = similarity
-        
-    
-    
+    if state is not None:
+        neighbour_rows, neighbour_similarities = state.neighbours('collaborative', target_user_id)
+    else:
+        # Jaccard similarity against every other user in one sparse product
+        user_similarities = matrix.jaccard_similarities(target_user_id)
+        neighbour_rows, neighbour_similarities = matrix.nearest_neighbours(target_user_id, user_similarities, n_neighbours=10)
     
-    # Get top similar users
-    similar_users = sorted(user_similarities.items(), key=lambda x: x[1], reverse=True)[:10]
+    # Score unseen items from the top 10 similar users
+    candidate_cols, candidate_scores = matrix.candidate_scores(target_user_id, neighbour_rows, neighbour_similarities)
+    observe_size('collaborative_filtering.candidates', len(candidate_cols))
+    target_user_items_set = set(matrix.user_items(target_user_id))
+    if state is None:
+        # Tied candidates in the order the neighbours, best first, touched them;
+        # the state's incrementally updated matrix doesn't keep that order, so
+        # there ties stay in column (first seen overall) order
+        order = _first_touched_order(snapshot, neighbour_rows, candidate_cols)
+        candidate_cols, candidate_scores = candidate_cols[order], candidate_scores[order]
     
-    # Get items from similar users that target user hasn't interacted with
-    target_user_items_set = set(target_user_items.keys())
-    candidate_items = {}
     
-    for similar_user_id, similarity in similar_users:
-        for item_id, score in user_item_matrix[similar_user_id].items():
-            if item_id not in target_user_items_set:
-                if item_id in candidate_items:
-                    candidate_items[item_id] += score * similarity
-                else:
-                    candidate_items[item_id] = score * similarity
-                    
-     
-     
-                    
     
     # Get top recommended items
-    recommended_items = sorted(candidate_items.items(), key=lambda x: x[1], reverse=True)[:limit]
-    recommended_item_ids = [item_id for item_id, _ in recommended_items]
+    recommended_item_ids = matrix.product_ids[candidate_cols[top_k(candidate_scores, limit)]].tolist()
     
     # If we don't have enough recommendations, add popular products
     if len(recommended_item_ids) < limit:
@@ -160,9 +356,7 @@ def collaborative_filtering(user, limit=5):
     recommended_products = list(Product.objects.filter(id__in=recommended_item_ids, available=True))
     
     # Sort products in the same order as recommended_item_ids
-    recommended_products.sort(key=lambda x: recommended_item_ids.index(x.id))
-    
-    return recommended_products
+    return in_order(recommended_products, recommended_item_ids)
  
 
 
@@ -171,104 +365,66 @@ def collaborative_filtering(user, limit=5):
 
 
 
+def _first_touched_order(snapshot, neighbour_rows, candidate_cols):
+    """
+    Positions of ``candidate_cols`` in the order the neighbours, best first,
+    each first touched them in ``snapshot`` (the order the original dict of
+    candidates was filled in)
+    """
+    matrix = snapshot.matrix
+    position = {col: i for i, col in enumerate(candidate_cols.tolist())}
+    order = {}
+    for row in neighbour_rows.tolist():
+        for product_id, _ in snapshot.user_scores(int(matrix.user_ids[row])):
+            i = position.get(matrix.product_index[product_id])
+            if i is not None and i not in order:
+                order[i] = len(order)
+    return np.fromiter(order, dtype=np.int64, count=len(order))
+
+
+
+
+
+
+
+@instrumented('content_based_filtering')
 def content_based_filtering(product, limit=5):
     """Content-based filtering"""
     if not product:
         return get_popular_products(limit)
     
-    # Get all products
-    all_products = Product.objects.filter(available=True).exclude(id=product.id)
-    
-    
-    
-    # Create feature vectors
-    
-    
-    # For simplicity, we'll use text similarity of ingredients, flavor_profile, and occasion
-    
-    
-    target_features = f"{product.ingredients} {product.flavor_profile} {product.occasion} {product.category.name}"
-    
-    
-    similarities = []
-    for other_product in all_products:
-        other_features = f"{other_product.ingredients} {other_product.flavor_profile} {other_product.occasion} {other_product.category.name}"
-        
-        # Calculate simple text similarity (Jaccard similarity)
-        target_words = set(target_features.lower().split())
-        other_words = set(other_features.lower().split())
-        
-        if not target_words or not other_words:
-            similarity = 0
-        else:
-            intersection = len(target_words & other_words)
-            union = len(target_words | other_words)
-            similarity = intersection / union if union > 0 else 0
-        
-        similarities.append((other_product, similarity))
-        
-        
-    
-    # Sort by similarity and get top recommendations
-    similarities.sort(key=lambda x: x[1], reverse=True)
-    recommended_products = [p for p, _ in similarities[:limit]]
+    # Look the product up in the TF-IDF index over ingredients, flavor_profile,
+    # occasion and category, rebuilt by rebuild_content_index --if-stale after
+    # products change; until it's first built, compare token sets directly
+    index = get_content_index()
+    if index is not None:
+        recommended_ids = index.similar(product, limit)
+    else:
+        recommended_ids = similar_without_index(product, limit)
     
-    return recommended_products
+    recommended_products = Product.objects.filter(id__in=recommended_ids, available=True)
+    return in_order(recommended_products, recommended_ids)
 
 
 
 
 
-def clustering_recommendations(user, limit=5):
+@instrumented('clustering_recommendations')
+def clustering_recommendations(user, limit=5, snapshot=None):
     """K-means clustering based recommendations"""
-    # Get all products
-    all_products = list(Product.objects.filter(available=True))
+    # Fitted model over price and one-hot category/flavor/occasion features,
+    # cached until the catalogue changes
+    model = get_cluster_model()
     
     
     
-    if len(all_products) < 10:  # Not enough products for meaningful clustering
+    if len(model) < MIN_PRODUCTS:  # Not enough products for meaningful clustering
         return get_popular_products(limit)
     
     
     
-    # Create feature vectors (simplified for demonstration)
-    # In a real system, you'd use more sophisticated feature engineering
-    
-    features = []
-    for product in all_products:
-        # Extract numeric features
-        
-        price = float(product.price)
-        
-        # Create a simple feature vector
-        # In a real system, you'd include more features and use techniques like one-hot encoding
-        
-        feature_vector = [price]
-        features.append(feature_vector)
-        
-        
-    
-    # Convert to numpy array
-    features = np.array(features)
-    
-    
-    # Normalize features
-    features_mean = np.mean(features, axis=0)
-    features_std = np.std(features, axis=0)
-    features_normalized = (features - features_mean) / features_std
-    
-    
-    
-    # Apply K-means clustering
-    
-    n_clusters = min(5, len(all_products) // 2)                    # Adjust number of clusters based on data size
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    clusters = kmeans.fit_predict(features_normalized)
-    
-    
-    
     # Find user's preferred cluster
-    user_interactions = UserProductInteraction.objects.filter(user=user)
+    user_interactions = (snapshot or get_interaction_snapshot()).user_scores(user.id)
     
     if not user_interactions:
         return get_popular_products(limit)
@@ -276,25 +432,14 @@ def clustering_recommendations(user, limit=5):
     
     
     
-    # Count interactions by cluster
-    cluster_interactions = defaultdict(int)
-    for interaction in user_interactions:
-        try:
-            product_index = next(i for i, p in enumerate(all_products) if p.id == interaction.product.id)
-            product_cluster = clusters[product_index]
-            
-            # Weight by interaction type
-            weight = 1
-            if interaction.interaction_type == 'cart':
-                weight = 3
-            elif interaction.interaction_type == 'purchase':
-                weight = 5
-            elif interaction.interaction_type == 'rating' and interaction.rating:
-                weight = interaction.rating
-                
-            cluster_interactions[product_cluster] += weight
-        except StopIteration:
+    # Sum interaction scores by cluster
+    cluster_interactions = defaultdict(float)
+    for product_id, score in user_interactions:
+        product_cluster = model.product_clusters.get(product_id)
+        if product_cluster is None:
             continue
+            
+        cluster_interactions[product_cluster] += score
         
         
     
@@ -306,28 +451,18 @@ def clustering_recommendations(user, limit=5):
         
         
     
-    # Get products from preferred cluster that user hasn't interacted with
-    user_product_ids = {interaction.product.id for interaction in user_interactions}
-    recommended_products = []
-    
-    for i, product in enumerate(all_products):
-        if clusters[i] == preferred_cluster and product.id not in user_product_ids:
-            recommended_products.append(product)
-            if len(recommended_products) >= limit:
-                break
-            
-            
-            
+    # Get products from preferred cluster that user hasn't interacted with,
+    # then fill from other clusters in catalogue order
+    user_product_ids = {product_id for product_id, _ in user_interactions}
+    unseen = ~np.isin(model.product_ids, list(user_product_ids))
+    in_cluster = model.clusters == preferred_cluster
     
-    # If we don't have enough recommendations, add products from other clusters
-    if len(recommended_products) < limit:
-        for product in all_products:
-            if product not in recommended_products and product.id not in user_product_ids:
-                recommended_products.append(product)
-                if len(recommended_products) >= limit:
-                    break
+    recommended_ids = model.product_ids[unseen & in_cluster][:limit].tolist()
+    if len(recommended_ids) < limit:
+        recommended_ids += model.product_ids[unseen & ~in_cluster][:limit - len(recommended_ids)].tolist()
     
-    return recommended_products[:limit]
+    recommended_products = Product.objects.filter(id__in=recommended_ids, available=True)
+    return in_order(recommended_products, recommended_ids)[:limit]
 
 
 
@@ -338,7 +473,8 @@ def clustering_recommendations(user, limit=5):
 
 
 
-def clean_recommendations(user, limit=5):
+@instrumented('clean_recommendations')
+def clean_recommendations(user, limit=5, snapshot=None):
     
     
     """
@@ -352,191 +488,93 @@ def clean_recommendations(user, limit=5):
     """
     
     
-    # Get 
-    # 
-    # all user interactions
-    interactions = UserProductInteraction.objects.all()
-    
-    # Get all products
-    all_products = Product.objects.filter(available=True)
+    state = get_similarity_state()
+    if state is not None:
+        candidate_items = _clean_candidates_from_state(state, user)
+    else:
+        candidate_items = _clean_candidates(user, snapshot or get_interaction_snapshot())
     
-    if not interactions or not all_products:
+    if candidate_items is None:
         return get_popular_products(limit)
+    observe_size('clean_recommendations.candidates', len(candidate_items))
     
     
     
+    # Step 6: Apply diversity enhancement - ensure we don't just recommend from one category
+    recommended_items = top_items(candidate_items, limit*2)  # Get more than needed for diversity
     
     
     
-    # Step 1: Calculate interaction statistics for outlier detection
-    product_interaction_counts = defaultdict(int)
-    user_interaction_counts = defaultdict(int)
-    
-    for interaction in interactions:
-        product_interaction_counts[interaction.product.id] += 1
-        user_interaction_counts[interaction.user.id] += 1
-        
-        
-        
-        
-         
-    
-    # Calculate mean and standard deviation for product interactions
-    product_counts = list(product_interaction_counts.values())
-    product_mean = sum(product_counts) / len(product_counts) if product_counts else 0
-    product_std = (sum((x - product_mean) ** 2 for x in product_counts) / len(product_counts)) ** 0.5 if product_counts else 0
-    
-    
-    # Identify outlier products (products with abnormally high interaction counts)
-    outlier_threshold = product_mean + 2 * product_std
-    outlier_products = {pid for pid, count in product_interaction_counts.items() if count > outlier_threshold}
-    
-    
+    # Get product objects for the top recommendations
+    top_product_ids = [item_id for item_id, _ in recommended_items]
+    top_products = list(Product.objects.filter(id__in=top_product_ids, available=True))
     
-    # Step 2: Create normalized user-item interaction matrix
-    user_item_matrix = defaultdict(dict)
     
-    # Weight different interaction types
-    weights = {
-        'view': 1,
-        'cart': 3,
-        'purchase': 5,
-        'rating': 2  # Base weight, will be multiplied by rating value
-    }
     
+    # Select products ensuring category diversity
+    return round_robin_by_category(top_products, lambda product: product.category_id, limit)
+
+
+
+def _clean_candidates_from_state(state, user):
+    """Clean algorithm steps 1-5 read from the maintained SimilarityState"""
+    neighbours = state.neighbours('clean', user.id)
+    if neighbours is None:
+        return None
     
+    neighbour_rows, neighbour_similarities = neighbours
+    candidate_cols, scores = state.matrix.candidate_scores(user.id, neighbour_rows, neighbour_similarities, matrix=state.clean_matrix)
+    return dict(zip(state.matrix.product_ids[candidate_cols].tolist(), scores.tolist()))
+
+
+
+def _clean_candidates(user, snapshot):
+    """
+    Clean algorithm steps 1-5 computed from the interactions in ``snapshot``
     
+    Outlier products are dropped from the snapshot's matrix and each row is
+    divided by its maximum (``snapshot.clean_matrix``), then the user's cosine
+    similarity to every other user is one sparse matrix-vector product. Ties
+    are broken in the order users and products appear in the snapshot.
     
-    # Fill the matrix with weighted interaction scores
-    for interaction in interactions:
-        # Skip outlier products for cleaner recommendations
-        if interaction.product.id in outlier_products:
-            continue
-            
-        score = weights[interaction.interaction_type]
-        if interaction.interaction_type == 'rating' and interaction.rating:
-            score *= interaction.rating
-        
-        if interaction.user.id in user_item_matrix:
-            if interaction.product.id in user_item_matrix[interaction.user.id]:
-                user_item_matrix[interaction.user.id][interaction.product.id] += score
-            else:
-                user_item_matrix[interaction.user.id][interaction.product.id] = score
-        else:
-            user_item_matrix[interaction.user.id] = {interaction.product.id: score}
-            
-            
-            
+    Returns:
+        {product_id: score} for products the user hasn't interacted with,
+        or None when the user should get popular products instead
+    """
+    if not len(snapshot) or not Product.objects.filter(available=True).exists():
+        return None
     
-    # Step 3: Normalize scores per user to address different user activity levels
-    for user_id in user_item_matrix:
-        user_scores = user_item_matrix[user_id]
-        max_score = max(user_scores.values()) if user_scores else 1
-        for product_id in user_scores:
-            user_item_matrix[user_id][product_id] /= max_score
-            
-            
-            
+    matrix = snapshot.matrix
+    clean = snapshot.clean_matrix
+    row = matrix.user_index.get(user.id)
+    if row is None or clean.indptr[row] == clean.indptr[row + 1]:
+        # If user has no interactions left once outliers are removed, return popular products
+        return None
     
-    # Step 4: Find similar users with normalized data
-    target_user_id = user.id
-    if target_user_id not in user_item_matrix:
-        # If user has no interactions, return popular products
-        return get_popular_products(limit)
     
-    user_similarities = {}
-    target_user_items = user_item_matrix[target_user_id]
     
-    for other_user_id, other_user_items in user_item_matrix.items():
-        if other_user_id == target_user_id:
-            continue
-        
-        
-        
-        # Calculate cosine similarity
-        common_items = set(target_user_items.keys()) & set(other_user_items.keys())
-        if not common_items:
-            continue
-            
-        numerator = sum(target_user_items[item] * other_user_items[item] for item in common_items)
-        sum1 = sum(target_user_items[item] ** 2 for item in target_user_items)
-        sum2 = sum(other_user_items[item] ** 2 for item in other_user_items)
-        
-        denominator = (sum1 ** 0.5) * (sum2 ** 0.5)
-        
-        if denominator == 0:
-            continue
-            
-        similarity = numerator / denominator
-        user_similarities[other_user_id] = similarity
-        
-        
-        
+    # Top 10 users sharing at least one product with the target user
+    similarities = matrix.cosine_similarities(user.id, matrix=clean)
+    similarities[row] = 0
+    similar_rows = np.flatnonzero(similarities > 0)
+    order = np.lexsort((snapshot.clean_first_seen[similar_rows], -similarities[similar_rows]))[:10]
+    similar_rows = similar_rows[order]
     
-    # Get top similar users
-    similar_users = sorted(user_similarities.items(), key=lambda x: x[1], reverse=True)[:10]
     
     
+    # Neighbour scores weighted by similarity, summed over neighbours in rank order
+    scores = np.asarray(clean[similar_rows].T @ similarities[similar_rows]).ravel()
+    target_cols = set(clean.indices[clean.indptr[row]:clean.indptr[row + 1]].tolist())
     
-    # Step 5: Get items from similar users that target user hasn't interacted with
-    target_user_items_set = set(target_user_items.keys())
     candidate_items = {}
+    for similar_row in similar_rows.tolist():
+        cols = set(clean.indices[clean.indptr[similar_row]:clean.indptr[similar_row + 1]].tolist()) - target_cols
+        for product_id, _ in snapshot.user_scores(int(matrix.user_ids[similar_row])):
+            col = matrix.product_index[product_id]
+            if col in cols and product_id not in candidate_items:
+                candidate_items[product_id] = float(scores[col])
     
-    for similar_user_id, similarity in similar_users:
-        for item_id, score in user_item_matrix[similar_user_id].items():
-            if item_id not in target_user_items_set:
-                if item_id in candidate_items:
-                    candidate_items[item_id] += score * similarity
-                else:
-                    candidate_items[item_id] = score * similarity
-                    
-                    
-                    
-    
-    # Step 6: Apply diversity enhancement - ensure we don't just recommend from one category
-    recommended_items = sorted(candidate_items.items(), key=lambda x: x[1], reverse=True)
-    
-    
-    
-    # Get product objects for the top recommendations
-    top_product_ids = [item_id for item_id, _ in recommended_items[:limit*2]]  # Get more than needed for diversity
-    top_products = list(Product.objects.filter(id__in=top_product_ids, available=True))
-    
-    
-    
-    # Group by category
-    category_products = defaultdict(list)
-    for product in top_products:
-        category_products[product.category.id].append(product)
-        
-        
-    
-    # Select products ensuring category diversity
-    diverse_products = []
-    categories = list(category_products.keys())
-    
-    
-    
-    # Round-robin selection from different categories
-    
-    while len(diverse_products) < limit and categories:
-        for category_id in categories[:]:
-            if category_products[category_id]:
-                diverse_products.append(category_products[category_id].pop(0))
-                if len(diverse_products) >= limit:
-                    break
-            else:
-                categories.remove(category_id)
-                
-                
-                
-    
-    # If we still need more products, add from the top recommendations
-    if len(diverse_products) < limit:
-        remaining_products = [p for p in top_products if p not in diverse_products]
-        diverse_products.extend(remaining_products[:limit-len(diverse_products)])
-    
-    return diverse_products[:limit]
+    return candidate_items
 
 
 
@@ -545,43 +583,48 @@ def clean_recommendations(user, limit=5):
 
 
 
-def get_popular_products(limit=5):
-    """Get popular products based on interaction count"""
-    # Count interactions for each product
-    product_interactions = defaultdict(int)
+@instrumented('als_recommendations')
+def als_recommendations(user, limit=5):
+    """Matrix factorisation recommendations (see shop.als); popular products until the model is trained"""
+    model = get_als_model()
+    if model is None or user.id not in model:
+        return get_popular_products(limit)
     
-    for interaction in UserProductInteraction.objects.all():
-        weight = 1
-        if interaction.interaction_type == 'cart':
-            weight = 3
-        elif interaction.interaction_type == 'purchase':
-            weight = 5
-        elif interaction.interaction_type == 'rating' and interaction.rating:
-            weight = interaction.rating
-            
-        product_interactions[interaction.product.id] += weight
+    # Over-fetch so products that became unavailable since training can be dropped
+    candidate_ids = model.recommend(user.id, limit * 2)
+    products = Product.objects.filter(id__in=candidate_ids, available=True).in_bulk()
+    if len(products) < min(limit, len(candidate_ids)):
+        available_ids = Product.objects.filter(available=True).values_list('id', flat=True)
+        candidate_ids = model.recommend(user.id, limit, allowed=model.allowed_mask(available_ids))
+        products = Product.objects.filter(id__in=candidate_ids).in_bulk()
     
+    recommended_products = [products[product_id] for product_id in candidate_ids if product_id in products][:limit]
     
+    # If we don't have enough recommendations, add popular products
+    if len(recommended_products) < limit:
+        seen = model.seen_product_ids(user.id)
+        for product in get_popular_products(limit):
+            if len(recommended_products) >= limit:
+                break
+            if product not in recommended_products and product.id not in seen:
+                recommended_products.append(product)
     
+    return recommended_products
     
     
-    # Sort products by interaction count
-    popular_product_ids = sorted(product_interactions.items(), key=lambda x: x[1], reverse=True)
-    popular_product_ids = [p_id for p_id, _ in popular_product_ids]
     
     
-    # Get product objects
-    popular_products = list(Product.objects.filter(id__in=popular_product_ids, available=True)[:limit])
     
+def get_popular_products(limit=5, category=None, decayed=False):
+    """
+    Get popular products based on weighted interaction counts
     
-    # If we don't have enough popular products, add some recent ones
-    if len(popular_products) < limit:
-        recent_products = Product.objects.filter(available=True).order_by('-created')
-        for product in recent_products:
-            if product not in popular_products:
-                popular_products.append(product)
-                if len(popular_products) >= limit:
-                    break
-                
+    Reads the ProductPopularity totals maintained as interactions are recorded,
+    with a short in-process cache in front.
     
-    return popular_products[:limit]
+    Args:
+        limit: Number of products to return
+        category: Optional Category (or id) to restrict to
+        decayed: Favour recent interactions (RECOMMENDER_POPULARITY_HALF_LIFE_DAYS)
+    """
+    return popular_products(limit, category=category, decayed=decayed)
@@ -0,0 +1,169 @@
+from django.db import transaction
+from django.db.models import DateTimeField, F, Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from .models import InteractionRollup, UserProductInteraction
+from .popularity import popularity_boost
+from .scoring import decay_boost, event_units
+
+
+
+# Raw rows pruned by ``manage.py compact_interactions`` unless told otherwise
+DEFAULT_PRUNE_TYPES = ('view',)
+
+
+
+
+def record_rollups(interactions):
+    """
+    Fold interactions into their InteractionRollup rows.
+
+    Called alongside popularity.record_interactions: by the post_save signal
+    for single saves and by the interaction buffer after a bulk insert.
+
+    Args:
+        interactions: Iterable of UserProductInteraction objects
+    """
+    totals = {}
+    for interaction in interactions:
+        _fold(
+            totals,
+            interaction.user_id,
+            interaction.product_id,
+            interaction.interaction_type,
+            interaction.rating,
+            interaction.timestamp or timezone.now(),
+        )
+
+    if not totals:
+        return
+
+    with transaction.atomic():
+        InteractionRollup.objects.bulk_create(
+            [
+                InteractionRollup(
+                    user_id=user_id,
+                    product_id=product_id,
+                    interaction_type=interaction_type,
+                    first_seen=total['first'],
+                    last_seen=total['last'],
+                )
+                for (user_id, product_id, interaction_type), total in totals.items()
+            ],
+            ignore_conflicts=True,
+        )
+        # F() expressions keep concurrent writers from losing each other's increments
+        for (user_id, product_id, interaction_type), total in totals.items():
+            InteractionRollup.objects.filter(
+                user_id=user_id, product_id=product_id, interaction_type=interaction_type,
+            ).update(
+                count=F('count') + total['count'],
+                rating_sum=F('rating_sum') + total['rating_sum'],
+                rating_count=F('rating_count') + total['rating_count'],
+                decayed_units=F('decayed_units') + total['decayed_units'],
+                popularity_units=F('popularity_units') + total['popularity_units'],
+                first_seen=Least(F('first_seen'), Value(total['first'], output_field=DateTimeField())),
+                last_seen=Greatest(F('last_seen'), Value(total['last'], output_field=DateTimeField())),
+            )
+
+
+
+def rebuild_rollups():
+    """
+    Recompute every rollup from the raw interaction table.
+
+    Only safe while the raw table still holds the full history: events whose
+    rows were pruned by ``compact_interactions`` would be lost.
+
+    Returns:
+        Number of rollup rows
+    """
+    totals = {}
+    rows = (
+        UserProductInteraction.objects
+        .order_by()
+        .values_list('user_id', 'product_id', 'interaction_type', 'rating', 'timestamp')
+    )
+    # Folded in Python, so each event's decay comes from its own timestamp
+    for row in rows.iterator(chunk_size=2000):
+        _fold(totals, *row)
+
+    with transaction.atomic():
+        InteractionRollup.objects.all().delete()
+        InteractionRollup.objects.bulk_create(
+            (
+                InteractionRollup(
+                    user_id=user_id,
+                    product_id=product_id,
+                    interaction_type=interaction_type,
+                    count=total['count'],
+                    rating_sum=total['rating_sum'],
+                    rating_count=total['rating_count'],
+                    decayed_units=total['decayed_units'],
+                    popularity_units=total['popularity_units'],
+                    first_seen=total['first'],
+                    last_seen=total['last'],
+                )
+                for (user_id, product_id, interaction_type), total in totals.items()
+            ),
+            batch_size=1000,
+        )
+        return InteractionRollup.objects.count()
+
+
+
+def prune_interactions(before, types=DEFAULT_PRUNE_TYPES):
+    """
+    Delete raw interaction rows older than ``before``.
+
+    Every row is already counted in its rollup when it is written, so this
+    only drops event history; the recommenders read the rollups. Rows newer
+    than the similarity watermark are still needed by incremental updates,
+    so keep ``before`` well behind the last ``update_similarities`` run.
+    The browsing sessions of the "frequently bought together" model are
+    built from raw rows too (see cooccurrence.basket_matrix), so its next
+    rebuild loses the pruned events.
+
+    Args:
+        before: Datetime; older rows are deleted
+        types: Interaction types to prune, or None for every type
+
+    Returns:
+        Number of rows deleted
+    """
+    interactions = UserProductInteraction.objects.filter(timestamp__lt=before)
+    if types is not None:
+        interactions = interactions.filter(interaction_type__in=types)
+    deleted, _ = interactions.delete()
+    return deleted
+
+
+
+def _fold(totals, user_id, product_id, interaction_type, rating, timestamp):
+    """Add one event to the running totals of its (user, product, type)"""
+    key = (user_id, product_id, interaction_type)
+    total = totals.get(key)
+    if total is None:
+        total = totals[key] = {
+            'count': 0, 'rating_sum': 0, 'rating_count': 0, 'decayed_units': 0.0, 'popularity_units': 0.0,
+            'first': timestamp, 'last': timestamp,
+        }
+    units = event_units(interaction_type, rating)
+    total['count'] += 1
+    if rating is not None:
+        total['rating_sum'] += rating
+        total['rating_count'] += 1
+    total['decayed_units'] += units * decay_boost(timestamp)
+    total['popularity_units'] += units * popularity_boost(timestamp)
+    total['first'] = min(total['first'], timestamp)
+    total['last'] = max(total['last'], timestamp)
+
+
+
+def rollup_totals():
+    """Raw row and rollup row counts"""
+    return {
+        'interactions': UserProductInteraction.objects.count(),
+        'rollups': InteractionRollup.objects.count(),
+    }
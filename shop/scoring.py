@@ -0,0 +1,126 @@
+import math
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import UserProductInteraction
+
+
+
+# Decayed scores are stored relative to this instant: a score decayed to "now",
+# w * e^(-rate * (now - t)), equals e^(-rate * now) * w * e^(rate * t). The
+# first factor is shared by every score, so rankings, cosine similarities and
+# per-user normalised scores only need the second, which never goes stale.
+SCORE_EPOCH = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+# Interaction types as small integer codes, in model choice order
+INTERACTION_TYPES = [interaction_type for interaction_type, _ in UserProductInteraction.INTERACTION_TYPES]
+TYPE_CODES = {interaction_type: code for code, interaction_type in enumerate(INTERACTION_TYPES)}
+
+DEFAULT_INTERACTION_WEIGHTS = {
+    'view': 1,
+    'cart': 3,
+    'purchase': 5,
+    'rating': 2,  # Base weight, multiplied by the rating value
+}
+
+
+
+
+def interaction_weights():
+    """Weight per interaction type: RECOMMENDER_INTERACTION_WEIGHTS over the defaults"""
+    return {**DEFAULT_INTERACTION_WEIGHTS, **getattr(settings, 'RECOMMENDER_INTERACTION_WEIGHTS', {})}
+
+
+
+def score_half_life():
+    """RECOMMENDER_SCORE_HALF_LIFE_DAYS; 0 or None turns decay off"""
+    return getattr(settings, 'RECOMMENDER_SCORE_HALF_LIFE_DAYS', 30)
+
+
+
+def scoring_signature():
+    """Hashable summary of the scoring settings, to tell when stored scores are stale"""
+    return (tuple(sorted(interaction_weights().items())), score_half_life())
+
+
+
+def decay_rate(half_life_days=None):
+    """Per-second decay constant for a half-life in days (the score half-life by default)"""
+    if half_life_days is None:
+        half_life_days = score_half_life()
+    if not half_life_days:
+        return 0.0
+    return math.log(2) / (half_life_days * 24 * 60 * 60)
+
+
+
+def epoch_seconds(timestamps):
+    """Array of seconds since SCORE_EPOCH for an iterable of datetimes"""
+    return np.fromiter(((timestamp - SCORE_EPOCH).total_seconds() for timestamp in timestamps), dtype=np.float64)
+
+
+
+def decay_boost(timestamp, half_life_days=None):
+    """Multiplier for an event at ``timestamp`` (see SCORE_EPOCH)"""
+    return math.exp(decay_rate(half_life_days) * (timestamp - SCORE_EPOCH).total_seconds())
+
+
+
+def current_boost(half_life_days=None):
+    """decay_boost now; divide stored scores by it to get their value decayed to the present"""
+    return decay_boost(timezone.now(), half_life_days)
+
+
+
+def decay_boosts(seconds, half_life_days=None):
+    """Vectorised decay_boost over an array of epoch_seconds"""
+    return np.exp(decay_rate(half_life_days) * np.asarray(seconds, dtype=np.float64))
+
+
+
+def score_arrays(type_codes, units, seconds=None, half_life_days=None):
+    """
+    Weighted, time-decayed scores for arrays of interactions.
+
+    Args:
+        type_codes: Codes into INTERACTION_TYPES
+        units: Events per entry, with rating events counted as their rating
+            value (1 when missing)
+        seconds: Optional event times as epoch_seconds; no decay without them
+        half_life_days: Overrides RECOMMENDER_SCORE_HALF_LIFE_DAYS
+
+    Returns:
+        Float64 array of scores
+    """
+    weights = interaction_weights()
+    weights = np.array([weights[interaction_type] for interaction_type in INTERACTION_TYPES], dtype=np.float64)
+    scores = weights[np.asarray(type_codes)] * np.asarray(units, dtype=np.float64)
+    if seconds is not None:
+        scores *= decay_boosts(seconds, half_life_days)
+    return scores
+
+
+
+def event_units(interaction_type, rating=None):
+    """Units of a single interaction: its rating for rating events (1 when missing), otherwise 1"""
+    if interaction_type == 'rating' and rating is not None:
+        return rating
+    return 1
+
+
+
+def interaction_score(interaction_type, rating=None, timestamp=None, half_life_days=None):
+    """Score of a single interaction; undecayed when ``timestamp`` is None"""
+    score = interaction_weights()[interaction_type] * event_units(interaction_type, rating)
+    if timestamp is not None:
+        score *= decay_boost(timestamp, half_life_days)
+    return score
+
+
+
+def rating_units(type_codes, counts, rating_sums, rating_counts):
+    """Units of rolled-up interactions: the count, with each rating counted as its value (1 when missing)"""
+    return np.where(np.asarray(type_codes) == TYPE_CODES['rating'], rating_sums + counts - rating_counts, counts)
@@ -0,0 +1,61 @@
+from django.contrib.auth.signals import user_logged_in
+from django.core.management import call_command
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from .cart import merge_session_cart
+from .content_index import mark_content_index_stale
+from .models import Category, Order, OrderItem, Product, UserProductInteraction
+from .popularity import record_interactions
+from .rollup import record_rollups
+
+
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def catalogue_changed(sender, **kwargs):
+    """Mark the content similarity index stale once the change is committed, for ``rebuild_content_index --if-stale``"""
+    if kwargs.get('raw'):
+        # Fixture loading; the index is rebuilt by build_recommendations
+        return
+    transaction.on_commit(mark_content_index_stale)
+
+
+
+@receiver(post_save, sender=UserProductInteraction)
+def interaction_created(sender, instance, created, **kwargs):
+    """Add new interactions to the product popularity totals and the rollups"""
+    if created and not kwargs.get('raw'):
+        record_interactions([instance])
+        record_rollups([instance])
+
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+def order_item_changed(sender, instance, **kwargs):
+    """Keep the order's stored totals in step with its items (checkout sets them itself, as bulk_create sends no signals)"""
+    if kwargs.get('raw') or isinstance(kwargs.get('origin'), Order):
+        # Fixture loading, or the whole order is being deleted
+        return
+    Order(pk=instance.order_id).update_totals()
+
+
+
+@receiver(post_migrate)
+def backfill_missing_order_totals(sender, verbosity=1, **kwargs):
+    """Fill the stored totals of orders placed before they existed, so deploying the columns with ``migrate`` backfills them"""
+    if sender.label == 'shop':
+        call_command('backfill_order_totals', '--missing', verbosity=verbosity)
+
+
+
+@receiver(user_logged_in)
+def user_signed_in(sender, request, user, **kwargs):
+    """Keep what the visitor put in their cart before signing in"""
+    if request is not None and hasattr(request, 'session'):
+        merge_session_cart(request, user)
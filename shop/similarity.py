@@ -0,0 +1,361 @@
+import copy
+
+import numpy as np
+from django.db import transaction
+
+from .ann import build_ann_index
+from .artifacts import load_artifact, save_artifact
+from .models import UserProductInteraction
+from .scoring import interaction_score, scoring_signature
+from .snapshot import InteractionSnapshot
+
+
+
+STATE_ARTIFACT = 'similarity_state'
+
+# Neighbours served per user; matches the "top 10 similar users" the recommenders use
+N_NEIGHBOURS = 10
+
+# Neighbours stored per user. The spare slots let incremental patches promote
+# a runner-up when a neighbour's similarity drops, without a full rebuild
+N_STORED_NEIGHBOURS = 2 * N_NEIGHBOURS
+
+# Rows of the user x user product computed at once during a full rebuild
+CHUNK_SIZE = 512
+
+
+
+
+class SimilarityState:
+    """
+    Incrementally maintained user similarity data.
+
+    Built and updated by ``manage.py update_similarities`` (or
+    train_recommenders) and saved as an artefact; serving processes only
+    read the saved state, so nothing here runs in a request. Holds the
+    interaction matrix, each user's top neighbours for collaborative
+    filtering (Jaccard on raw interactions) and for the clean algorithm (cosine
+    on outlier-free, per-user normalised scores), plus a watermark of the last
+    UserProductInteraction row applied as ``(timestamp, id)``. Full builds
+    read the InteractionRollup table; newer raw rows are then applied
+    in id order: buffered rows are inserted after their event timestamp, so
+    a timestamp watermark would skip them.
+
+    Once there are RECOMMENDER_ANN_MIN_ROWS users, neighbour rows are
+    computed against candidates from LSH indexes over the user vectors
+    instead of against every user.
+    """
+
+    def __init__(self, matrix, watermark):
+        self.matrix = matrix
+        self.watermark = watermark
+        # Scores depend on the weights and half-life; a change needs a full rebuild
+        self.scoring = scoring_signature()
+        self.collaborative_neighbours = {}
+        self.clean_neighbours = {}
+        self.outlier_product_ids = set()
+        self.clean_matrix = None
+        self.user_ann = None
+        self.clean_ann = None
+
+
+
+    @classmethod
+    def build(cls, snapshot=None, watermark=None):
+        """
+        Full rebuild from the interaction rollups.
+
+        Args:
+            snapshot: Optional InteractionSnapshot to build from, read
+                together with ``watermark`` by ``consistent_snapshot``
+            watermark: Required with ``snapshot``
+        """
+        if snapshot is None:
+            snapshot, watermark = consistent_snapshot()
+        state = cls(snapshot.matrix, watermark)
+        state._rebuild_collaborative()
+        state._rebuild_clean()
+        return state
+
+
+
+    def pending_interactions(self):
+        """Interaction rows inserted after the watermark, in insertion order"""
+        interactions = UserProductInteraction.objects.all()
+        if self.watermark is not None:
+            _, last_id = self.watermark
+            interactions = interactions.filter(id__gt=last_id)
+        return list(_interaction_rows(interactions.order_by('id')))
+
+
+
+    def update(self):
+        """
+        Apply interactions created since the watermark.
+
+        Only the users who interacted get their item vectors and neighbour
+        lists recomputed; their new similarity is patched into the lists of
+        the users they overlap with. Clean neighbours are recomputed for
+        everyone only when the set of outlier products changes.
+
+        Returns:
+            Set of user ids that were updated
+        """
+        rows = self.pending_interactions()
+        if not rows:
+            return set()
+
+        # Each event decayed from its own time, as the rollups' decayed_units
+        # the full build reads; with decay off the boost is 1
+        changed_users = self.matrix.add(
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+            [interaction_score(row[3], row[4], row[5]) for row in rows],
+        )
+        self.watermark = _watermark(rows, self.watermark)
+        changed_rows = [self.matrix.user_index[user_id] for user_id in changed_users]
+
+        if self.user_ann is None:
+            self.user_ann = build_ann_index(self.matrix.binary, metric='jaccard')
+        else:
+            self.user_ann.update(changed_rows, self.matrix.binary[changed_rows])
+
+        for user_id in changed_users:
+            candidates = self._candidates(self.user_ann, self.matrix.binary, user_id)
+            similarities = self.matrix.jaccard_similarities(user_id, rows=candidates)
+            self.collaborative_neighbours[user_id] = self._neighbours(user_id, similarities, include_zero=True)
+            self._patch_neighbours(self.collaborative_neighbours, user_id, similarities)
+
+        if self.matrix.outlier_product_ids() != self.outlier_product_ids:
+            self._rebuild_clean()
+        else:
+            self.clean_matrix = self.matrix.normalised(self.outlier_product_ids)
+            if self.clean_ann is None:
+                self.clean_ann = build_ann_index(self.clean_matrix)
+            else:
+                self.clean_ann.update(changed_rows, self.clean_matrix[changed_rows])
+            for user_id in changed_users:
+                self._update_clean_user(user_id)
+
+        return changed_users
+
+
+
+    def save(self):
+        save_artifact(STATE_ARTIFACT, self)
+
+
+
+    def neighbours(self, kind, user_id):
+        """
+        Top neighbours of a user as (matrix rows, similarities).
+
+        Args:
+            kind: 'collaborative' or 'clean'
+            user_id: Target user id
+
+        Returns:
+            Tuple of arrays, or None if the user has no neighbour list
+        """
+        lists = self.collaborative_neighbours if kind == 'collaborative' else self.clean_neighbours
+        if user_id not in lists:
+            return None
+        ids, sims = lists[user_id]
+        rows = [self.matrix.user_index[int(uid)] for uid in ids[:N_NEIGHBOURS]]
+        return rows, sims[:N_NEIGHBOURS]
+
+
+
+    def _neighbours(self, user_id, similarities, include_zero):
+        rows, sims = self.matrix.nearest_neighbours(user_id, similarities, N_STORED_NEIGHBOURS, include_zero=include_zero)
+        return (self.matrix.user_ids[rows], sims)
+
+
+
+    def _patch_neighbours(self, neighbours, user_id, similarities):
+        """Insert or refresh ``user_id`` in the lists of users it now overlaps with"""
+        target_row = self.matrix.user_index[user_id]
+        for row in np.flatnonzero(similarities > 0):
+            if row == target_row:
+                continue
+            other_id = int(self.matrix.user_ids[row])
+            ids, sims = neighbours.get(other_id, (np.empty(0, dtype=np.int64), np.empty(0)))
+
+            keep = ids != user_id
+            ids = np.append(ids[keep], user_id)
+            sims = np.append(sims[keep], similarities[row])
+
+            # Ties keep matrix row order, as in a full rebuild
+            rows = np.fromiter((self.matrix.user_index[int(uid)] for uid in ids), dtype=np.int64, count=len(ids))
+            order = np.lexsort((rows, -sims))[:N_STORED_NEIGHBOURS]
+            neighbours[other_id] = (ids[order], sims[order])
+
+
+
+    def _update_clean_user(self, user_id, patch=True):
+        row = self.matrix.user_index[user_id]
+        if self.clean_matrix.indptr[row] == self.clean_matrix.indptr[row + 1]:
+            # Every product this user touched is an outlier
+            self.clean_neighbours.pop(user_id, None)
+            return
+        candidates = self._candidates(self.clean_ann, self.clean_matrix, user_id)
+        similarities = self.matrix.cosine_similarities(user_id, matrix=self.clean_matrix, rows=candidates)
+        self.clean_neighbours[user_id] = self._neighbours(user_id, similarities, include_zero=False)
+        if patch:
+            self._patch_neighbours(self.clean_neighbours, user_id, similarities)
+
+
+
+    def _candidates(self, index, vectors, user_id):
+        """Candidate rows from an ANN index, or None to compare against every user"""
+        if index is None:
+            return None
+        return index.candidates(vectors.getrow(self.matrix.user_index[user_id]))
+
+
+
+    def _rebuild_collaborative(self):
+        binary = self.matrix.binary
+        row_sizes = np.diff(binary.indptr)
+        self.collaborative_neighbours = {}
+        self.user_ann = build_ann_index(binary, metric='jaccard')
+
+        if self.user_ann is not None:
+            for user_id in self.matrix.user_ids.tolist():
+                candidates = self._candidates(self.user_ann, binary, user_id)
+                similarities = self.matrix.jaccard_similarities(user_id, rows=candidates)
+                self.collaborative_neighbours[user_id] = self._neighbours(user_id, similarities, include_zero=True)
+            return
+
+        for start, block in _row_blocks(binary, binary.T.tocsc()):
+            for offset in range(block.shape[0]):
+                row = start + offset
+                intersection = block.getrow(offset).toarray().ravel()
+                union = row_sizes + row_sizes[row] - intersection
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    similarities = np.where(union > 0, intersection / union, 0.0)
+                user_id = int(self.matrix.user_ids[row])
+                self.collaborative_neighbours[user_id] = self._neighbours(user_id, similarities, include_zero=True)
+
+
+
+    def _rebuild_clean(self):
+        self.outlier_product_ids = self.matrix.outlier_product_ids()
+        self.clean_matrix = self.matrix.normalised(self.outlier_product_ids)
+        self.clean_neighbours = {}
+        self.clean_ann = build_ann_index(self.clean_matrix)
+
+        if self.clean_ann is not None:
+            for user_id in self.matrix.user_ids.tolist():
+                if self.clean_matrix.getrow(self.matrix.user_index[user_id]).nnz:
+                    self._update_clean_user(user_id, patch=False)
+            return
+
+        norms = np.sqrt(np.asarray(self.clean_matrix.multiply(self.clean_matrix).sum(axis=1)).ravel())
+        for start, block in _row_blocks(self.clean_matrix, self.clean_matrix.T.tocsc()):
+            for offset in range(block.shape[0]):
+                row = start + offset
+                if norms[row] == 0:
+                    continue
+                numerator = block.getrow(offset).toarray().ravel()
+                denominator = norms * norms[row]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    similarities = np.where(denominator > 0, numerator / denominator, 0.0)
+                user_id = int(self.matrix.user_ids[row])
+                self.clean_neighbours[user_id] = self._neighbours(user_id, similarities, include_zero=False)
+
+
+
+
+def get_similarity_state():
+    """
+    Return the saved SimilarityState, as last written by update_similarity_state.
+
+    load_artifact swaps in a newly saved state on the next call, so new
+    interactions show once ``manage.py update_similarities`` has run. The
+    state is never changed here: requests share it, and updating it would
+    both race with them and put a rebuild's cost on whichever request ran it.
+    Returns None if the state has never been built, or was built with
+    different scoring settings.
+    """
+    state = load_artifact(STATE_ARTIFACT)
+    if state is None or getattr(state, 'scoring', None) != scoring_signature():
+        return None
+    return state
+
+
+
+def update_similarity_state(full=False, snapshot=None, watermark=None):
+    """
+    Bring the saved state up to date and save it.
+
+    The update is applied to a copy, so a state this process is serving is
+    replaced rather than changed under its readers.
+
+    Args:
+        full: Rebuild from scratch instead of applying new interactions
+        snapshot, watermark: Passed to SimilarityState.build for a rebuild
+
+    Returns:
+        (state, number of users updated)
+    """
+    state = None if full else load_artifact(STATE_ARTIFACT)
+    if state is None or getattr(state, 'scoring', None) != scoring_signature():
+        state = SimilarityState.build(snapshot, watermark)
+        changed = len(state.matrix)
+    else:
+        state = copy.deepcopy(state)
+        changed = len(state.update())
+    state.save()
+    return state, changed
+
+
+
+def consistent_snapshot():
+    """
+    Read the interaction rollups and the watermark for a full build in one transaction.
+
+    Both reads then see the same committed rows (MySQL's default REPEATABLE
+    READ isolation gives a transaction one consistent view), so the
+    watermark is exactly the newest raw row the rollups include: nothing is
+    applied twice by the next update, or missed. Interactions are written
+    in the same transaction as their rollups (see shop.interaction_buffer).
+
+    Returns:
+        (loaded InteractionSnapshot, watermark)
+    """
+    with transaction.atomic():
+        watermark = latest_interaction()
+        snapshot = InteractionSnapshot().load()
+    return snapshot, watermark
+
+
+
+
+def latest_interaction():
+    """``(timestamp, id)`` of the newest UserProductInteraction row, the watermark for a rebuild"""
+    return UserProductInteraction.objects.order_by('-id').values_list('timestamp', 'id').first()
+
+
+
+
+def _interaction_rows(interactions):
+    return interactions.values_list('id', 'user_id', 'product_id', 'interaction_type', 'rating', 'timestamp')
+
+
+
+def _watermark(rows, current):
+    if not rows:
+        return current
+    # (timestamp, id) of the row with the highest id
+    latest_id, latest_timestamp = max((row[0], row[5]) for row in rows)
+    if current is not None and current[1] > latest_id:
+        return current
+    return (latest_timestamp, latest_id)
+
+
+
+def _row_blocks(matrix, transposed):
+    """Yield (first row, rows x users product) blocks of ``matrix @ matrix.T``"""
+    for start in range(0, matrix.shape[0], CHUNK_SIZE):
+        yield start, (matrix[start:start + CHUNK_SIZE] @ transposed).tocsr()
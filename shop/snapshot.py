@@ -0,0 +1,255 @@
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from scipy import sparse
+
+from .artifacts import delete_array, load_array, save_array
+from .interaction_matrix import InteractionMatrix
+from .models import InteractionRollup
+from .scoring import INTERACTION_TYPES, TYPE_CODES, rating_units, score_arrays, score_half_life
+
+
+
+# Arrays a snapshot is made of, as written by save_arrays
+SNAPSHOT_ARRAYS = ('user_ids', 'product_ids', 'types', 'counts', 'units', 'decayed_units')
+
+_process_snapshot = None
+_process_lock = threading.Lock()
+
+
+
+
+class InteractionSnapshot:
+    """
+    One read of the InteractionRollup table shared by the recommenders.
+
+    Nothing is queried until the data is first needed, then a single
+    ``values_list`` query fills compact parallel arrays (``user_ids``,
+    ``product_ids``, ``types`` as codes into INTERACTION_TYPES, ``counts`` of
+    raw events, ``units``: the count, with each rating event counted as its
+    rating value, and ``decayed_units``: the units with each event decayed
+    from its own time, relative to scoring.SCORE_EPOCH) in the table's
+    default order. Each entry stands for all of one user's events of one
+    type on one product. Scores, per-user scores and the interaction
+    matrices are computed from the arrays on first use and kept.
+    """
+
+    def __init__(self):
+        self.loaded_at = None
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._clean_matrix = None
+        self._clean_first_seen = None
+        self._first_touched = None
+        self._scores = None
+        self._user_positions = None
+        self._user_scores = {}
+
+
+
+    def _load(self):
+        with self._lock:
+            if self.loaded_at is not None:
+                return
+            rows = list(InteractionRollup.objects.values_list(
+                'user_id', 'product_id', 'interaction_type', 'count', 'rating_sum', 'rating_count', 'decayed_units',
+            ))
+            self.user_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            self.product_ids = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+            self.types = np.fromiter((TYPE_CODES[row[2]] for row in rows), dtype=np.int8, count=len(rows))
+            self.counts = np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows))
+            rating_sums = np.fromiter((row[4] for row in rows), dtype=np.int64, count=len(rows))
+            rating_counts = np.fromiter((row[5] for row in rows), dtype=np.int64, count=len(rows))
+            self.units = rating_units(self.types, self.counts, rating_sums, rating_counts)
+            self.decayed_units = np.fromiter((row[6] for row in rows), dtype=np.float64, count=len(rows))
+            self.loaded_at = time.monotonic()
+
+
+
+    def load(self):
+        """Read the rollups now instead of on first use, e.g. inside a transaction; returns self"""
+        self._load()
+        return self
+
+
+
+    def __getattr__(self, name):
+        # Only reached for the arrays, before they have been loaded
+        if name in SNAPSHOT_ARRAYS:
+            self._load()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
+
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+
+    def save_arrays(self, version):
+        """Write the arrays as ``.npy`` artefacts for other processes to open with ``mapped``"""
+        for name in SNAPSHOT_ARRAYS:
+            save_array(_array_name(name, version), getattr(self, name))
+
+
+
+    @classmethod
+    def mapped(cls, version):
+        """
+        Snapshot over arrays written by ``save_arrays``, memory-mapped read-only.
+
+        Processes mapping the same version share the pages instead of each
+        querying and holding their own copy.
+        """
+        snapshot = cls()
+        for name in SNAPSHOT_ARRAYS:
+            array = load_array(_array_name(name, version))
+            if array is None:
+                raise FileNotFoundError(f'Snapshot {version} has no {name} array')
+            snapshot.__dict__[name] = array
+        snapshot.loaded_at = time.monotonic()
+        return snapshot
+
+
+
+    def rows(self, positions=None):
+        """Yield (user_id, product_id, interaction_type, count, units) tuples, optionally for some positions only"""
+        if positions is None:
+            positions = slice(None)
+        for user_id, product_id, code, count, units in zip(
+            self.user_ids[positions].tolist(),
+            self.product_ids[positions].tolist(),
+            self.types[positions].tolist(),
+            self.counts[positions].tolist(),
+            self.units[positions].tolist(),
+        ):
+            yield user_id, product_id, INTERACTION_TYPES[code], count, units
+
+
+
+    def user_rows(self, user_id):
+        """(product_id, interaction_type, count, units) for one user, in snapshot order"""
+        return [row[1:] for row in self.rows(self._positions(user_id))]
+
+
+
+    def user_scores(self, user_id):
+        """(product_id, score) for each of one user's entries, in snapshot order; cached per user"""
+        scores = self._user_scores.get(user_id)
+        if scores is None:
+            positions = self._positions(user_id)
+            scores = self._user_scores[user_id] = list(zip(
+                self.product_ids[positions].tolist(),
+                self.scores()[positions].tolist(),
+            ))
+        return scores
+
+
+
+    def scores(self):
+        """Weighted, time-decayed score of every entry (see shop.scoring)"""
+        if self._scores is None:
+            # decayed_units is summed at the configured half-life; with decay off the plain units apply
+            self._scores = score_arrays(self.types, self.decayed_units if score_half_life() else self.units)
+        return self._scores
+
+
+
+    def _positions(self, user_id):
+        if self._user_positions is None:
+            order = np.argsort(self.user_ids, kind='stable')
+            users, starts = np.unique(self.user_ids[order], return_index=True)
+            ends = np.append(starts[1:], len(order))
+            self._user_positions = {
+                int(uid): order[start:end] for uid, start, end in zip(users, starts, ends)
+            }
+        return self._user_positions.get(user_id, np.empty(0, dtype=np.int64))
+
+
+
+    @property
+    def matrix(self):
+        """InteractionMatrix over the snapshot"""
+        if self._matrix is None:
+            self._matrix = InteractionMatrix.from_arrays(self.user_ids, self.product_ids, self.scores(), self.counts)
+        return self._matrix
+
+
+
+    @property
+    def clean_matrix(self):
+        """``matrix`` without its outlier products and with each user's scores divided by their maximum"""
+        if self._clean_matrix is None:
+            self._clean_matrix = self.matrix.normalised(self.matrix.outlier_product_ids())
+        return self._clean_matrix
+
+
+
+    @property
+    def first_touched(self):
+        """CSR matrix shaped like ``matrix``: per user and product, 1 + the position of the user's first entry for it"""
+        if self._first_touched is None:
+            matrix = self.matrix
+            rows = np.fromiter((matrix.user_index[uid] for uid in self.user_ids.tolist()), dtype=np.int64, count=len(self))
+            cols = np.fromiter((matrix.product_index[pid] for pid in self.product_ids.tolist()), dtype=np.int64, count=len(self))
+            # np.unique returns the first, i.e. lowest, position of every cell
+            cells, first = np.unique(rows * len(matrix.product_ids) + cols, return_index=True)
+            self._first_touched = sparse.csr_matrix(
+                (first + 1, np.divmod(cells, len(matrix.product_ids))), shape=matrix.matrix.shape,
+            )
+        return self._first_touched
+
+
+
+    @property
+    def clean_first_seen(self):
+        """Per ``matrix`` row, the position of the user's first entry kept in ``clean_matrix`` (len(self) if none)"""
+        if self._clean_first_seen is None:
+            user_ids = self.matrix.user_ids
+            outliers = np.fromiter(self.matrix.outlier_product_ids(), dtype=np.int64)
+            kept = np.flatnonzero(~np.isin(self.product_ids, outliers))
+            users, first = np.unique(self.user_ids[kept], return_index=True)
+
+            first_seen = np.full(len(user_ids), len(self), dtype=np.int64)
+            found = np.isin(user_ids, users)
+            first_seen[found] = kept[first[np.searchsorted(users, user_ids[found])]]
+            self._clean_first_seen = first_seen
+        return self._clean_first_seen
+
+
+
+
+def delete_snapshot_arrays(version):
+    """Remove the arrays ``save_arrays`` wrote for ``version``"""
+    for name in SNAPSHOT_ARRAYS:
+        delete_array(_array_name(name, version))
+
+
+
+def _array_name(name, version):
+    return f'snapshot_{name}.{version}'
+
+
+
+def get_interaction_snapshot():
+    """
+    Return an interaction snapshot to pass to the recommenders.
+
+    A new (lazy) snapshot is returned per call, so callers wanting one read per
+    request should create it once and pass it along. When
+    RECOMMENDER_SNAPSHOT_TTL_SECONDS is set, a process-wide snapshot is shared
+    until it is that old.
+    """
+    global _process_snapshot
+    ttl = getattr(settings, 'RECOMMENDER_SNAPSHOT_TTL_SECONDS', 0)
+    if not ttl:
+        return InteractionSnapshot()
+
+    with _process_lock:
+        snapshot = _process_snapshot
+        if snapshot is None or (snapshot.loaded_at is not None and time.monotonic() - snapshot.loaded_at >= ttl):
+            snapshot = _process_snapshot = InteractionSnapshot()
+    return snapshot
@@ -0,0 +1,150 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.db import connections
+
+from .als import train_als
+from .artifacts import delete_artifact, publish_artifacts, staged_artifacts
+from .clustering import rebuild_cluster_model
+from .content_index import rebuild_content_index
+from .cooccurrence import rebuild_together
+from .similarity import consistent_snapshot, update_similarity_state
+from .snapshot import InteractionSnapshot, delete_snapshot_arrays
+
+
+
+
+def _train_similarity(snapshot, watermark):
+    _, changed = update_similarity_state(full=True, snapshot=snapshot, watermark=watermark)
+    return changed
+
+
+
+def _train_als(snapshot, watermark):
+    return len(train_als(snapshot))
+
+
+
+def _train_clustering(snapshot, watermark):
+    return len(rebuild_cluster_model())
+
+
+
+def _train_content(snapshot, watermark):
+    return len(rebuild_content_index().product_ids)
+
+
+
+def _train_together(snapshot, watermark):
+    return rebuild_together()
+
+
+
+# Model builds run by train_recommenders. Each takes the shared snapshot and
+# the watermark it was read after, saves its artefact and returns how many
+# users or products it covers
+TRAINERS = {
+    'similarity': _train_similarity,
+    'als': _train_als,
+    'clustering': _train_clustering,
+    'content': _train_content,
+    'together': _train_together,
+}
+
+# Builds that rewrite database tables (the stored content and together
+# rows). They run one after another in the calling process rather than in
+# the pool: parallel writers fail on SQLite with "database is locked"
+TABLE_TRAINERS = ('content', 'together')
+
+
+
+
+def train_recommenders(models=None, workers=None):
+    """
+    Build the recommendation models side by side and publish them together.
+
+    The interaction rollups are read once and the snapshot arrays written as
+    ``.npy`` artefacts named after this run's version; each build runs in a
+    worker process that memory-maps them read-only, so the workers share one
+    copy instead of each querying their own. The TABLE_TRAINERS run
+    afterwards in this process, one at a time.
+
+    Every model is saved under the run's version without being published
+    (see staged_artifacts), so serving processes keep loading the previous
+    models while the run is in progress. Once every build has succeeded the
+    manifest, written last, points at all of them in one atomic write and
+    load_artifact picks them up on its next call, without a restart. If a
+    build fails nothing is published and the run's artefacts are deleted;
+    the stored content and together rows are replaced by their own builds,
+    in a transaction each, whether or not the run is published.
+
+    Args:
+        models: Names from TRAINERS (defaults to all of them)
+        workers: Worker processes; defaults to one per pooled model up to
+            the CPU count, and 1 runs every build in this process
+
+    Returns:
+        The run's details: version, timings, per-model results (where a
+        failed build has an 'error' instead of a count) and whether it was
+        published
+    """
+    models = list(models or TRAINERS)
+    pooled = [name for name in models if name not in TABLE_TRAINERS]
+    workers = max(1, min(len(pooled), workers or os.cpu_count() or 1))
+    version = f'{time.time_ns():x}'
+    started = time.time()
+
+    snapshot, watermark = consistent_snapshot()
+    snapshot.save_arrays(version)
+
+    results = {}
+    try:
+        if workers < 2:
+            for name in pooled:
+                results[name] = _train(name, version, watermark)
+        else:
+            # Workers open their own database connections instead of sharing ours
+            connections.close_all()
+            # Spawned workers (the default outside Linux) start without Django configured
+            with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+                futures = {pool.submit(_train, name, version, watermark): name for name in pooled}
+                for future in as_completed(futures):
+                    results[futures[future]] = future.result()
+
+        for name in models:
+            if name in TABLE_TRAINERS:
+                results[name] = _train(name, version, watermark)
+    finally:
+        delete_snapshot_arrays(version)
+
+    saved = [artifact for result in results.values() for artifact in result.get('artifacts', ())]
+    manifest = {
+        'version': version,
+        'started_at': started,
+        'seconds': round(time.time() - started, 3),
+        'interactions': len(snapshot),
+        'watermark': watermark,
+        'workers': workers,
+        'models': {name: results[name] for name in models},
+        'published': not any('error' in result for result in results.values()),
+    }
+    if manifest['published']:
+        publish_artifacts({artifact: version for artifact in saved}, manifest)
+    else:
+        for artifact in saved:
+            delete_artifact(artifact, version)
+    return manifest
+
+
+
+def _train(name, version, watermark):
+    """Run one build on the mapped snapshot, reporting a failure rather than raising so the others finish"""
+    started = time.perf_counter()
+    try:
+        with staged_artifacts(version) as saved:
+            count = TRAINERS[name](InteractionSnapshot.mapped(version), watermark)
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}', 'artifacts': sorted(saved)}
+    return {'count': count, 'seconds': round(time.perf_counter() - started, 3), 'artifacts': sorted(saved)}
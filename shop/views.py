@@ -8,6 +8,7 @@ from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse, JsonResponse
 from django.core.paginator import Paginator
+from django.db import transaction
 from django.db.models import Q, Avg, Count
 from django.contrib import messages
 from django.core.mail import send_mail, EmailMessage
@@ -25,10 +26,13 @@ import json
 import logging
 import requests
 
-from .models import Category, Product, Order, OrderItem, UserProductInteraction, EsewaPayment
+from .models import Category, Product, Order, OrderItem, EsewaPayment
 from .forms import OrderCreateForm
 from .recommendation import get_recommendations
-from .cart import Cart
+from .cooccurrence import frequently_bought_together
+from .snapshot import get_interaction_snapshot
+from .interaction_buffer import log_interaction, log_interactions
+from .cart import Cart, checkout_problems
 
 
 
@@ -104,8 +108,10 @@ def home(request):
     recommended_products = []
     clean_recommended_products = []
     if request.user.is_authenticated:
-        recommended_products = get_recommendations(request.user, 'collaborative', limit=4)
-        clean_recommended_products = get_recommendations(request.user, 'clean', limit=4)
+        # Both recommenders read the interactions from one shared snapshot
+        snapshot = get_interaction_snapshot()
+        recommended_products = get_recommendations(request.user, 'collaborative', limit=4, snapshot=snapshot)
+        clean_recommended_products = get_recommendations(request.user, 'clean', limit=4, snapshot=snapshot)
         
     return render(request, 'shop/home.html', {
         'products': products,
@@ -145,17 +151,15 @@ def product_detail(request, id, slug):
     product = get_object_or_404(Product, id=id, slug=slug, available=True)
     
     if request.user.is_authenticated:
-        UserProductInteraction.objects.create(
-            user=request.user,
-            product=product,
-            interaction_type='view'
-        )
+        log_interaction(request.user, product, 'view')
     
     similar_products = get_recommendations(request.user, 'content', product=product, limit=4)
+    bought_together = frequently_bought_together([product.id], limit=4)
     
     return render(request, 'shop/product_detail.html', {
         'product': product,
-        'similar_products': similar_products
+        'similar_products': similar_products,
+        'bought_together': bought_together
     })
 
 
@@ -171,11 +175,7 @@ def cart_add(request, product_id):
     cart.add(product, quantity=quantity)
     
     if request.user.is_authenticated:
-        UserProductInteraction.objects.create(
-            user=request.user,
-            product=product,
-            interaction_type='cart'
-        )
+        log_interaction(request.user, product, 'cart')
     
     return redirect('shop:cart_detail')
 
@@ -194,7 +194,8 @@ def cart_remove(request, product_id):
 
 def cart_detail(request):
     cart = Cart(request)
-    return render(request, 'shop/cart.html', {'cart': cart})
+    bought_together = frequently_bought_together(cart.product_ids(), limit=4)
+    return render(request, 'shop/cart.html', {'cart': cart, 'bought_together': bought_together})
 
 
 
@@ -210,34 +211,46 @@ def order_create(request):
     if request.method == 'POST':
         form = OrderCreateForm(request.POST)
         if form.is_valid():
-            order = form.save(commit=False)
-            order.user = request.user
-            payment_method = request.POST.get('payment_method', 'cod')
-            payment_status = 'pending'
-            
-            order.payment_method = payment_method
-            order.payment_status = payment_status
-            order.save()
-            
-            for item in cart:
-                OrderItem.objects.create(
-                    order=order,
-                    product=item['product'],
-                    price=item['price'],
-                    quantity=item['quantity']
-                )
+            with transaction.atomic():
+                # Read the lines under the cart's lock, so a change from another
+                # tab waits until this order is written and the cart cleared
+                cart.lock()
+                lines = list(cart)
+                if not lines:
+                    messages.error(request, "Your cart is empty. Please add some products before checkout.")
+                    return redirect('shop:cart_detail')
+                unavailable, changed_prices = checkout_problems(lines)
+                if unavailable:
+                    messages.error(request, f"No longer available: {', '.join(unavailable)}. Please remove them from your cart.")
+                    return redirect('shop:cart_detail')
+                if changed_prices:
+                    cart.update_prices(changed_prices)
+                    messages.warning(request, "Some prices have changed since you added the items. Please review your cart.")
+                    return redirect('shop:cart_detail')
                 
-                if request.user.is_authenticated:
-                    UserProductInteraction.objects.create(
-                        user=request.user,
-                        product=item['product'],
-                        interaction_type='purchase'
-                    )
-            
-            if payment_method == 'esewa':
-                return redirect('shop:esewa_payment', order_id=order.id)
-            
-            cart.clear()
+                order = form.save(commit=False)
+                order.user = request.user
+                payment_method = request.POST.get('payment_method', 'cod')
+                payment_status = 'pending'
+                
+                order.payment_method = payment_method
+                order.payment_status = payment_status
+                order.set_totals(sum(line['total_price'] for line in lines))
+                order.save()
+                
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=line['product'], price=line['price'], quantity=line['quantity'])
+                    for line in lines
+                ])
+                
+                # Only count purchases that were actually committed
+                products = [line['product'] for line in lines]
+                transaction.on_commit(lambda: log_interactions(request.user, products, 'purchase'))
+                
+                if payment_method == 'esewa':
+                    return redirect('shop:esewa_payment', order_id=order.id)
+                
+                cart.clear()
             
             return render(request, 'shop/order_created.html', {'order': order})
     else:
@@ -256,11 +269,11 @@ def order_create(request):
 def esewa_payment(request, order_id):
     order = get_object_or_404(Order, id=order_id, user=request.user)
     
-    amount = "{:.2f}".format(float(order.get_total_cost()))
-    tax_amount = "{:.2f}".format(float(order.get_total_cost()) * 0.13)
+    amount = "{:.2f}".format(order.subtotal)
+    tax_amount = "{:.2f}".format(order.tax)
     service_charge = "0.00"
     delivery_charge = "0.00"
-    total_amount = "{:.2f}".format(float(amount) + float(tax_amount) + float(service_charge) + float(delivery_charge))
+    total_amount = "{:.2f}".format(order.total)
     
     transaction_uuid = str(uuid.uuid4())
     
@@ -534,11 +547,9 @@ def quick_view(request, product_id):
             
             # Track view interaction  
             if request.user.is_authenticated:
-                UserProductInteraction.objects.create(
-                    user=request.user,
-                    product=product,
-                    interaction_type='view'
-                )
+                log_interaction(request.user, product, 'view')
+            
+            similar_products = get_recommendations(request.user, 'content', product=product, limit=4)
             
             data = {
                 'id': product.id,
@@ -551,6 +562,16 @@ def quick_view(request, product_id):
                 'ingredients': product.ingredients,
                 'flavor_profile': product.flavor_profile,
                 'occasion': product.occasion,
+                'similar_products': [
+                    {
+                        'id': similar.id,
+                        'name': similar.name,
+                        'price': str(similar.price),
+                        'image_url': similar.image.url if similar.image else '/static/images/placeholder.jpg',
+                        'url': similar.get_absolute_url(),
+                    }
+                    for similar in similar_products
+                ],
             }
             
             return JsonResponse({'success': True, 'product': data})
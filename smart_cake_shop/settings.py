@@ -122,6 +122,44 @@ LOGOUT_REDIRECT_URL = '/'
 
 # Cart session
 CART_SESSION_ID = 'cart'
+CART_COUNT_SESSION_ID = 'cart_count'  # Item count kept in the session so the cart badge needs no query
+CART_LOG_SAMPLE_RATE = 0.01  # Fraction of cart adds/removes logged when the shop.cart logger is at DEBUG (invalid ids are always logged)
+
+# Orders
+ORDER_TAX_RATE = '0.13'  # VAT charged on the order subtotal (stored on Order.tax)
+
+# Recommendation engine
+RECOMMENDER_ARTIFACT_DIR = BASE_DIR / 'recommender_artifacts'
+RECOMMENDER_ANN_MIN_ROWS = 5000  # Search LSH candidates instead of every user/product above this size
+RECOMMENDER_POPULARITY_HALF_LIFE_DAYS = 7  # Half-life of an interaction in the time-decayed popularity score (after changing it run compact_interactions --rebuild)
+RECOMMENDER_POPULARITY_CACHE_SECONDS = 30  # How long popular product lists are cached in-process
+RECOMMENDER_SNAPSHOT_TTL_SECONDS = 0  # Share one interaction snapshot per process for this long (0: one per request)
+RECOMMENDER_PROFILE_SAMPLE_RATE = 0  # Fraction of recommender calls run under cProfile (see the metrics endpoint)
+
+# Interaction scoring (shop.scoring); changing these triggers a full similarity rebuild
+RECOMMENDER_INTERACTION_WEIGHTS = {'view': 1, 'cart': 3, 'purchase': 5, 'rating': 2}  # Ratings are multiplied by their value
+RECOMMENDER_SCORE_HALF_LIFE_DAYS = 30  # Half-life of an interaction in recommender scores (0: no decay; after changing it run compact_interactions --rebuild)
+
+# Matrix factorisation (shop.als), trained by build_recommendations
+RECOMMENDER_ALS_FACTORS = 32  # Latent factors per user/product
+RECOMMENDER_ALS_ITERATIONS = 10  # Alternating solves of user then item factors
+RECOMMENDER_ALS_REGULARIZATION = 1.0  # L2 penalty on the factors; raise it if recommendations look noisy
+RECOMMENDER_ALS_ALPHA = 10.0  # Confidence per unit of decayed interaction score
+
+# Frequently bought together (shop.cooccurrence), rebuilt by build_recommendations
+RECOMMENDER_TOGETHER_TOP_K = 10  # Co-occurring products stored per product
+RECOMMENDER_SESSION_GAP_MINUTES = 30  # A pause this long between a user's interactions starts a new session
+RECOMMENDER_SESSION_WEIGHT = 0.5  # Weight of a browsing session relative to an order
+
+# Diversity re-ranking (shop.diversity), for get_recommendations(diversity=...)
+RECOMMENDER_DIVERSITY_POOL = 3  # Candidates fetched per recommendation slot before re-ranking
+RECOMMENDER_MMR_TRADE_OFF = 0.7  # 1 keeps the method's ranking, lower values favour products unlike those already picked
+
+# Interaction logging (shop.interaction_buffer)
+RECOMMENDER_ASYNC_INTERACTIONS = True  # Queue interactions and insert them in batches off the request path
+RECOMMENDER_INTERACTION_BATCH_SIZE = 500  # Rows per bulk_create
+RECOMMENDER_INTERACTION_FLUSH_SECONDS = 2  # Longest an interaction waits in the queue
+RECOMMENDER_INTERACTION_QUEUE_SIZE = 10000  # Past this, interactions are written inline
 
 # Email Configuration
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'